@@ -2,4 +2,8 @@ from django.apps import AppConfig
  
 class AccountsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
-    name = 'accounts' 
\ No newline at end of file
+    name = 'accounts'
+
+    def ready(self):
+        # Connect the token cache invalidation signals
+        from . import authentication  # noqa: F401
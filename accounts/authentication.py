@@ -0,0 +1,146 @@
+"""
+Cached DRF token authentication.
+
+``TokenAuthentication`` joins the token and user tables on every API
+request. ``CachedTokenAuthentication`` keeps token -> user lookups in a
+small per-process LRU backed by the shared cache, so polling clients
+authenticate without touching the database.
+
+Entries are dropped when a token is deleted (including when its user is
+deleted) or its user is saved, e.g. deactivated. That clears the shared
+cache for every process, but other processes' LRUs only expire, which
+is why their TTL is kept short.
+"""
+from collections import OrderedDict
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils.translation import gettext_lazy as _
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+TOKEN_CACHE_SECONDS = getattr(settings, 'TOKEN_AUTH_CACHE_SECONDS', 300)
+TOKEN_LOCAL_SECONDS = getattr(settings, 'TOKEN_AUTH_LOCAL_SECONDS', 30)
+TOKEN_LOCAL_SIZE = getattr(settings, 'TOKEN_AUTH_LOCAL_SIZE', 1024)
+
+
+class TokenLRU:
+    """A thread-safe LRU whose entries also expire after ``ttl`` seconds"""
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+local_tokens = TokenLRU(TOKEN_LOCAL_SIZE, TOKEN_LOCAL_SECONDS)
+
+
+def _cache_key(token_key):
+    # Never use the raw token as a cache key; it would sit in the cache table
+    return f'auth-token:{hashlib.sha256(token_key.encode()).hexdigest()}'
+
+
+def _user_fields(User):
+    # The password hash is left out of the cache; it stays a deferred field
+    return [
+        field.attname for field in User._meta.concrete_fields
+        if field.attname != 'password'
+    ]
+
+
+def _load(token_key):
+    """(field names, values) of the token's user, or None if there is no such token"""
+    User = get_user_model()
+    names = _user_fields(User)
+    values = (
+        User.objects.filter(auth_token__key=token_key)
+        .values_list(*names)
+        .first()
+    )
+    if values is None:
+        return None
+    return names, values
+
+
+def invalidate_token(token_key):
+    local_tokens.delete(token_key)
+    cache.delete(_cache_key(token_key))
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """Drop-in replacement for ``TokenAuthentication`` that caches lookups"""
+
+    def authenticate_credentials(self, key):
+        row = local_tokens.get(key)
+        if row is None:
+            cache_key = _cache_key(key)
+            row = cache.get(cache_key)
+            if row is None:
+                row = _load(key)
+                if row is None:
+                    raise exceptions.AuthenticationFailed(_('Invalid token.'))
+                cache.set(cache_key, row, TOKEN_CACHE_SECONDS)
+            local_tokens.set(key, row)
+
+        names, values = row
+        # A fresh instance per request, so no request sees another's changes
+        user = get_user_model().from_db(Token.objects.db, names, values)
+        if not user.is_active:
+            raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
+        token = Token(key=key, user=user)
+        token._state.adding = False
+        return user, token
+
+
+@receiver(post_delete, sender=Token)
+def invalidate_deleted_token(sender, instance, **kwargs):
+    invalidate_token(instance.key)
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def invalidate_user_tokens(sender, instance, created=False, update_fields=None, **kwargs):
+    """
+    Forget cached lookups when a user changes, e.g. is deactivated.
+
+    Deleting a user deletes its token, which is handled above.
+    """
+    if created or (update_fields is not None and set(update_fields) <= {'last_login'}):
+        return
+    for token_key in Token.objects.filter(user_id=instance.pk).values_list('key', flat=True):
+        invalidate_token(token_key)
@@ -1,15 +1,35 @@
 from django.contrib.auth.backends import ModelBackend
 from django.contrib.auth import get_user_model
 
+from .throttle import (
+    check_login_allowed,
+    record_login_failure,
+    record_login_success,
+    run_dummy_hash,
+)
+
 class EmailBackend(ModelBackend):
     def authenticate(self, request, email=None, password=None, **kwargs):
         UserModel = get_user_model()
+        # The admin login form passes the email as ``username``
+        email = email or kwargs.get(UserModel.USERNAME_FIELD) or kwargs.get('username')
+        if not email or password is None:
+            return None
+
+        # Refuse throttled attempts before spending time on the hash
+        if not check_login_allowed(request, email).allowed:
+            return None
+
         try:
             user = UserModel.objects.get(email=email)
-            if user.check_password(password):
-                return user
         except UserModel.DoesNotExist:
+            run_dummy_hash(password)
+            record_login_failure(request, email)
             return None
+        if user.check_password(password):
+            record_login_success(request, email)
+            return user
+        record_login_failure(request, email)
         return None
 
     def get_user(self, user_id):
@@ -17,4 +37,4 @@ class EmailBackend(ModelBackend):
         try:
             return UserModel.objects.get(pk=user_id)
         except UserModel.DoesNotExist:
-            return None 
\ No newline at end of file
+            return None
@@ -0,0 +1,209 @@
+import json
+import time
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache, caches
+from django.db import connection
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework import exceptions
+from rest_framework.authtoken.models import Token
+
+from accounts import throttle, views
+from accounts.authentication import CachedTokenAuthentication, _cache_key, local_tokens
+from futureme import ratelimit
+from futureme.ratelimit import TokenBucket, cache_lock, client_ip
+from letters.cache import CACHE_ALIAS
+from letters.models import Letter
+from letters.tests import make_letters
+
+User = get_user_model()
+
+
+class CachedTokenAuthenticationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        caches[CACHE_ALIAS].clear()
+        local_tokens.clear()
+        self.user = User.objects.create_user(email='token@example.com', password='first-password')
+        self.token = Token.objects.create(user=self.user)
+        # Deleting the token clears its key, which is also its primary key
+        self.key = self.token.key
+        self.auth = CachedTokenAuthentication()
+
+    def api(self, key=None):
+        key = key or self.key
+        return self.client.get(reverse('api_letters'), {'fields': 'id,title'}, HTTP_AUTHORIZATION=f'Token {key}')
+
+    def assertCached(self, cached=True):
+        check = self.assertIsNotNone if cached else self.assertIsNone
+        check(local_tokens.get(self.key))
+        check(cache.get(_cache_key(self.key)))
+
+    def test_token_authenticates_the_letter_api(self):
+        letters = make_letters(self.user, 2)
+        make_letters(User.objects.create_user(email='other@example.com'), 1)
+        response = self.api()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([row['id'] for row in response.json()['letters']], [letter.id for letter in letters])
+
+    def test_letter_api_rejects_missing_and_unknown_tokens(self):
+        self.assertEqual(self.client.get(reverse('api_letters')).status_code, 401)
+        self.assertEqual(self.api('0' * 40).status_code, 401)
+
+    def test_repeated_lookups_skip_the_database(self):
+        user, token = self.auth.authenticate_credentials(self.key)
+        self.assertEqual(user.pk, self.user.pk)
+        self.assertCached()
+        with self.assertNumQueries(0):
+            user, token = self.auth.authenticate_credentials(self.key)
+        self.assertEqual((user.pk, user.email, token.key), (self.user.pk, self.user.email, self.key))
+
+    def test_cached_entry_holds_no_password_hash(self):
+        self.auth.authenticate_credentials(self.key)
+        names, values = cache.get(_cache_key(self.key))
+        self.assertNotIn('password', names)
+        self.assertNotIn(self.user.password, values)
+
+    def test_revoking_the_token_invalidates_it(self):
+        self.assertEqual(self.api().status_code, 200)
+        self.assertCached()
+        self.token.delete()
+        self.assertCached(False)
+        self.assertEqual(self.api().status_code, 401)
+
+    def test_deactivating_the_user_invalidates_the_token(self):
+        self.assertEqual(self.api().status_code, 200)
+        self.user.is_active = False
+        self.user.save()
+        self.assertCached(False)
+        self.assertEqual(self.api().status_code, 401)
+
+    def test_changing_the_password_invalidates_the_token(self):
+        self.auth.authenticate_credentials(self.key)
+        self.user.set_password('second-password')
+        self.user.save()
+        self.assertCached(False)
+        # The next lookup goes back to the token table
+        with CaptureQueriesContext(connection) as queries:
+            self.auth.authenticate_credentials(self.key)
+        self.assertTrue(any('authtoken_token' in query['sql'] for query in queries))
+
+    def test_last_login_updates_keep_the_entry(self):
+        self.auth.authenticate_credentials(self.key)
+        self.user.save(update_fields=['last_login'])
+        self.assertCached()
+
+    def test_deleting_the_user_invalidates_the_token(self):
+        self.auth.authenticate_credentials(self.key)
+        admin = User.objects.create_superuser(email='admin@example.com', password='admin-password')
+        self.client.force_login(admin)
+        response = self.client.post(
+            reverse('api_delete_user'), json.dumps({'email': self.user.email}), content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.client.logout()
+        self.assertCached(False)
+        with self.assertRaises(exceptions.AuthenticationFailed):
+            self.auth.authenticate_credentials(self.key)
+        self.assertFalse(Letter.objects.filter(author_id=self.user.pk).exists())
+
+
+class TokenBucketTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.bucket = TokenBucket('test', capacity=3, per=60)
+
+    def test_allows_a_burst_then_refuses(self):
+        results = [self.bucket.consume('a') for _ in range(4)]
+        self.assertEqual([result.allowed for result in results], [True, True, True, False])
+        self.assertEqual([result.remaining for result in results[:3]], [2, 1, 0])
+        self.assertEqual(results[3].retry_after, 20)
+        # Every key has a bucket of its own
+        self.assertTrue(self.bucket.consume('b').allowed)
+
+    def test_refills_over_time(self):
+        for _ in range(3):
+            self.bucket.consume('a')
+        later = time.time() + 20
+        with mock.patch('futureme.ratelimit.time.time', return_value=later):
+            self.assertTrue(self.bucket.consume('a').allowed)
+            self.assertFalse(self.bucket.consume('a').allowed)
+
+    def test_busy_lock_does_not_refuse(self):
+        bucket = TokenBucket('test', capacity=3, per=60, lock_wait=0.05)
+        with cache_lock(cache, bucket._key('a')) as locked:
+            self.assertTrue(locked)
+            with self.assertLogs('futureme.ratelimit', 'WARNING'):
+                result = bucket.consume('a')
+        self.assertTrue(result.allowed)
+        self.assertEqual(result.remaining, 2)
+
+    def test_fails_open_without_the_cache(self):
+        with mock.patch.object(ratelimit, 'caches', {}), self.assertLogs('futureme.ratelimit', 'ERROR'):
+            self.assertTrue(self.bucket.consume('a').allowed)
+
+    def test_registration_is_limited_per_address(self):
+        body = json.dumps({'email': 'limit@example.com', 'password1': 'pw-12345!', 'password2': 'pw-12345!'})
+        statuses = [
+            self.client.post(reverse('api_register'), body, content_type='application/json').status_code
+            for _ in range(views.REGISTER_EMAIL_LIMIT.capacity + 1)
+        ]
+        self.assertEqual(statuses[:-1], [200] * views.REGISTER_EMAIL_LIMIT.capacity)
+        self.assertEqual(statuses[-1], 429)
+
+
+class ClientIPTests(TestCase):
+    def request(self, forwarded):
+        return RequestFactory().get('/', REMOTE_ADDR='10.0.0.1', HTTP_X_FORWARDED_FOR=forwarded)
+
+    def test_ignores_forwarded_for_by_default(self):
+        self.assertEqual(client_ip(self.request('1.2.3.4')), '10.0.0.1')
+
+    @mock.patch('futureme.ratelimit.TRUSTED_PROXY_COUNT', 1)
+    def test_takes_the_address_the_proxy_saw(self):
+        self.assertEqual(client_ip(self.request('6.6.6.6, 1.2.3.4')), '1.2.3.4')
+        self.assertEqual(client_ip(self.request('')), '10.0.0.1')
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class LoginThrottleTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(email='login@example.com', password='right-password')
+
+    def login(self, email='login@example.com', password='wrong-password', ip='10.0.0.1'):
+        return self.client.post(
+            reverse('api_login'), json.dumps({'email': email, 'password': password}),
+            content_type='application/json', REMOTE_ADDR=ip,
+        )
+
+    def test_account_is_refused_before_hashing(self):
+        for _ in range(throttle.email_failures.limit):
+            self.assertEqual(self.login().status_code, 401)
+        with mock.patch.object(User, 'check_password') as check_password:
+            response = self.login(password='right-password', ip='10.0.0.2')
+        self.assertEqual(response.status_code, 429)
+        self.assertGreater(int(response['Retry-After']), 0)
+        check_password.assert_not_called()
+
+    def test_success_clears_the_account_but_not_the_ip(self):
+        with mock.patch.object(throttle.ip_failures, 'limit', throttle.email_failures.limit):
+            for _ in range(throttle.email_failures.limit - 1):
+                self.login()
+            self.assertEqual(self.login(password='right-password').status_code, 200)
+            self.assertEqual(throttle.email_failures.count('login@example.com'), 0)
+            self.assertEqual(self.login().status_code, 401)
+            self.assertEqual(self.login(email='other@example.com').status_code, 429)
+
+    def test_unknown_emails_hash_a_dummy_and_count_against_the_ip(self):
+        with mock.patch.object(throttle.ip_failures, 'limit', 3), \
+                mock.patch('accounts.throttle.check_password') as check_password:
+            for n in range(3):
+                self.assertEqual(self.login(email=f'nobody{n}@example.com').status_code, 401)
+            self.assertEqual(check_password.call_count, 3)
+            self.assertEqual(self.login(password='right-password').status_code, 429)
+            # Another client is not affected
+            self.assertEqual(self.login(password='right-password', ip='10.0.0.2').status_code, 200)
@@ -0,0 +1,63 @@
+"""
+Brute-force protection for password logins.
+
+Failed logins are counted per client IP and per email address over a
+sliding window. Once either count reaches its limit, further attempts are
+refused before the password is hashed, so an attack costs a cache read
+per request instead of a full PBKDF2 computation. Unknown emails are
+checked against a dummy hash so they take as long as real accounts and
+do not reveal which addresses are registered.
+"""
+from django.conf import settings
+from django.contrib.auth.hashers import check_password, make_password
+from django.utils.crypto import get_random_string
+
+from futureme.ratelimit import RateLimitResult, SlidingWindow, client_ip
+
+WINDOW = getattr(settings, 'LOGIN_THROTTLE_WINDOW_SECONDS', 900)
+ip_failures = SlidingWindow('login-ip', getattr(settings, 'LOGIN_FAILURES_PER_IP', 20), WINDOW)
+email_failures = SlidingWindow('login-email', getattr(settings, 'LOGIN_FAILURES_PER_EMAIL', 5), WINDOW)
+
+_dummy_hash = None
+
+
+def _email_key(email):
+    return (email or '').strip().lower()
+
+
+def check_login_allowed(request, email):
+    """
+    Whether a login attempt may go ahead; no hashing happens here.
+
+    ``request`` may be None (e.g. token issuing without a request), in
+    which case only the per-email limit applies.
+    """
+    if request is not None:
+        result = ip_failures.check(client_ip(request))
+        if not result.allowed:
+            return result
+    if email:
+        return email_failures.check(_email_key(email))
+    return RateLimitResult(allowed=True, remaining=email_failures.limit)
+
+
+def record_login_failure(request, email):
+    if request is not None:
+        ip_failures.hit(client_ip(request))
+    if email:
+        email_failures.hit(_email_key(email))
+
+
+def record_login_success(request, email):
+    # A correct password clears the account's failures, not the IP's:
+    # one valid account must not unlock an IP that is guessing others
+    if email:
+        email_failures.reset(_email_key(email))
+
+
+def run_dummy_hash(password):
+    """Spend as long as a real password check, for emails with no account"""
+    global _dummy_hash
+    if _dummy_hash is None:
+        _dummy_hash = make_password(get_random_string(32))
+    check_password(password, _dummy_hash)
@@ -4,7 +4,6 @@ from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from .forms import UserRegistrationForm
 from django.contrib.auth.forms import AuthenticationForm
-from django.core.mail import send_mail
 from django.conf import settings
 import random
 import string
@@ -16,17 +15,37 @@ from django.views.decorators.http import require_http_methods
 import json
 from django.utils import timezone
 from .models import PendingRegistration
+from .throttle import check_login_allowed
+from letters.outbox import enqueue_email
 from django.contrib.auth.hashers import make_password
 from rest_framework.authtoken.views import ObtainAuthToken
 from rest_framework.authtoken.models import Token
 from rest_framework.response import Response
-from django.core.cache import cache
-from datetime import timedelta
+from futureme.ratelimit import TokenBucket, client_ip
 from django.contrib.admin.views.decorators import staff_member_required
 
 logger = logging.getLogger(__name__)
 User = get_user_model()
 
+# Rate limits, shared by all workers through the default cache
+OTP_RESEND_LIMIT = TokenBucket('otp-resend', capacity=1, per=60)  # one new code a minute per email
+REGISTER_LIMIT = TokenBucket('register', capacity=10, per=3600)  # sign-ups per client IP
+REGISTER_EMAIL_LIMIT = TokenBucket('register-email', capacity=3, per=3600)  # verification mails per address
+
+def rate_limited(result, message='Too many requests. Please try again later.', key='detail', **extra):
+    """429 response for a rejected RateLimitResult"""
+    response = JsonResponse({**extra, key: message, 'retry_after': result.retry_after}, status=429)
+    response['Retry-After'] = str(result.retry_after)
+    return response
+
+def check_registration_limits(request, email):
+    """Apply the per-IP and per-address sign-up limits; returns the first rejection"""
+    for limit, key in ((REGISTER_LIMIT, client_ip(request)), (REGISTER_EMAIL_LIMIT, email)):
+        result = limit.consume(key)
+        if not result.allowed:
+            return result
+    return None
+
 class CustomAuthToken(ObtainAuthToken):
     def post(self, request, *args, **kwargs):
         serializer = self.serializer_class(data=request.data,
@@ -73,6 +92,10 @@ def register_api(request):
         if password1 != password2:
             return JsonResponse({'detail': 'Passwords do not match'}, status=400)
         
+        limited = check_registration_limits(request, email)
+        if limited:
+            return rate_limited(limited)
+        
         # Check if email exists (quick query)
         try:
             if User.objects.filter(email=email).exists():
@@ -88,12 +111,7 @@ def register_api(request):
         request.session['register_email'] = email
         request.session['register_password'] = password1
         request.session['register_otp'] = otp
-        
-        # Try to save session
-        try:
-            request.session.save()
-        except Exception as e:
-            logger.error(f"Session save error: {str(e)}")
+        # SessionMiddleware saves the session once the response is ready
         
         # Create pending registration (with timeout)
         try:
@@ -106,9 +124,9 @@ def register_api(request):
             logger.error(f"Pending registration error: {str(e)}")
             # Don't fail registration if this fails
         
-        # Send email in background (non-blocking, with short timeout)
-        # Skip email sending entirely to avoid timeouts
-        logger.info(f"Registration created for {email}, OTP: {otp}")
+        # Queue the OTP email; the outbox dispatcher sends it in the background
+        send_verification_email(email, otp)
+        logger.info("Registration created for %s", email)
         
         # Return immediately
         response_data = {
@@ -197,31 +215,29 @@ def login_api(request):
         if not email or not password:
             return JsonResponse({'detail': 'Email and password are required'}, status=400)
         
-        try:
-            # Find user by email
-            user = User.objects.get(email=email)
-            
-            # Check password
-            if not user.check_password(password):
-                return JsonResponse({'detail': 'Invalid email or password'}, status=401)
-            
-            if not user.is_active:
-                return JsonResponse({'detail': 'Account not activated. Please verify OTP.'}, status=403)
-            
-            # Log in user
-            login(request, user)
-            return JsonResponse({
-                'success': True,
-                'message': 'Login successful',
-                'user': {
-                    'email': user.email,
-                    'is_superuser': user.is_superuser
-                }
-            })
-            
-        except User.DoesNotExist:
+        # Cheap check first: throttled attempts never reach the password hash
+        limited = check_login_allowed(request, email)
+        if not limited.allowed:
+            return rate_limited(limited, 'Too many login attempts. Please try again later.')
+        
+        user = authenticate(request, email=email, password=password)
+        if user is None:
             return JsonResponse({'detail': 'Invalid email or password'}, status=401)
         
+        if not user.is_active:
+            return JsonResponse({'detail': 'Account not activated. Please verify OTP.'}, status=403)
+        
+        # Log in user
+        login(request, user)
+        return JsonResponse({
+            'success': True,
+            'message': 'Login successful',
+            'user': {
+                'email': user.email,
+                'is_superuser': user.is_superuser
+            }
+        })
+        
     except json.JSONDecodeError:
         return JsonResponse({'detail': 'Invalid JSON data'}, status=400)
     except Exception as e:
@@ -236,18 +252,14 @@ def resend_otp_view(request):
     
     try:
         # Check rate limit
-        cache_key = f'otp_resend_{email}'
-        last_resend = cache.get(cache_key)
-        
-        if last_resend:
-            time_since_last_resend = timezone.now() - last_resend
-            if time_since_last_resend < timedelta(minutes=1):
-                remaining_seconds = 60 - time_since_last_resend.seconds
-                return JsonResponse({
-                    'success': False,
-                    'error': f'Please wait {remaining_seconds} seconds before requesting a new OTP.',
-                    'retry_after': remaining_seconds
-                }, status=429)
+        limited = OTP_RESEND_LIMIT.consume(email)
+        if not limited.allowed:
+            return rate_limited(
+                limited,
+                f'Please wait {limited.retry_after} seconds before requesting a new OTP.',
+                key='error',
+                success=False,
+            )
         
         # Get existing pending registration
         try:
@@ -264,10 +276,7 @@ def resend_otp_view(request):
         pending_reg.created_at = timezone.now()
         pending_reg.save()
         
-        # Update rate limit
-        cache.set(cache_key, timezone.now(), timeout=60)
-        
-        # Send new OTP email
+        # Queue new OTP email
         if send_verification_email(email, new_otp):
             return JsonResponse({
                 'success': True,
@@ -287,22 +296,15 @@ def resend_otp_view(request):
         }, status=500)
 
 def send_verification_email(email, verification_code):
+    """Queue the verification email; returns False if it could not be queued"""
     subject = 'Verify your FutureMe account'
     message = f'Your verification code for FutureMe account is: {verification_code}'
-    from_email = settings.DEFAULT_FROM_EMAIL
-    recipient_list = [email]
     
     try:
-        send_mail(
-            subject,
-            message,
-            from_email,
-            recipient_list,
-            fail_silently=False,
-        )
+        enqueue_email(subject, message, [email], from_email=settings.DEFAULT_FROM_EMAIL)
         return True
     except Exception as e:
-        logger.error(f"Failed to send email: {str(e)}")
+        logger.error("Failed to queue verification email: %s", e)
         return False
 
 def register_view(request):
@@ -323,6 +325,10 @@ def register_view(request):
             messages.error(request, 'Email already registered.')
             return redirect('register')
         
+        if check_registration_limits(request, email):
+            messages.error(request, 'Too many registration attempts. Please try again later.')
+            return redirect('register')
+        
         # Generate OTP
         otp = str(random.randint(100000, 999999))
         
@@ -337,19 +343,11 @@ def register_view(request):
             defaults={'otp_code': otp, 'created_at': timezone.now()}
         )
         
-        # Send OTP email
-        try:
-            send_mail(
-                subject='Verify your FutureMe account',
-                message=f'Your OTP for FutureMe account verification is: {otp}',
-                from_email=settings.DEFAULT_FROM_EMAIL,
-                recipient_list=[email],
-                fail_silently=False,
-            )
+        # Queue OTP email
+        if send_verification_email(email, otp):
             messages.success(request, 'Registration successful! Please check your email for OTP verification.')
             return redirect('verify_otp_view')
-        except Exception as e:
-            logger.error(f"Failed to send email: {str(e)}")
+        else:
             # Clean up the pending registration if email fails
             PendingRegistration.objects.filter(email=email).delete()
             # Clear session data
@@ -411,27 +409,23 @@ def login_view(request):
             messages.error(request, 'Please provide both email and password')
             return render(request, 'login.html')
         
-        try:
-            # Find user by email
-            user = User.objects.get(email=email)
-            
-            # Check password
-            if user.check_password(password):
-                if not user.is_active:
-                    messages.error(request, 'Your account is not activated. Please check your email for activation link.')
-                    return render(request, 'login.html')
-                
-                # Log in user
-                login(request, user)
-                messages.success(request, 'Successfully logged in!')
-                return redirect('dashboard')
-            else:
-                messages.error(request, 'Invalid email or password')
-                return render(request, 'login.html')
-                
-        except User.DoesNotExist:
+        if not check_login_allowed(request, email).allowed:
+            messages.error(request, 'Too many login attempts. Please try again later.')
+            return render(request, 'login.html', status=429)
+        
+        user = authenticate(request, email=email, password=password)
+        if user is None:
             messages.error(request, 'Invalid email or password')
             return render(request, 'login.html')
+        
+        if not user.is_active:
+            messages.error(request, 'Your account is not activated. Please check your email for activation link.')
+            return render(request, 'login.html')
+        
+        # Log in user
+        login(request, user)
+        messages.success(request, 'Successfully logged in!')
+        return redirect('dashboard')
             
     return render(request, 'login.html')
 
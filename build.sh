@@ -19,5 +19,8 @@ python manage.py migrate accounts
 python manage.py migrate letters
 python manage.py migrate
 
+# Table for the database cache backend (no-op when it exists or is unused)
+python manage.py createcachetable
+
 # Collect static files with force flag
 python manage.py collectstatic --no-input --clear 
\ No newline at end of file
@@ -0,0 +1,44 @@
+"""
+Cache backend selection.
+
+Settings pick a backend by short name so every cache alias is configured
+the same way from environment variables:
+
+* ``db``: the ``django_cache`` table (``manage.py createcachetable``),
+  shared by every process that uses the database
+* ``file``: a directory, shared by the processes on one machine
+* ``redis``: any Redis-protocol server (needs the ``redis`` package)
+* ``locmem``: memory of the current process only
+"""
+
+CACHE_BACKENDS = {
+    'db': ('django.core.cache.backends.db.DatabaseCache', 'django_cache{suffix}'),
+    'file': ('django.core.cache.backends.filebased.FileBasedCache', '/tmp/futureme-cache{suffix}'),
+    'redis': ('django.core.cache.backends.redis.RedisCache', 'redis://localhost:6379/1'),
+    'locmem': ('django.core.cache.backends.locmem.LocMemCache', 'futureme{suffix}'),
+}
+
+
+def cache_config(backend, location=None, timeout=300, name=None, **options):
+    """
+    Build a CACHES entry for ``backend`` (one of ``CACHE_BACKENDS``).
+
+    ``name`` gives a secondary cache its own default table or directory and
+    its own key prefix, so it never collides with the default cache.
+    """
+    try:
+        backend_path, default_location = CACHE_BACKENDS[backend]
+    except KeyError:
+        raise ValueError(
+            f"Unknown cache backend {backend!r}, expected one of {', '.join(CACHE_BACKENDS)}"
+        )
+    config = {
+        'BACKEND': backend_path,
+        'LOCATION': location or default_location.format(suffix=f'_{name}' if name else ''),
+        'TIMEOUT': timeout,
+    }
+    if name:
+        config['KEY_PREFIX'] = name
+    if options:
+        config['OPTIONS'] = options
+    return config
@@ -0,0 +1,175 @@
+"""
+Logging helpers.
+
+``QueueingHandler`` hands records to a background thread so request and
+delivery code never waits on console or disk I/O. ``JsonFormatter`` writes
+one JSON object per line, and ``log_event`` logs a named event with
+structured fields that both the JSON and the plain text formats render.
+Select the format with the ``LOG_FORMAT`` setting ('text' or 'json').
+"""
+import atexit
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+from logging.handlers import QueueHandler, QueueListener
+
+# Attributes every LogRecord has; anything else was passed in ``extra``
+_RECORD_ATTRS = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {
+    'message', 'asctime', 'taskName',
+}
+
+
+class _Fields:
+    """Renders event fields as ``key=value`` only if the record is formatted"""
+    __slots__ = ('fields',)
+
+    def __init__(self, fields):
+        self.fields = fields
+
+    def __str__(self):
+        return ' '.join(f'{key}={value}' for key, value in self.fields.items())
+
+
+def log_event(logger, event, level=logging.INFO, **fields):
+    """
+    Log ``event`` with structured ``fields``, e.g.
+    ``log_event(logger, 'letter.sent', letter_id=42, attempts=1)``.
+
+    Nothing is formatted unless ``logger`` is enabled for ``level``.
+    """
+    if logger.isEnabledFor(level):
+        # stacklevel=2: the record's module and line are the caller's
+        logger.log(
+            level, '%s %s', event, _Fields(fields),
+            extra={'event': event, 'fields': fields},
+            stacklevel=2,
+        )
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats each record as a single line of JSON"""
+
+    def format(self, record):
+        payload = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'process': record.process,
+            'thread': record.threadName,
+        }
+        event = getattr(record, 'event', None)
+        if event:
+            payload['event'] = event
+            payload.update(getattr(record, 'fields', None) or {})
+        else:
+            payload['message'] = record.getMessage()
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and key not in ('event', 'fields'):
+                payload[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            payload['exception'] = record.exc_text
+        return json.dumps(payload, default=str)
+
+    def formatTime(self, record, datefmt=None):
+        return super().formatTime(record, datefmt or '%Y-%m-%dT%H:%M:%S') + f'.{int(record.msecs):03d}'
+
+
+class _Listener(QueueListener):
+    """``QueueListener`` that writes each record while holding ``lock``"""
+
+    def __init__(self, queue, *handlers, lock, **kwargs):
+        super().__init__(queue, *handlers, **kwargs)
+        self.lock = lock
+
+    def handle(self, record):
+        with self.lock:
+            super().handle(record)
+
+
+class QueueingHandler(QueueHandler):
+    """
+    Non-blocking handler: records are queued and written by a
+    ``QueueListener`` thread to the console and, optionally, a file.
+
+    The listener starts on first use and is restarted after a fork, so it
+    works under gunicorn's pre-fork workers. A fork waits for the record
+    being written, so the child never inherits a stream lock held by the
+    parent's listener thread.
+    """
+
+    def __init__(self, filename=None, stream=True, maxsize=10000):
+        super().__init__(queue.Queue(maxsize))
+        self.targets = []
+        if stream:
+            self.targets.append(logging.StreamHandler(sys.stderr))
+        if filename:
+            self.targets.append(logging.FileHandler(filename, delay=True))
+        self._listener = None
+        self._pid = None
+        self._writing = threading.Lock()
+        atexit.register(self.stop)
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(
+                before=self._writing.acquire,
+                after_in_parent=self._writing.release,
+                after_in_child=self._after_fork_in_child,
+            )
+
+    def setFormatter(self, fmt):
+        # The formatter is applied by the listener thread, not the caller
+        for target in self.targets:
+            target.setFormatter(fmt)
+
+    def prepare(self, record):
+        # The message is merged with its arguments here, on the caller's
+        # thread, so the record is pickle-safe and reflects the arguments
+        # as they were when logged; only the formatter (timestamp, layout,
+        # JSON) and the writing run on the listener thread
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        if self._pid != os.getpid():
+            self._start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # Drop rather than block the caller when the writer falls behind
+            pass
+
+    def _start(self):
+        with self.lock:
+            if self._pid == os.getpid():
+                return
+            # After a fork the parent's listener thread does not exist here
+            self.queue = queue.Queue(self.queue.maxsize)
+            self._listener = _Listener(
+                self.queue, *self.targets, lock=self._writing, respect_handler_level=True
+            )
+            self._listener.start()
+            self._pid = os.getpid()
+
+    def _after_fork_in_child(self):
+        self._writing = threading.Lock()
+
+    def stop(self):
+        if self._listener is not None and self._pid == os.getpid():
+            self._listener.stop()
+            self._listener = None
+            self._pid = None
+
+    def close(self):
+        self.stop()
+        for target in self.targets:
+            target.close()
+        super().close()
@@ -0,0 +1,216 @@
+"""
+Pooled SMTP email backend.
+
+Every ``send_mail`` call with Django's stock SMTP backend opens a new TCP
+connection and repeats the STARTTLS and AUTH handshake. ``PooledEmailBackend``
+keeps authenticated connections in a process-wide pool so delivery workers
+and request handlers reuse warm sessions instead.
+
+Settings:
+    EMAIL_POOL_SIZE                   max live connections per SMTP server
+    EMAIL_POOL_IDLE_TIMEOUT           seconds before an idle connection is closed
+    EMAIL_POOL_HEALTH_CHECK_INTERVAL  idle seconds after which NOOP is sent before reuse
+    EMAIL_POOL_WAIT_TIMEOUT           seconds to wait for a free connection
+"""
+import atexit
+from collections import deque
+import logging
+import os
+import smtplib
+import threading
+import time
+
+from django.conf import settings
+from django.core.mail.backends.smtp import EmailBackend
+from django.core.mail.message import sanitize_address
+
+logger = logging.getLogger(__name__)
+
+
+class PoolTimeout(smtplib.SMTPException):
+    """No pooled SMTP connection became available in time"""
+
+
+class SMTPConnectionPool:
+    """A bounded pool of open, authenticated SMTP connections"""
+
+    def __init__(self, size=4, idle_timeout=60, health_check_interval=10, wait_timeout=30):
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.wait_timeout = wait_timeout
+        self._idle = deque()  # (connection, released_at)
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def acquire(self, connect):
+        """
+        Return a healthy connection, creating one with ``connect()`` if no
+        idle connection can be reused.
+        """
+        if not self._slots.acquire(timeout=self.wait_timeout):
+            raise PoolTimeout(f"No SMTP connection available after {self.wait_timeout}s")
+        try:
+            while True:
+                with self._lock:
+                    if not self._idle:
+                        break
+                    conn, released_at = self._idle.pop()
+                if self._is_reusable(conn, time.monotonic() - released_at):
+                    return conn
+                self._quit(conn)
+            return connect()
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, conn):
+        """Return ``conn`` to the pool, or close it if it is no longer usable"""
+        try:
+            if getattr(conn, 'sock', None) is None:
+                self._quit(conn)
+                return
+            with self._lock:
+                self._idle.append((conn, time.monotonic()))
+        finally:
+            self._slots.release()
+
+    def discard(self, conn):
+        """Close a broken connection and free its slot"""
+        try:
+            self._quit(conn)
+        finally:
+            self._slots.release()
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, deque()
+        for conn, _ in idle:
+            self._quit(conn)
+
+    def _is_reusable(self, conn, idle_for):
+        if getattr(conn, 'sock', None) is None or idle_for > self.idle_timeout:
+            return False
+        if idle_for < self.health_check_interval:
+            return True
+        try:
+            code, _ = conn.noop()
+            return code == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    @staticmethod
+    def _quit(conn):
+        try:
+            conn.quit()
+        except (smtplib.SMTPException, OSError):
+            conn.close()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+_pools_pid = os.getpid()
+
+
+def get_pool(key):
+    """Return the process-wide pool for ``key``, creating it on first use"""
+    global _pools, _pools_pid
+    with _pools_lock:
+        if _pools_pid != os.getpid():
+            # Forked child (gunicorn worker, process pool): never share the
+            # parent's sockets, start with an empty set of pools.
+            _pools, _pools_pid = {}, os.getpid()
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = SMTPConnectionPool(
+                size=getattr(settings, 'EMAIL_POOL_SIZE', 4),
+                idle_timeout=getattr(settings, 'EMAIL_POOL_IDLE_TIMEOUT', 60),
+                health_check_interval=getattr(settings, 'EMAIL_POOL_HEALTH_CHECK_INTERVAL', 10),
+                wait_timeout=getattr(settings, 'EMAIL_POOL_WAIT_TIMEOUT', 30),
+            )
+        return pool
+
+
+@atexit.register
+def close_pools():
+    with _pools_lock:
+        pools = list(_pools.values()) if _pools_pid == os.getpid() else []
+    for pool in pools:
+        pool.close_all()
+
+
+class PooledEmailBackend(EmailBackend):
+    """
+    SMTP backend that borrows connections from a shared pool.
+
+    ``open()`` checks a connection out of the pool and ``close()`` hands it
+    back instead of sending QUIT, so the handshake cost is paid once per
+    pooled connection rather than once per message. A connection that drops
+    mid-send is discarded and the message is retried once on a fresh one.
+    """
+
+    @property
+    def pool(self):
+        return get_pool((self.host, self.port, self.username, self.use_tls, self.use_ssl))
+
+    def open(self):
+        if self.connection:
+            return False
+        try:
+            self.connection = self.pool.acquire(self._connect)
+            return True
+        except OSError:
+            if not self.fail_silently:
+                raise
+
+    def close(self):
+        if self.connection is None:
+            return
+        conn, self.connection = self.connection, None
+        self.pool.release(conn)
+
+    def _connect(self):
+        """Open a brand new authenticated connection"""
+        super().open()
+        conn, self.connection = self.connection, None
+        if conn is None:
+            raise smtplib.SMTPConnectError(-1, f"Could not connect to {self.host}:{self.port}")
+        return conn
+
+    def _discard(self):
+        conn, self.connection = self.connection, None
+        if conn is not None:
+            self.pool.discard(conn)
+
+    def _send(self, email_message):
+        if not email_message.recipients():
+            return False
+        encoding = email_message.encoding or settings.DEFAULT_CHARSET
+        from_email = sanitize_address(email_message.from_email, encoding)
+        recipients = [
+            sanitize_address(addr, encoding) for addr in email_message.recipients()
+        ]
+        message = email_message.message().as_bytes(linesep="\r\n")
+
+        for attempt in range(2):
+            try:
+                self.connection.sendmail(from_email, recipients, message)
+                return True
+            except smtplib.SMTPServerDisconnected as e:
+                error = e
+            except smtplib.SMTPException:
+                if not self.fail_silently:
+                    raise
+                return False
+            except OSError as e:
+                error = e
+
+            # The pooled session went away underneath us: drop it and retry
+            # once on a fresh connection.
+            logger.warning("SMTP connection lost, reconnecting: %s", error)
+            self._discard()
+            if attempt == 0 and self.open():
+                continue
+            if not self.fail_silently:
+                raise error
+            return False
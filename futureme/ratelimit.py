@@ -0,0 +1,217 @@
+"""
+Rate limiting on top of the default cache.
+
+A ``TokenBucket`` holds up to ``capacity`` tokens and refills at a fixed
+rate; an action is allowed when a token can be taken.
+``SlidingWindow`` counts events, such as failed logins, over a trailing
+window. State lives in the shared cache, so limits hold across every
+gunicorn worker. Updates are serialised with a short lock taken with
+``cache.add``, which is atomic on the database, redis and local-memory
+backends (the file backend only approximates it). If the lock stays
+busy the update goes ahead without it, so contention can at worst let a
+few extra actions through; it never refuses one by itself.
+"""
+from contextlib import contextmanager
+from dataclasses import dataclass
+import logging
+import math
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+logger = logging.getLogger(__name__)
+
+TRUSTED_PROXY_COUNT = getattr(settings, 'TRUSTED_PROXY_COUNT', 0)
+
+
+@dataclass
+class RateLimitResult:
+    allowed: bool
+    remaining: int
+    # Seconds until the next token is available; 0 when allowed
+    retry_after: int = 0
+
+
+class TokenBucket:
+    """
+    A named token bucket, e.g.
+    ``TokenBucket('login', capacity=10, per=60)`` allows bursts of ten and
+    ten more every minute, tracked separately for each key.
+    """
+
+    def __init__(self, name, capacity, per, cache_alias='default', lock_timeout=2, lock_wait=0.5):
+        self.name = name
+        self.capacity = capacity
+        self.rate = capacity / per
+        self.cache_alias = cache_alias
+        self.lock_timeout = lock_timeout
+        self.lock_wait = lock_wait
+        # An untouched bucket refills completely after this long
+        self.ttl = math.ceil(per) + 1
+
+    def _key(self, key):
+        return f'ratelimit:{self.name}:{key}'
+
+    def consume(self, key, tokens=1):
+        """
+        Take ``tokens`` from the bucket for ``key`` if it has them.
+
+        If the cache is unavailable the action is allowed: an outage of the
+        cache should not lock every user out.
+        """
+        try:
+            return self._consume(key, tokens)
+        except Exception as e:
+            logger.error("Rate limit %s unavailable: %s", self.name, e)
+            return RateLimitResult(allowed=True, remaining=0)
+
+    def _consume(self, key, tokens):
+        cache = caches[self.cache_alias]
+        state_key = self._key(key)
+        with cache_lock(cache, state_key, self.lock_timeout, self.lock_wait) as locked:
+            if not locked:
+                # Proceed unlocked: a concurrent update may be lost, but
+                # legitimate users sharing a key are not turned away
+                logger.warning("Rate limit %s: lock busy for %s", self.name, key)
+
+            now = time.time()
+            available, updated_at = cache.get(state_key) or (self.capacity, now)
+            available = min(self.capacity, available + (now - updated_at) * self.rate)
+            if available >= tokens:
+                available -= tokens
+                result = RateLimitResult(allowed=True, remaining=int(available))
+            else:
+                result = RateLimitResult(
+                    allowed=False,
+                    remaining=int(available),
+                    retry_after=math.ceil((tokens - available) / self.rate),
+                )
+            cache.set(state_key, (available, now), self.ttl)
+            return result
+
+    def reset(self, key):
+        caches[self.cache_alias].delete(self._key(key))
+
+
+class SlidingWindow:
+    """
+    Counts events per key over the last ``window`` seconds.
+
+    Uses the sliding-window-counter approximation: the count is the
+    current fixed window plus the previous one weighted by how much of it
+    still overlaps the sliding window. Reading a count is a single cache
+    round trip and never takes a lock, so checking a limit stays cheap
+    even under attack. Like ``TokenBucket``, it fails open: while the
+    cache is unavailable events are allowed and not counted.
+    """
+
+    def __init__(self, name, limit, window, cache_alias='default'):
+        self.name = name
+        self.limit = limit
+        self.window = window
+        self.cache_alias = cache_alias
+
+    def _keys(self, key, now):
+        current = int(now // self.window)
+        return (
+            f'ratelimit:{self.name}:{key}:{current}',
+            f'ratelimit:{self.name}:{key}:{current - 1}',
+        )
+
+    def count(self, key):
+        now = time.time()
+        current_key, previous_key = self._keys(key, now)
+        counts = caches[self.cache_alias].get_many([current_key, previous_key])
+        overlap = 1 - (now % self.window) / self.window
+        return counts.get(current_key, 0) + counts.get(previous_key, 0) * overlap
+
+    def check(self, key):
+        """Whether another event for ``key`` is still within the limit"""
+        try:
+            return self._check(key)
+        except Exception as e:
+            logger.error("Rate limit %s unavailable: %s", self.name, e)
+            return RateLimitResult(allowed=True, remaining=0)
+
+    def _check(self, key):
+        now = time.time()
+        count = self.count(key)
+        if count < self.limit:
+            return RateLimitResult(allowed=True, remaining=int(self.limit - count))
+        # At the latest, the count drops once the current window is over
+        return RateLimitResult(
+            allowed=False,
+            remaining=0,
+            retry_after=math.ceil(self.window - now % self.window),
+        )
+
+    def hit(self, key):
+        """Record one event for ``key``"""
+        try:
+            self._hit(key)
+        except Exception as e:
+            logger.error("Rate limit %s unavailable: %s", self.name, e)
+
+    def _hit(self, key):
+        cache = caches[self.cache_alias]
+        current_key, _ = self._keys(key, time.time())
+        # incr is only atomic on some backends; the lock makes it so on all
+        with cache_lock(cache, current_key) as locked:
+            if not locked:
+                logger.warning("Rate limit %s: lock busy for %s", self.name, key)
+            if cache.add(current_key, 1, self.window * 2):
+                return
+            try:
+                cache.incr(current_key)
+            except ValueError:
+                # Expired between add() and incr()
+                cache.set(current_key, 1, self.window * 2)
+
+    def reset(self, key):
+        try:
+            caches[self.cache_alias].delete_many(self._keys(key, time.time()))
+        except Exception as e:
+            logger.error("Rate limit %s unavailable: %s", self.name, e)
+
+
+@contextmanager
+def cache_lock(cache, key, timeout=2, wait=0.5):
+    """
+    Hold a short lock named after ``key`` using ``cache.add``.
+
+    Yields False if the lock could not be taken within ``wait`` seconds;
+    the caller decides whether to go ahead anyway.
+    """
+    lock_key = f'{key}:lock'
+    deadline = time.monotonic() + wait
+    locked = cache.add(lock_key, 1, timeout)
+    while not locked and time.monotonic() < deadline:
+        time.sleep(0.01)
+        locked = cache.add(lock_key, 1, timeout)
+    try:
+        yield locked
+    finally:
+        if locked:
+            cache.delete(lock_key)
+
+
+def client_ip(request):
+    """
+    The client's IP address.
+
+    Behind ``TRUSTED_PROXY_COUNT`` reverse proxies the address is taken
+    from X-Forwarded-For, counting from the right so clients cannot spoof
+    it by sending their own header. The count defaults to 0 (use
+    REMOTE_ADDR): trusting the header without a proxy that sets it would
+    let every client pick its own address.
+    """
+    if TRUSTED_PROXY_COUNT:
+        forwarded = [
+            address.strip()
+            for address in request.META.get('HTTP_X_FORWARDED_FOR', '').split(',')
+            if address.strip()
+        ]
+        if len(forwarded) >= TRUSTED_PROXY_COUNT:
+            return forwarded[-TRUSTED_PROXY_COUNT]
+    return request.META.get('REMOTE_ADDR', '')
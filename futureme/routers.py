@@ -0,0 +1,91 @@
+"""
+Read-replica routing.
+
+With ``DATABASE_REPLICA_URL`` set, ``ReplicaRouter`` sends the reads of
+GET and HEAD requests to the ``replica`` alias; everything else, and all
+code outside a request (scheduler, delivery, management commands), stays
+on the primary.
+
+Reads stay on the primary for the rest of a request once it has written,
+and ``ReplicaPinMiddleware`` sets a short-lived cookie after any request
+that wrote, so the same client keeps reading from the primary for
+``REPLICA_PIN_SECONDS`` and sees its own writes despite replication lag.
+"""
+from contextlib import ContextDecorator
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import DEFAULT_DB_ALIAS
+
+REPLICA_ALIAS = 'replica'
+PIN_COOKIE = 'db_primary'
+PIN_SECONDS = getattr(settings, 'REPLICA_PIN_SECONDS', 10)
+
+# Tables whose readers must see the latest write: rate limit counters and
+# cached lookups in the cache table, sessions (logout) and scheduler state
+PRIMARY_APPS = frozenset({'django_cache', 'sessions', 'django_apscheduler'})
+
+_use_replica = ContextVar('use_replica', default=False)
+_wrote = ContextVar('wrote', default=False)
+
+
+class use_primary(ContextDecorator):
+    """Send every query in the block (or decorated function) to the primary"""
+
+    def _recreate_cm(self):
+        # A fresh instance per call, so concurrent calls keep their own token
+        return type(self)()
+
+    def __enter__(self):
+        self._token = _use_replica.set(False)
+        return self
+
+    def __exit__(self, *exc):
+        # A write inside the block keeps the rest of the request on the primary
+        if not _wrote.get():
+            _use_replica.reset(self._token)
+        return False
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if _use_replica.get() and model._meta.app_label not in PRIMARY_APPS:
+            return REPLICA_ALIAS
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        # Tables in PRIMARY_APPS are always read from the primary, so
+        # writing them (e.g. filling the cache) needs no pin
+        if model._meta.app_label not in PRIMARY_APPS:
+            # Read-your-writes for the rest of the request
+            _use_replica.set(False)
+            _wrote.set(True)
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Both aliases hold the same data
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
+
+
+class ReplicaPinMiddleware:
+    def __init__(self, get_response):
+        if REPLICA_ALIAS not in settings.DATABASES:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        replica = request.method in ('GET', 'HEAD') and PIN_COOKIE not in request.COOKIES
+        replica_token = _use_replica.set(replica)
+        wrote_token = _wrote.set(False)
+        try:
+            response = self.get_response(request)
+            if _wrote.get():
+                response.set_cookie(PIN_COOKIE, '1', max_age=PIN_SECONDS, httponly=True, samesite='Lax')
+            return response
+        finally:
+            _use_replica.reset(replica_token)
+            _wrote.reset(wrote_token)
@@ -1,9 +1,34 @@
 from django.contrib import admin
-from .models import Letter
+from .models import DeliveryWorker, Lease, Letter, OutboundEmail, SchedulerRun
 
 @admin.register(Letter)
 class LetterAdmin(admin.ModelAdmin):
-    list_display = ('title', 'author', 'delivery_date', 'is_delivered', 'created_at')
-    list_filter = ('is_delivered', 'delivery_date')
+    list_display = ('title', 'author', 'delivery_date', 'is_delivered', 'is_failed', 'delivery_attempts', 'created_at')
+    list_filter = ('is_delivered', 'is_failed', 'delivery_date')
+    list_select_related = ('author',)
     search_fields = ('title', 'content', 'author__email')
-    readonly_fields = ('created_at', 'uuid')
+    readonly_fields = ('created_at', 'uuid', 'last_delivery_error')
+
+
+@admin.register(DeliveryWorker)
+class DeliveryWorkerAdmin(admin.ModelAdmin):
+    list_display = ('worker_id', 'hostname', 'pid', 'started_at', 'heartbeat_at')
+    readonly_fields = ('started_at',)
+
+@admin.register(Lease)
+class LeaseAdmin(admin.ModelAdmin):
+    list_display = ('name', 'holder', 'expires_at')
+    search_fields = ('name', 'holder')
+
+@admin.register(OutboundEmail)
+class OutboundEmailAdmin(admin.ModelAdmin):
+    list_display = ('subject', 'status', 'attempts', 'next_attempt_at', 'created_at', 'sent_at')
+    list_filter = ('status',)
+    search_fields = ('subject',)
+    readonly_fields = ('created_at', 'sent_at', 'last_error')
+
+@admin.register(SchedulerRun)
+class SchedulerRunAdmin(admin.ModelAdmin):
+    list_display = ('job_id', 'started_at', 'duration', 'status', 'detail')
+    list_filter = ('job_id', 'status')
+    readonly_fields = ('slot', 'job_id', 'started_at', 'duration', 'status', 'detail')
@@ -0,0 +1,388 @@
+"""
+Asyncio delivery: many SMTP sessions in flight from one thread.
+
+``send_batch`` waits out every SMTP round trip on a single session, so a
+worker thread sends at most one letter per four round trips (MAIL, RCPT,
+DATA, message). ``deliver_async`` keeps ``sessions`` SMTP sessions busy
+at once on an event loop. Each session is an ``AsyncSMTP`` client, which
+sends MAIL, RCPT and DATA in a single round trip when the server
+advertises PIPELINING (RFC 2920).
+
+The database work stays synchronous: claiming batches and recording their
+outcome run through ``sync_to_async`` on one dedicated thread, as Django's
+ORM requires, while the event loop keeps sending. The next batch is
+claimed while the current one is still being sent. Claims, leases and
+retries are the ones of ``letters.delivery``.
+"""
+import asyncio
+import base64
+import logging
+import re
+import smtplib
+import ssl
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.mail.message import sanitize_address
+from django.core.mail.utils import DNS_NAME
+from django.db import connections
+
+from futureme.routers import use_primary
+from letters.delivery import (
+    DELIVERY_BATCH_SIZE,
+    DeliveryResult,
+    Pacer,
+    build_message,
+    claim_due_letters,
+    record_outcome,
+)
+
+logger = logging.getLogger(__name__)
+
+ASYNC_SESSIONS = getattr(settings, 'LETTER_ASYNC_SESSIONS', 8)
+
+CRLF = b'\r\n'
+_LINE_ENDING = re.compile(br'\r\n|\n|\r(?!\n)')
+_LEADING_DOT = re.compile(br'^\.', re.MULTILINE)
+
+
+def _data_block(message):
+    """``message`` as the body of a DATA command: CRLF line endings, dot-stuffed and terminated"""
+    data = _LEADING_DOT.sub(b'..', _LINE_ENDING.sub(CRLF, message))
+    if not data.endswith(CRLF):
+        data += CRLF
+    return data + b'.' + CRLF
+
+
+class AsyncSMTP:
+    """
+    A minimal asyncio SMTP client for sending mail.
+
+    Connection settings default to Django's ``EMAIL_*`` settings. Errors
+    are the ``smtplib`` exceptions the synchronous backend raises, so
+    failures read the same in ``last_delivery_error`` either way.
+    """
+
+    def __init__(self, host=None, port=None, username=None, password=None,
+                 use_tls=None, use_ssl=None, timeout=None, pipelining=True):
+        self.host = host or settings.EMAIL_HOST
+        self.port = port or settings.EMAIL_PORT
+        self.username = settings.EMAIL_HOST_USER if username is None else username
+        self.password = settings.EMAIL_HOST_PASSWORD if password is None else password
+        self.use_tls = settings.EMAIL_USE_TLS if use_tls is None else use_tls
+        self.use_ssl = getattr(settings, 'EMAIL_USE_SSL', False) if use_ssl is None else use_ssl
+        self.timeout = timeout or getattr(settings, 'EMAIL_TIMEOUT', None) or 30
+        # Whether to pipeline when the server allows it
+        self.pipelining = pipelining
+        self.extensions = {}
+        self._reader = self._writer = None
+
+    @property
+    def is_connected(self):
+        return self._writer is not None and not self._writer.is_closing()
+
+    @property
+    def pipelines(self):
+        return self.pipelining and 'pipelining' in self.extensions
+
+    async def connect(self):
+        """Open the session: greeting, EHLO, STARTTLS and AUTH as configured"""
+        context = ssl.create_default_context() if self.use_ssl else None
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=context), self.timeout
+        )
+        try:
+            code, message = await self._reply()
+            if code != 220:
+                raise smtplib.SMTPConnectError(code, message)
+            await self._ehlo()
+            if self.use_tls:
+                if 'starttls' not in self.extensions:
+                    raise smtplib.SMTPNotSupportedError("STARTTLS extension not supported by server.")
+                await self._expect(220, 'STARTTLS')
+                await self._writer.start_tls(ssl.create_default_context(), server_hostname=self.host)
+                await self._ehlo()
+            if self.username and self.password:
+                await self._login()
+        except BaseException:
+            self.abort()
+            raise
+
+    async def sendmail(self, from_addr, recipients, message):
+        """
+        Send ``message`` (bytes) to ``recipients``.
+
+        Raises ``SMTPSenderRefused``, ``SMTPRecipientsRefused`` (all
+        recipients refused) or ``SMTPDataError`` with the session reset
+        and still usable; returns the recipients that were refused.
+        """
+        options = ' BODY=8BITMIME' if '8bitmime' in self.extensions else ''
+        mail = f'MAIL FROM:<{from_addr}>{options}'
+        rcpts = [f'RCPT TO:<{recipient}>' for recipient in recipients]
+        data_reply = None
+        if self.pipelines:
+            self._send(mail, *rcpts, 'DATA')
+            mail_reply = await self._reply()
+            rcpt_replies = [await self._reply() for _ in rcpts]
+            data_reply = await self._reply()
+        else:
+            self._send(mail)
+            mail_reply = await self._reply()
+            rcpt_replies = []
+            if mail_reply[0] == 250:
+                for rcpt in rcpts:
+                    self._send(rcpt)
+                    rcpt_replies.append(await self._reply())
+                if any(code in (250, 251) for code, _ in rcpt_replies):
+                    self._send('DATA')
+                    data_reply = await self._reply()
+
+        if mail_reply[0] != 250:
+            await self._reset()
+            raise smtplib.SMTPSenderRefused(*mail_reply, from_addr)
+        refused = {
+            recipient: reply
+            for recipient, reply in zip(recipients, rcpt_replies)
+            if reply[0] not in (250, 251)
+        }
+        if len(refused) == len(recipients):
+            if data_reply and data_reply[0] == 354:
+                # A pipelined DATA may be accepted with no recipients;
+                # end it empty (RFC 2920, section 3.1)
+                self._writer.write(b'.' + CRLF)
+                await self._reply()
+            await self._reset()
+            raise smtplib.SMTPRecipientsRefused(refused)
+        if data_reply[0] != 354:
+            await self._reset()
+            raise smtplib.SMTPDataError(*data_reply)
+
+        self._writer.write(_data_block(message))
+        code, reply = await self._reply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, reply)
+        return refused
+
+    async def quit(self):
+        if not self.is_connected:
+            return
+        try:
+            self._send('QUIT')
+            await self._reply()
+        except (smtplib.SMTPException, OSError):
+            pass
+        finally:
+            self.abort()
+
+    def abort(self):
+        """Drop the connection without saying goodbye"""
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+        self.extensions = {}
+
+    def _send(self, *commands):
+        if not self.is_connected:
+            raise smtplib.SMTPServerDisconnected('please run connect() first')
+        self._writer.write(b''.join(command.encode('ascii') + CRLF for command in commands))
+
+    async def _reply(self):
+        """Read one (possibly multi-line) reply; returns ``(code, message)`` like smtplib"""
+        lines = []
+        while True:
+            line = await asyncio.wait_for(self._reader.readline(), self.timeout)
+            if not line:
+                self.abort()
+                raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+            lines.append(line[4:].strip())
+            if line[3:4] != b'-':
+                break
+        try:
+            code = int(line[:3])
+        except ValueError:
+            code = -1
+        return code, b'\n'.join(lines)
+
+    async def _expect(self, expected, command):
+        self._send(command)
+        code, message = await self._reply()
+        if code != expected:
+            raise smtplib.SMTPResponseException(code, message)
+        return message
+
+    async def _ehlo(self):
+        self._send(f'EHLO {DNS_NAME}')
+        code, message = await self._reply()
+        if code != 250:
+            self._send(f'HELO {DNS_NAME}')
+            code, message = await self._reply()
+            if code != 250:
+                raise smtplib.SMTPHeloError(code, message)
+            self.extensions = {}
+            return
+        # The first line is the greeting, then one extension per line
+        self.extensions = {}
+        for line in message.decode('latin-1').split('\n')[1:]:
+            keyword, _, params = line.partition(' ')
+            self.extensions[keyword.lower()] = params
+
+    async def _login(self):
+        methods = self.extensions.get('auth', '').upper().split()
+        try:
+            if 'PLAIN' in methods:
+                token = base64.b64encode(f'\0{self.username}\0{self.password}'.encode()).decode('ascii')
+                await self._expect(235, f'AUTH PLAIN {token}')
+            elif 'LOGIN' in methods:
+                await self._expect(334, 'AUTH LOGIN')
+                await self._expect(334, base64.b64encode(self.username.encode()).decode('ascii'))
+                await self._expect(235, base64.b64encode(self.password.encode()).decode('ascii'))
+            else:
+                raise smtplib.SMTPException("No suitable authentication method found.")
+        except smtplib.SMTPResponseException as e:
+            raise smtplib.SMTPAuthenticationError(e.smtp_code, e.smtp_error) from e
+
+    async def _reset(self):
+        try:
+            self._send('RSET')
+            await self._reply()
+        except (smtplib.SMTPException, OSError):
+            self.abort()
+
+
+class _Batch:
+    """A claimed batch whose letters are being sent by any of the sessions"""
+
+    def __init__(self, letters):
+        self.letters = letters
+        self.unsent = len(letters)
+        self.sent = []
+        self.failures = {}
+
+    def done(self, letter, error):
+        """Record one letter's outcome; returns whether the batch is complete"""
+        if error is None:
+            self.sent.append(letter.id)
+        else:
+            self.failures[letter.id] = error
+        self.unsent -= 1
+        return self.unsent == 0
+
+
+@sync_to_async
+@use_primary()
+def _claim(batch_size, queryset):
+    return claim_due_letters(batch_size=batch_size, queryset=queryset)
+
+
+@sync_to_async
+@use_primary()
+def _record(batch):
+    # Letters still unsent (the run was interrupted) keep their claim
+    # and are retried when the lease runs out
+    finished = set(batch.sent) | batch.failures.keys()
+    letters = [letter for letter in batch.letters if letter.id in finished]
+    return record_outcome(letters, batch.sent, batch.failures)
+
+
+@sync_to_async
+def _close_db():
+    connections.close_all()
+
+
+async def send_letter_async(smtp, letter, pacer=None):
+    """Send one letter on ``smtp``; returns None, or the error message"""
+    email = build_message(letter)
+    encoding = email.encoding or settings.DEFAULT_CHARSET
+    from_email = sanitize_address(email.from_email, encoding)
+    recipients = [sanitize_address(address, encoding) for address in email.recipients()]
+    message = email.message().as_bytes(linesep='\r\n')
+    if pacer is not None:
+        delay = pacer.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    for attempt in range(2):
+        reused = smtp.is_connected
+        try:
+            if not reused:
+                await smtp.connect()
+            await smtp.sendmail(from_email, recipients, message)
+            return None
+        except (smtplib.SMTPServerDisconnected, OSError) as e:
+            smtp.abort()
+            error = e
+            if reused and attempt == 0:
+                # The session went away while idle: retry once on a fresh one
+                logger.warning("SMTP session lost, reconnecting: %s", e)
+                continue
+        except smtplib.SMTPException as e:
+            error = e
+        break
+    logger.error("Failed to send letter %s: %s", letter.id, error)
+    return str(error)
+
+
+async def deliver_async(sessions=None, batch_size=None, queryset=None, max_rate=None,
+                        connect=AsyncSMTP, on_batch=None):
+    """
+    Deliver due letters over ``sessions`` concurrent SMTP sessions until
+    none are left; returns the aggregate ``DeliveryResult``.
+
+    ``connect`` makes a new ``AsyncSMTP`` client. ``on_batch`` is called
+    on the event loop with the ``DeliveryResult`` of every batch once its
+    outcome is recorded. ``max_rate`` caps messages per second across
+    all sessions.
+    """
+    sessions = sessions or ASYNC_SESSIONS
+    batch_size = batch_size or DELIVERY_BATCH_SIZE
+    pacer = Pacer(max_rate) if max_rate else None
+    result = DeliveryResult()
+    # One batch waits while another is sent, so the claim round trip is
+    # hidden without leasing much more than the sessions can send
+    queue = asyncio.Queue(maxsize=batch_size)
+    batches = set()
+
+    async def record(batch):
+        batches.discard(batch)
+        outcome = await _record(batch)
+        result.merge(outcome)
+        if on_batch is not None:
+            on_batch(outcome)
+
+    async def claim():
+        while True:
+            letters = await _claim(batch_size, queryset)
+            if not letters:
+                break
+            batch = _Batch(letters)
+            batches.add(batch)
+            for letter in letters:
+                await queue.put((batch, letter))
+        for _ in range(sessions):
+            await queue.put(None)
+
+    async def send(group):
+        smtp = connect()
+        try:
+            while (item := await queue.get()) is not None:
+                batch, letter = item
+                if batch.done(letter, await send_letter_async(smtp, letter, pacer)):
+                    group.create_task(record(batch))
+        finally:
+            await smtp.quit()
+
+    try:
+        async with asyncio.TaskGroup() as group:
+            group.create_task(claim())
+            for _ in range(sessions):
+                group.create_task(send(group))
+    finally:
+        try:
+            # Whatever was sent before a failure or interruption is still
+            # marked, so it is not sent again
+            for batch in list(batches):
+                if batch.sent or batch.failures:
+                    await record(batch)
+        finally:
+            await _close_db()
+    return result
@@ -10,6 +10,10 @@ class LettersConfig(AppConfig):
     name = 'letters'
 
     def ready(self):
+        from django.db.backends.signals import connection_created
+        from futureme.db import configure_sqlite
+        connection_created.connect(configure_sqlite, dispatch_uid='futureme.configure_sqlite')
+
         # Skip scheduler initialization during:
         # - Management commands (migrate, etc.)
         # - Testing
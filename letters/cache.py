@@ -0,0 +1,104 @@
+"""
+Per-user cache of the letter index.
+
+The index is the light-weight list of a user's letters (no content) that
+the dashboard and the letters API are built from. It is loaded from the
+database on first use and dropped whenever one of the user's letters
+changes: by the ``Letter`` post_save/post_delete signals, and by the
+delivery engine, whose bulk updates do not send signals.
+
+Invalidation bumps a per-user generation token instead of deleting the
+index, so a reader that loaded the index just before a write can only
+store it under the old generation, where nobody will read it again.
+
+The index is only cached in redis or a shared directory ('file'). A
+locmem cache would never see the invalidations made by other gunicorn
+workers or the scheduler, and a hit in the 'db' cache is a query of its
+own; with either, ``get_letter_index`` returns None and callers run
+their projected, keyset-paginated query instead.
+"""
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+from futureme.cache import CACHE_BACKENDS
+from letters.models import Letter
+
+CACHE_ALIAS = 'letters' if 'letters' in settings.CACHES else 'default'
+CACHE_ENABLED = settings.CACHES[CACHE_ALIAS]['BACKEND'] not in (
+    CACHE_BACKENDS['db'][0],
+    CACHE_BACKENDS['locmem'][0],
+)
+INDEX_FIELDS = ('id', 'title', 'delivery_date', 'is_delivered', 'is_failed', 'sent_at')
+INDEX_TIMEOUT = getattr(settings, 'LETTER_INDEX_CACHE_SECONDS', 300)
+INDEX_MAX_SIZE = getattr(settings, 'LETTER_INDEX_MAX_SIZE', 5000)
+# Stored instead of the rows for users with more than INDEX_MAX_SIZE letters
+TOO_LARGE = 'too-large'
+
+
+def _generation_key(user_id):
+    return f'letters:index-gen:{user_id}'
+
+
+def _index_key(user_id, generation):
+    return f'letters:index:{user_id}:{generation}'
+
+
+def _generation(cache, user_id):
+    key = _generation_key(user_id)
+    generation = cache.get(key)
+    if generation is None:
+        generation = uuid.uuid4().hex
+        if not cache.add(key, generation, INDEX_TIMEOUT):
+            generation = cache.get(key, generation)
+    return generation
+
+
+def get_letter_index(user_id):
+    """
+    The user's letters as dicts of ``INDEX_FIELDS``, ordered by
+    ``(delivery_date, id)``.
+
+    Returns None when the index is not cached (see above) or the user has
+    more than ``LETTER_INDEX_MAX_SIZE`` letters; callers then query the
+    database directly.
+    """
+    if not CACHE_ENABLED:
+        return None
+    cache = caches[CACHE_ALIAS]
+    key = _index_key(user_id, _generation(cache, user_id))
+    rows = cache.get(key)
+    if rows is None:
+        # Never from a replica: rows it has not caught up with yet
+        # would be cached under the new generation until the next write
+        rows = _load_index(user_id, using=DEFAULT_DB_ALIAS)
+        cache.set(key, rows, INDEX_TIMEOUT)
+    if rows == TOO_LARGE:
+        return None
+    return [dict(zip(INDEX_FIELDS, row)) for row in rows]
+
+
+def _load_index(user_id, using=None):
+    rows = list(
+        Letter.objects.using(using).filter(author_id=user_id)
+        .order_by('delivery_date', 'id')
+        .values_list(*INDEX_FIELDS)[:INDEX_MAX_SIZE + 1]
+    )
+    return TOO_LARGE if len(rows) > INDEX_MAX_SIZE else rows
+
+
+def invalidate_letter_index(*user_ids):
+    """Drop the cached index of each user, once the current transaction commits"""
+    user_ids = {user_id for user_id in user_ids if user_id is not None}
+    if not user_ids or not CACHE_ENABLED:
+        return
+
+    def invalidate():
+        caches[CACHE_ALIAS].set_many(
+            {_generation_key(user_id): uuid.uuid4().hex for user_id in user_ids},
+            INDEX_TIMEOUT,
+        )
+
+    transaction.on_commit(invalidate)
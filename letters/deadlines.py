@@ -0,0 +1,223 @@
+"""
+Event-driven delivery scheduler.
+
+Instead of polling the database on a fixed interval, ``DeadlineScheduler``
+loads the upcoming window of undelivered letters into a min-heap keyed by
+``next_attempt_at``, the time each letter becomes eligible, and sleeps until the earliest one is due.
+New letters are pushed in through ``notify_letter_scheduled`` so they are
+picked up without waiting for the next window refresh. On PostgreSQL the
+notification is also sent with NOTIFY so a scheduler running in another
+process (the ``worker`` dyno) hears about letters written by web workers.
+Elsewhere (SQLite, or PostgreSQL behind pgbouncer) only a refresh finds
+those letters, so the window is reloaded every
+``LETTER_SCHEDULER_POLL_SECONDS`` instead of ``LETTER_SCHEDULER_REFRESH_SECONDS``.
+Letters that delivery hands back, retries and released claims, are
+pushed back onto the heap straight away.
+"""
+import heapq
+import logging
+import select
+import threading
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, connection
+from django.utils import timezone
+
+from letters.delivery import deliver_due_letters, pending_letters
+from letters.sharding import in_shards
+
+logger = logging.getLogger(__name__)
+
+NOTIFY_CHANNEL = 'letters_scheduled'
+
+# The scheduler running in this process, if any; see notify_letter_scheduled
+_active_scheduler = None
+
+
+def listens_for_notify():
+    """Whether letters written by other processes reach the scheduler by NOTIFY"""
+    # LISTEN needs a server session of its own, which pgbouncer's
+    # transaction pooling cannot give us
+    return connection.vendor == 'postgresql' and getattr(settings, 'DATABASE_POOL_MODE', '') != 'transaction'
+
+
+class DeadlineScheduler:
+    """Sleeps until the next letter is due, then runs the delivery engine"""
+
+    def __init__(self, window=None, refresh_interval=None, max_letters=None, deliver=None,
+                 coordinator=None):
+        self.window = window or timedelta(
+            seconds=getattr(settings, 'LETTER_SCHEDULER_WINDOW_SECONDS', 3600)
+        )
+        if refresh_interval is None:
+            if listens_for_notify():
+                refresh_interval = getattr(settings, 'LETTER_SCHEDULER_REFRESH_SECONDS', 300)
+            else:
+                refresh_interval = getattr(settings, 'LETTER_SCHEDULER_POLL_SECONDS', 30)
+        self.refresh_interval = timedelta(seconds=refresh_interval)
+        self.max_letters = max_letters or getattr(settings, 'LETTER_SCHEDULER_MAX_LETTERS', 10000)
+        self.deliver = deliver or deliver_due_letters
+        # ShardCoordinator when running as one of several sharded workers
+        self.coordinator = coordinator
+
+        self._heap = []  # (eligible_at, letter_id)
+        self._queued = set()
+        self._horizon = None
+        self._next_refresh = None
+        self._cond = threading.Condition()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._listener = None
+
+    def push(self, letter_id, eligible_at):
+        """Add a letter to the heap if it falls inside the loaded window"""
+        if self.coordinator is not None and not self.coordinator.owns(letter_id):
+            return
+        with self._cond:
+            if letter_id in self._queued:
+                return
+            if self._horizon is not None and eligible_at > self._horizon:
+                return
+            heapq.heappush(self._heap, (eligible_at, letter_id))
+            self._queued.add(letter_id)
+            if self._heap[0][1] == letter_id:
+                self._cond.notify()
+
+    def refresh(self):
+        """Reload the upcoming window of undelivered letters from the database"""
+        now = timezone.now()
+        horizon = now + self.window
+        upcoming = pending_letters().filter(next_attempt_at__lte=horizon)
+        if self.coordinator is not None:
+            upcoming = in_shards(upcoming, self.coordinator.shards)
+        rows = list(
+            upcoming.order_by('next_attempt_at')
+            .values_list('next_attempt_at', 'id')[:self.max_letters]
+        )
+        if len(rows) == self.max_letters:
+            # Window is full: only trust it up to the last loaded letter
+            horizon = rows[-1][0]
+
+        # Rows come back sorted, which is already a valid heap
+        heap = rows
+
+        with self._cond:
+            self._heap = heap
+            self._queued = {letter_id for _, letter_id in heap}
+            self._horizon = horizon
+            self._next_refresh = min(now + self.refresh_interval, horizon)
+            self._cond.notify()
+        logger.debug("Deadline scheduler loaded %d letters due before %s", len(heap), horizon)
+
+    def request_refresh(self, *args):
+        """Ask the scheduling loop to reload its window, e.g. after a shard rebalance"""
+        with self._cond:
+            self._next_refresh = timezone.now()
+            self._cond.notify()
+
+    def _pop_due(self, now):
+        due = False
+        while self._heap and self._heap[0][0] <= now:
+            _, letter_id = heapq.heappop(self._heap)
+            self._queued.discard(letter_id)
+            due = True
+        return due
+
+    def _seconds_until_next_event(self, now):
+        deadline = self._next_refresh
+        if self._heap and self._heap[0][0] < deadline:
+            deadline = self._heap[0][0]
+        return max((deadline - now).total_seconds(), 0)
+
+    def run_forever(self):
+        """Run the scheduling loop in the calling thread until ``stop()``"""
+        global _active_scheduler
+        _active_scheduler = self
+        self.refresh()
+        while not self._stopped.is_set():
+            try:
+                with self._cond:
+                    now = timezone.now()
+                    due = self._pop_due(now)
+                    if not due and now < self._next_refresh:
+                        self._cond.wait(self._seconds_until_next_event(now))
+                        continue
+
+                close_old_connections()
+                if due:
+                    shards = self.coordinator.shards if self.coordinator is not None else None
+                    result = self.deliver(shards=shards)
+                    # Retries and released claims were popped already
+                    for letter_id, eligible_at in result.requeued.items():
+                        self.push(letter_id, eligible_at)
+                if timezone.now() >= self._next_refresh:
+                    self.refresh()
+            except Exception as e:
+                logger.error("Error in deadline scheduler: %s", e, exc_info=True)
+                self._stopped.wait(5)
+        if _active_scheduler is self:
+            _active_scheduler = None
+
+    def start(self):
+        """Run the scheduler (and its NOTIFY listener) in background threads"""
+        self._thread = threading.Thread(
+            target=self.run_forever, name='letters-deadline-scheduler', daemon=True
+        )
+        self._thread.start()
+        if listens_for_notify():
+            self._listener = threading.Thread(
+                target=self._listen, name='letters-deadline-listener', daemon=True
+            )
+            self._listener.start()
+
+    def stop(self):
+        self._stopped.set()
+        with self._cond:
+            self._cond.notify()
+
+    def join(self, timeout=None):
+        if self._thread:
+            self._thread.join(timeout)
+
+    def _listen(self):
+        """Feed PostgreSQL NOTIFY payloads from other processes into the heap"""
+        try:
+            connection.ensure_connection()
+            raw = connection.connection
+            if not hasattr(raw, 'poll'):
+                logger.info("NOTIFY listener needs psycopg2; relying on window refreshes")
+                return
+            with connection.cursor() as cursor:
+                cursor.execute(f'LISTEN {NOTIFY_CHANNEL}')
+            while not self._stopped.is_set():
+                if select.select([raw], [], [], 5) == ([], [], []):
+                    continue
+                raw.poll()
+                while raw.notifies:
+                    notify = raw.notifies.pop(0)
+                    letter_id, _, eligible_at = notify.payload.partition('|')
+                    self.push(int(letter_id), datetime.fromisoformat(eligible_at))
+        except Exception as e:
+            logger.error("Deadline scheduler listener stopped: %s", e, exc_info=True)
+        finally:
+            connection.close()
+
+
+def notify_letter_scheduled(letter):
+    """
+    Tell the deadline scheduler about a new or rescheduled letter.
+
+    Call this after the letter has been committed.
+    """
+    if _active_scheduler is not None:
+        _active_scheduler.push(letter.id, letter.delivery_date)
+    if connection.vendor == 'postgresql':
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    'SELECT pg_notify(%s, %s)',
+                    [NOTIFY_CHANNEL, f'{letter.id}|{letter.delivery_date.isoformat()}'],
+                )
+        except Exception as e:
+            logger.warning("Could not notify scheduler about letter %s: %s", letter.id, e)
@@ -0,0 +1,377 @@
+"""Batched delivery engine for due letters.
+
+Letters are delivered in three steps:
+
+1. ``claim_due_letters`` claims up to ``batch_size`` due letters in a single
+   statement, so concurrent workers never pick up the same rows.
+2. ``send_batch`` sends the whole batch over one SMTP connection.
+3. ``mark_delivered`` flags every successfully sent letter in one UPDATE.
+"""
+from dataclasses import dataclass, field
+from datetime import timedelta
+import logging
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from futureme.db import retry_on_database_locked
+from futureme.log import log_event
+from futureme.mail import PoolTimeout
+from futureme.routers import use_primary
+from letters.cache import invalidate_letter_index
+from letters.models import Letter
+from letters.retry import RetryPolicy
+from letters.sharding import in_shards
+
+logger = logging.getLogger(__name__)
+
+DELIVERY_BATCH_SIZE = getattr(settings, 'LETTER_DELIVERY_BATCH_SIZE', 100)
+# A claimed letter becomes claimable again after this long, in case the
+# worker that claimed it died before recording the outcome
+CLAIM_LEASE = timedelta(seconds=getattr(settings, 'LETTER_DELIVERY_CLAIM_SECONDS', 300))
+RETRY_POLICY = RetryPolicy.for_letters()
+# Everything the send path reads from a claimed letter, fetched together
+# with the author's email in the claim query
+DELIVERY_FIELDS = ('id', 'title', 'content', 'delivery_attempts', 'author__email')
+
+
+@dataclass
+class DeliveryResult:
+    """Outcome of one or more delivery batches"""
+    claimed: int = 0
+    sent: list = field(default_factory=list)
+    failed: list = field(default_factory=list)
+    batches: int = 0
+    # Letters that used up their attempts and were marked failed
+    given_up: list = field(default_factory=list)
+    # letter id -> when it is due again, for retries and released claims
+    requeued: dict = field(default_factory=dict)
+
+    def summary(self):
+        """One line for logs and the run history; empty when nothing was claimed"""
+        if not self.claimed:
+            return ''
+        return f'claimed={self.claimed} sent={len(self.sent)} failed={len(self.failed)}'
+
+    def merge(self, other):
+        self.claimed += other.claimed
+        self.sent.extend(other.sent)
+        self.failed.extend(other.failed)
+        self.batches += other.batches
+        self.given_up.extend(other.given_up)
+        # A letter released by one batch may be finished by a later one
+        for letter_id in other.sent + other.given_up:
+            self.requeued.pop(letter_id, None)
+        self.requeued.update(other.requeued)
+        return self
+
+
+def pending_letters():
+    """
+    Letters still waiting to be delivered.
+
+    The filter matches the condition of the partial ``letter_due_idx``
+    index exactly, so queries built on it only ever touch that index.
+    """
+    return Letter.objects.filter(is_delivered=False, is_failed=False)
+
+
+def due_letters(now=None):
+    """
+    Letters that are due and eligible for another delivery attempt.
+
+    ``next_attempt_at`` carries both the delivery date and any retry
+    backoff, so eligibility is a single range scan of ``letter_due_idx``.
+    """
+    now = now or timezone.now()
+    return pending_letters().filter(next_attempt_at__lte=now)
+
+
+@retry_on_database_locked
+def claim_due_letters(batch_size=None, now=None, queryset=None, shards=None):
+    """
+    Claim a batch of due letters for this worker.
+
+    The claim bumps ``delivery_attempts``, stamps ``last_delivery_attempt``
+    and pushes ``next_attempt_at`` out by ``CLAIM_LEASE``, which takes the
+    rows out of ``due_letters`` until the outcome is recorded (or the lease
+    runs out because the worker died). On PostgreSQL the candidate rows are locked with
+    SKIP LOCKED so concurrent workers claim disjoint batches; on SQLite the
+    conditional UPDATE plus the claim timestamp give the same guarantee.
+
+    ``shards`` restricts the claim to the shards leased by this worker (see
+    ``letters.sharding``).
+    """
+    batch_size = batch_size or DELIVERY_BATCH_SIZE
+    now = now or timezone.now()
+    candidates = queryset if queryset is not None else due_letters(now)
+    if shards is not None:
+        candidates = in_shards(candidates, shards)
+
+    # The random offset makes (last_delivery_attempt, next_attempt_at)
+    # unique to this claim even if another worker claims in the same
+    # microsecond; the pair is how the claimed rows are found again below
+    lease_until = now + CLAIM_LEASE + timedelta(microseconds=random.randrange(1, 1000000))
+    claim = {
+        'delivery_attempts': F('delivery_attempts') + 1,
+        'last_delivery_attempt': now,
+        'next_attempt_at': lease_until,
+    }
+    candidates = candidates.order_by('next_attempt_at', 'id')
+
+    if connections[DEFAULT_DB_ALIAS].features.has_select_for_update_skip_locked:
+        with transaction.atomic():
+            ids = list(
+                candidates.select_for_update(skip_locked=True).values_list('id', flat=True)[:batch_size]
+            )
+            if not ids or not due_letters(now).filter(id__in=ids).update(**claim):
+                return []
+    # On SQLite the claim is one UPDATE ... WHERE id IN (SELECT ... LIMIT n).
+    # A single statement waits for the write lock in the busy handler,
+    # whereas a read followed by a write in one transaction fails with
+    # "database is locked" as soon as another writer commits in between.
+    # The autocommit exists() check keeps idle polls from taking the lock.
+    elif (
+        not candidates.exists()
+        or not due_letters(now).filter(id__in=candidates.values('id')[:batch_size]).update(**claim)
+    ):
+        return []
+
+    return list(
+        pending_letters()
+        .filter(last_delivery_attempt=now, next_attempt_at=lease_until)
+        .select_related('author')
+        .only(*DELIVERY_FIELDS)
+        .order_by('delivery_date', 'id')
+    )
+
+
+class Pacer:
+    """
+    Spaces out sends to at most ``rate`` messages per second across all
+    threads that share it. ``wait`` blocks until the caller's turn.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, count=1):
+        """Book ``count`` sends; returns how many seconds to wait before making them"""
+        with self._lock:
+            now = time.monotonic()
+            # Unused time is not banked, so an idle spell allows no burst
+            start = max(self._next, now)
+            self._next = start + self.interval * count
+        return start - now
+
+    def wait(self, count=1):
+        delay = self.reserve(count)
+        if delay > 0:
+            time.sleep(delay)
+
+
+class PacedConnection:
+    """Wraps a mail connection so every ``send_messages`` call waits for a ``Pacer``"""
+
+    def __init__(self, connection, pacer):
+        self.connection = connection
+        self.pacer = pacer
+
+    def send_messages(self, messages):
+        self.pacer.wait(len(messages))
+        return self.connection.send_messages(messages)
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+
+def build_message(letter, connection=None):
+    """Build the email for a single letter"""
+    return EmailMessage(
+        subject=f'Your Future Letter: {letter.title}',
+        body=letter.content,
+        from_email=settings.DEFAULT_FROM_EMAIL,
+        to=[letter.author.email],
+        connection=connection,
+    )
+
+
+def send_batch(letters, connection=None):
+    """
+    Send ``letters`` over a single SMTP connection.
+
+    Returns ``(sent_ids, failures)`` where ``failures`` maps letter ids to
+    the error message. A failure on one letter does not stop the rest of the
+    batch; the connection is reopened after an error so a dropped session
+    only costs the letter that was in flight. If no pooled connection can
+    be had, the letters not yet sent are left out of both: they were
+    never attempted.
+    """
+    sent_ids, failures = [], {}
+    if not letters:
+        return sent_ids, failures
+
+    connection = connection or get_connection(fail_silently=False)
+    try:
+        for letter in letters:
+            try:
+                # open() is a no-op while the session is alive
+                connection.open()
+                if connection.send_messages([build_message(letter, connection)]):
+                    sent_ids.append(letter.id)
+                else:
+                    failures[letter.id] = 'Message was not sent'
+            except PoolTimeout as e:
+                logger.warning("No SMTP connection for the rest of the batch: %s", e)
+                break
+            except Exception as e:
+                logger.error("Failed to send letter %s: %s", letter.id, e)
+                failures[letter.id] = str(e)
+                _close_quietly(connection)
+    finally:
+        _close_quietly(connection)
+
+    return sent_ids, failures
+
+
+def _close_quietly(connection):
+    try:
+        connection.close()
+    except Exception as e:
+        logger.warning("Error closing mail connection: %s", e)
+
+
+@retry_on_database_locked
+def mark_delivered(letter_ids, sent_at=None, author_ids=None):
+    """
+    Mark all ``letter_ids`` as delivered in one UPDATE.
+
+    Pass the letters' ``author_ids`` when known to save a query for
+    invalidating their cached letter indexes.
+    """
+    if not letter_ids:
+        return 0
+    if author_ids is None:
+        author_ids = Letter.objects.filter(id__in=letter_ids).values_list('author_id', flat=True).distinct()
+    updated = Letter.objects.filter(id__in=letter_ids).update(
+        is_delivered=True,
+        sent_at=sent_at or timezone.now(),
+    )
+    invalidate_letter_index(*author_ids)
+    return updated
+
+
+@retry_on_database_locked
+def record_failures(letters, failures, now=None):
+    """
+    Schedule a retry for each failed letter, or mark it failed for good.
+
+    ``letters`` are the claimed instances, whose ``delivery_attempts``
+    already includes the failed attempt. Returns the ids that were given up on.
+    """
+    now = now or timezone.now()
+    failed, given_up = [], []
+    for letter in letters:
+        if letter.id not in failures:
+            continue
+        letter.next_attempt_at = RETRY_POLICY.next_attempt_at(letter.delivery_attempts, now)
+        letter.is_failed = letter.next_attempt_at is None
+        letter.last_delivery_error = failures[letter.id][:1000]
+        failed.append(letter)
+        if letter.is_failed:
+            given_up.append(letter)
+    if failed:
+        Letter.objects.bulk_update(failed, ['next_attempt_at', 'is_failed', 'last_delivery_error'])
+    if given_up:
+        invalidate_letter_index(*(letter.author_id for letter in given_up))
+    for letter in given_up:
+        log_event(
+            logger, 'letter.failed', logging.ERROR,
+            letter_id=letter.id,
+            attempts=letter.delivery_attempts,
+            error=letter.last_delivery_error,
+        )
+    return [letter.id for letter in given_up]
+
+
+@retry_on_database_locked
+def release_claims(letters, now=None):
+    """
+    Hand back claimed ``letters`` that were never attempted: the claim's
+    attempt is not counted and they are due again straight away.
+    """
+    if not letters:
+        return 0
+    return Letter.objects.filter(id__in=[letter.id for letter in letters]).update(
+        delivery_attempts=F('delivery_attempts') - 1,
+        next_attempt_at=now or timezone.now(),
+    )
+
+
+def record_outcome(letters, sent_ids, failures):
+    """
+    Record the outcome of sending claimed ``letters``: mark ``sent_ids``
+    delivered, schedule retries for ``failures`` and release the claim on
+    the rest. Returns the batch's ``DeliveryResult``.
+    """
+    result = DeliveryResult(claimed=len(letters), batches=1)
+    authors = {letter.id: letter.author_id for letter in letters}
+    mark_delivered(sent_ids, author_ids={authors[letter_id] for letter_id in sent_ids})
+    result.sent.extend(sent_ids)
+    result.failed.extend(failures)
+    result.given_up.extend(record_failures(letters, failures))
+    finished = set(sent_ids) | failures.keys()
+    untried = [letter for letter in letters if letter.id not in finished]
+    now = timezone.now()
+    release_claims(untried, now)
+    # record_failures set the retry time on each failed letter
+    result.requeued.update(
+        (letter.id, letter.next_attempt_at)
+        for letter in letters if letter.id in failures and not letter.is_failed
+    )
+    result.requeued.update((letter.id, now) for letter in untried)
+    log_event(
+        logger, 'letters.batch',
+        claimed=len(letters),
+        sent=len(sent_ids),
+        failed=len(failures),
+        given_up=len(result.given_up),
+        released=len(untried),
+    )
+    return result
+
+
+@use_primary()
+def deliver_batch(batch_size=None, connection=None, queryset=None, shards=None):
+    """Claim, send and mark a single batch of due letters"""
+    letters = claim_due_letters(batch_size=batch_size, queryset=queryset, shards=shards)
+    if not letters:
+        return DeliveryResult()
+
+    sent_ids, failures = send_batch(letters, connection=connection)
+    return record_outcome(letters, sent_ids, failures)
+
+
+def deliver_due_letters(batch_size=None, max_batches=None, connection=None, shards=None, queryset=None):
+    """
+    Drain due letters batch by batch until none are left.
+
+    ``max_batches`` bounds the work done in one call so a scheduler tick
+    cannot run forever while a large backlog drains. ``queryset`` limits
+    the letters claimed, as for ``claim_due_letters``.
+    """
+    result = DeliveryResult()
+    while max_batches is None or result.batches < max_batches:
+        batch = deliver_batch(batch_size=batch_size, connection=connection, queryset=queryset, shards=shards)
+        result.merge(batch)
+        if batch.claimed == 0:
+            break
+    return result
@@ -0,0 +1,100 @@
+"""
+Bounded execution history for scheduler jobs.
+
+Jobs wrapped with ``tracked`` record a ``SchedulerRun`` only when they
+did something (have a non-empty summary) or raised, so idle ticks never
+touch the database. Runs are written into ``SCHEDULER_RUN_HISTORY``
+fixed slots in turn, overwriting the oldest, so the table never grows
+past that size and needs no cleanup job. The turn comes from a counter
+in the database, so the workers of ``start_scheduler --sharded`` share
+one history instead of overwriting each other's runs.
+"""
+from functools import wraps
+import logging
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from letters.models import SchedulerRun, SchedulerRunCounter
+
+logger = logging.getLogger(__name__)
+
+RUN_HISTORY_SIZE = getattr(settings, 'SCHEDULER_RUN_HISTORY', 500)
+
+
+def _take_slot():
+    with transaction.atomic():
+        # The UPDATE locks the counter row until commit, so the value read
+        # back is this writer's own on every backend
+        counter = SchedulerRunCounter.objects.filter(pk=1)
+        if not counter.update(value=F('value') + 1):
+            SchedulerRunCounter.objects.get_or_create(pk=1)
+            counter.update(value=F('value') + 1)
+        count = counter.values_list('value', flat=True).get()
+    slot = (count - 1) % RUN_HISTORY_SIZE
+    if slot == 0:
+        # Once a lap, drop slots left over from a larger history size
+        SchedulerRun.objects.filter(slot__gte=RUN_HISTORY_SIZE).delete()
+    return slot
+
+
+def record_run(job_id, started_at, duration, status, detail=''):
+    """Store one run in the next slot of the ring buffer"""
+    SchedulerRun.objects.bulk_create(
+        [SchedulerRun(
+            slot=_take_slot(),
+            job_id=job_id,
+            started_at=started_at,
+            duration=duration,
+            status=status,
+            detail=detail[:2000],
+        )],
+        update_conflicts=True,
+        unique_fields=['slot'],
+        update_fields=['job_id', 'started_at', 'duration', 'status', 'detail'],
+    )
+
+
+def recent_runs(limit=20):
+    return list(SchedulerRun.objects.all()[:limit])
+
+
+def _record(job_id, started_at, start, status, detail):
+    try:
+        record_run(job_id, started_at, time.perf_counter() - start, status, detail)
+    except Exception as e:
+        logger.warning("Could not record run of %s: %s", job_id, e)
+
+
+def tracked(job_id, summary=None, reraise=False):
+    """
+    Decorate a scheduler job so its non-idle runs are recorded.
+
+    The run's detail is ``summary(result)``, or the job's return value
+    itself when it is truthy; a run without one was idle. Exceptions are
+    logged and recorded instead of propagating, so a failing run does not
+    stop the next tick, unless ``reraise`` leaves them to the caller.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            started_at = timezone.now()
+            start = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                if not reraise:
+                    logger.error("Scheduler job %s failed: %s", job_id, e, exc_info=True)
+                _record(job_id, started_at, start, SchedulerRun.STATUS_ERROR, f'{type(e).__name__}: {e}')
+                if reraise:
+                    raise
+                return None
+            detail = summary(result) if summary is not None else (result and str(result))
+            if detail:
+                _record(job_id, started_at, start, SchedulerRun.STATUS_OK, detail)
+            return result
+        return wrapper
+    return decorator
@@ -0,0 +1,156 @@
+"""
+Leader election, so only one process in the cluster runs the scheduler.
+
+On PostgreSQL the leader holds a session-level advisory lock on its own
+connection. The lock goes away with the connection, so when the leader
+dies a standby gets it at its next poll, within ``LETTER_LEADER_POLL_SECONDS``.
+Behind pgbouncer in transaction pooling mode, and on SQLite, the leader
+holds a ``Lease`` row instead, renewed every poll; a standby takes over
+once the lease expires (``LETTER_LEADER_LEASE_SECONDS``).
+
+Every contender polls; only the leader runs ``on_elected``'s work, and a
+leader that cannot confirm its lock or lease steps down through
+``on_deposed`` before anyone else can take over.
+"""
+import hashlib
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from letters.sharding import acquire_lease, release_lease
+
+logger = logging.getLogger(__name__)
+
+LEADER_LEASE_SECONDS = getattr(settings, 'LETTER_LEADER_LEASE_SECONDS', 10)
+LEADER_POLL_SECONDS = getattr(settings, 'LETTER_LEADER_POLL_SECONDS', 2)
+
+
+def advisory_lock_key(name):
+    """A stable signed 64-bit key for ``pg_try_advisory_lock``"""
+    return int.from_bytes(hashlib.sha256(name.encode()).digest()[:8], 'big', signed=True)
+
+
+def uses_advisory_locks(using=DEFAULT_DB_ALIAS):
+    # pgbouncer may run each statement on a different server session
+    return (
+        connections[using].vendor == 'postgresql'
+        and getattr(settings, 'DATABASE_POOL_MODE', '') != 'transaction'
+    )
+
+
+class LeaderElection:
+    """
+    Campaign for leadership of ``name`` in a background thread.
+
+    ``on_elected`` and ``on_deposed`` are called from that thread when
+    this process gains or loses leadership.
+    """
+
+    def __init__(self, name, on_elected=None, on_deposed=None, holder=None,
+                 lease_seconds=None, poll_interval=None, using=DEFAULT_DB_ALIAS):
+        self.name = name
+        self.on_elected = on_elected
+        self.on_deposed = on_deposed
+        self.holder = holder or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.lease_ttl = timedelta(seconds=lease_seconds or LEADER_LEASE_SECONDS)
+        self.poll_interval = poll_interval or LEADER_POLL_SECONDS
+        self.using = using
+        self.is_leader = False
+        self._advisory = None
+        self._confirmed_at = 0.0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self.run_forever, name=f'leader-{self.name}', daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def join(self, timeout=None):
+        if self._thread:
+            self._thread.join(timeout)
+
+    def stop(self):
+        self._stopped.set()
+        self.join(timeout=self.poll_interval * 2)
+
+    def run_forever(self):
+        self._advisory = uses_advisory_locks(self.using)
+        try:
+            while not self._stopped.is_set():
+                self.poll()
+                self._stopped.wait(self.poll_interval)
+        finally:
+            self._resign()
+            connections[self.using].close()
+
+    def poll(self):
+        """Try to take or keep leadership once; returns whether we lead"""
+        try:
+            held = self._try_advisory_lock() if self._advisory else self._try_lease()
+        except Exception as e:
+            logger.warning("Leader check for %s failed: %s", self.name, e)
+            held = False
+            if self._advisory:
+                # The lock lived on this connection; a fresh one starts over
+                connections[self.using].close()
+            elif self.is_leader and time.monotonic() - self._confirmed_at < self.lease_ttl.total_seconds() / 2:
+                # The lease is still ours for a while; try again next poll
+                held = True
+
+        if held and not self.is_leader:
+            self.is_leader = True
+            self._confirmed_at = time.monotonic()
+            logger.info("%s is now the leader for %s", self.holder, self.name)
+            self._call(self.on_elected)
+        elif held:
+            self._confirmed_at = time.monotonic()
+        elif self.is_leader:
+            self.is_leader = False
+            logger.warning("%s lost leadership of %s", self.holder, self.name)
+            self._call(self.on_deposed)
+        return self.is_leader
+
+    def _try_advisory_lock(self):
+        connection = connections[self.using]
+        with connection.cursor() as cursor:
+            if self.is_leader:
+                # The lock is held as long as this connection is alive
+                cursor.execute('SELECT 1')
+                return True
+            cursor.execute('SELECT pg_try_advisory_lock(%s)', [advisory_lock_key(self.name)])
+            return cursor.fetchone()[0]
+
+    def _try_lease(self):
+        return acquire_lease(f'leader:{self.name}', self.holder, self.lease_ttl)
+
+    def _resign(self):
+        if not self.is_leader:
+            return
+        self.is_leader = False
+        self._call(self.on_deposed)
+        try:
+            if self._advisory:
+                with connections[self.using].cursor() as cursor:
+                    cursor.execute('SELECT pg_advisory_unlock(%s)', [advisory_lock_key(self.name)])
+            else:
+                release_lease(f'leader:{self.name}', self.holder)
+        except Exception as e:
+            logger.warning("Could not release leadership of %s: %s", self.name, e)
+
+    def _call(self, callback):
+        if callback is None:
+            return
+        try:
+            callback()
+        except Exception as e:
+            logger.error("Leadership callback for %s failed: %s", self.name, e, exc_info=True)
@@ -0,0 +1,176 @@
+from django.contrib.auth import get_user_model
+from django.core.mail import get_connection
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from letters.aio import AsyncSMTP, deliver_async
+from letters.delivery import deliver_batch, due_letters
+from letters.models import Letter
+from datetime import timedelta
+from functools import partial
+import asyncio
+import threading
+import time
+import uuid
+
+User = get_user_model()
+
+
+class SMTPSink:
+    """
+    A local SMTP server that accepts and discards everything.
+
+    Replies to whatever arrived in one read are held back for ``latency``
+    seconds and written together, which models one network round trip:
+    a pipelined MAIL/RCPT/DATA costs one ``latency``, the same commands
+    sent one by one cost three.
+    """
+
+    def __init__(self, latency=0.0, pipelining=True):
+        self.latency = latency
+        self.pipelining = pipelining
+        self.received = 0
+        self.port = None
+        self._loop = asyncio.new_event_loop()
+        self._ready = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._run, name='smtp-sink', daemon=True).start()
+        self._ready.wait()
+        return self
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        server = self._loop.run_until_complete(asyncio.start_server(self._session, '127.0.0.1', 0))
+        self.port = server.sockets[0].getsockname()[1]
+        self._ready.set()
+        self._loop.run_forever()
+
+    def _ehlo(self):
+        lines = ['sink', '8BITMIME'] + (['PIPELINING'] if self.pipelining else [])
+        return ''.join(f'250-{line}\r\n' for line in lines[:-1]) + f'250 {lines[-1]}'
+
+    async def _session(self, reader, writer):
+        writer.write(b'220 sink ESMTP\r\n')
+        buffer, in_data, closing = b'', False, False
+        while not closing:
+            chunk = await reader.read(65536)
+            if not chunk:
+                break
+            buffer += chunk
+            replies = []
+            while True:
+                if in_data:
+                    end = buffer.find(b'\r\n.\r\n')
+                    if end < 0:
+                        break
+                    buffer, in_data = buffer[end + 5:], False
+                    self.received += 1
+                    replies.append('250 OK queued')
+                    continue
+                line, found, rest = buffer.partition(b'\r\n')
+                if not found:
+                    break
+                buffer = rest
+                verb = line[:4].upper()
+                if verb == b'EHLO':
+                    replies.append(self._ehlo())
+                elif verb == b'DATA':
+                    in_data = True
+                    replies.append('354 End data with <CR><LF>.<CR><LF>')
+                elif verb == b'QUIT':
+                    replies.append('221 Bye')
+                    closing = True
+                    break
+                else:
+                    replies.append('250 OK')
+            if replies:
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                writer.write(('\r\n'.join(replies) + '\r\n').encode())
+        writer.close()
+
+
+class Command(BaseCommand):
+    help = 'Measure async delivery throughput against a local SMTP sink as SMTP sessions are added (benchmark data is deleted)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--letters', type=int, default=2000, help='Letters sent per run')
+        parser.add_argument('--sessions', default='1,2,4,8,16,32', help='Comma-separated session counts to try')
+        parser.add_argument('--latency', type=float, default=20, help='Simulated SMTP round trip in milliseconds')
+        parser.add_argument('--batch-size', type=int, default=100, help='Letters claimed per batch')
+        parser.add_argument('--no-pipelining', action='store_true', help='Have the sink refuse PIPELINING')
+
+    def handle(self, *args, **options):
+        try:
+            session_counts = [int(n) for n in options['sessions'].split(',')]
+        except ValueError:
+            raise CommandError('--sessions must be a comma-separated list of numbers')
+        sink = SMTPSink(options['latency'] / 1000, pipelining=not options['no_pipelining']).start()
+        self.stdout.write(
+            f"SMTP sink on port {sink.port}: {options['latency']:g}ms round trip, "
+            f"pipelining {'off' if options['no_pipelining'] else 'on'}"
+        )
+        self.user = User.objects.create_user(email=f'benchmark-{uuid.uuid4().hex}@example.com')
+        try:
+            self.stdout.write(f"{'mode':<14}{'sent':>8}{'seconds':>10}{'per second':>12}{'speedup':>9}")
+            # The blocking engine on one session is the baseline
+            sent, seconds = self._run_sync(sink, options)
+            baseline = sent / seconds
+            self._row('sync, 1', sent, seconds, baseline)
+            for sessions in session_counts:
+                self._row(f'async, {sessions}', *self._run_async(sink, sessions, options), baseline)
+            self.stdout.write(f'Sink received {sink.received} messages')
+        finally:
+            sink.stop()
+            Letter.objects.filter(author=self.user).delete()
+            self.user.delete()
+
+    def _row(self, mode, sent, seconds, baseline):
+        rate = sent / seconds
+        speedup = f'{rate / baseline:.1f}x'
+        self.stdout.write(f'{mode:<14}{sent:>8}{seconds:>10.2f}{rate:>12.0f}{speedup:>9}')
+
+    def _make_letters(self, count):
+        Letter.objects.filter(author=self.user).delete()
+        when = timezone.now() - timedelta(seconds=1)
+        Letter.objects.bulk_create(
+            Letter(
+                author=self.user,
+                title=f'bench-{n}',
+                content='benchmark',
+                delivery_date=when,
+                next_attempt_at=when,
+            )
+            for n in range(count)
+        )
+        return due_letters().filter(author=self.user)
+
+    def _run_sync(self, sink, options):
+        # Fewer letters: at four round trips each this is the slow one
+        queryset = self._make_letters(max(1, options['letters'] // 10))
+        mail = get_connection(
+            'django.core.mail.backends.smtp.EmailBackend',
+            host='127.0.0.1', port=sink.port, username='', password='', use_tls=False, use_ssl=False,
+        )
+        sent = 0
+        start = time.perf_counter()
+        while True:
+            result = deliver_batch(batch_size=options['batch_size'], connection=mail, queryset=queryset)
+            sent += len(result.sent)
+            if not result.claimed:
+                break
+        return sent, time.perf_counter() - start
+
+    def _run_async(self, sink, sessions, options):
+        queryset = self._make_letters(options['letters'])
+        connect = partial(
+            AsyncSMTP, host='127.0.0.1', port=sink.port, username='', password='', use_tls=False, use_ssl=False,
+        )
+        start = time.perf_counter()
+        result = asyncio.run(deliver_async(
+            sessions=sessions, batch_size=options['batch_size'], queryset=queryset, connect=connect,
+        ))
+        return len(result.sent), time.perf_counter() - start
@@ -0,0 +1,102 @@
+from django.core.management.base import BaseCommand
+from django.contrib.auth import get_user_model
+from django.utils import timezone
+from futureme.db import scratch_database
+from letters.delivery import DELIVERY_BATCH_SIZE, due_letters, pending_letters
+from letters.models import Letter
+from datetime import timedelta
+import time
+import uuid
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = 'Measure due-letter poll cost as delivered history grows (runs in a scratch database)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--history',
+            default='0,10000,100000,1000000',
+            help='Comma-separated delivered-letter counts to measure at',
+        )
+        parser.add_argument('--pending', type=int, default=5000, help='Undelivered letters')
+        parser.add_argument('--due', type=int, default=200, help='How many of the undelivered letters are due')
+        parser.add_argument('--repeat', type=int, default=50, help='Polls timed per step')
+        parser.add_argument('--explain', action='store_true', help='Print the query plans')
+
+    def handle(self, *args, **options):
+        steps = sorted(int(step) for step in options['history'].split(','))
+        # Never the live database: up to a million rows in one transaction
+        # would hold its write lock (and bloat its WAL) until the rollback
+        with scratch_database() as name:
+            self.stdout.write(f'Scratch database: {name}')
+            self._run(steps, options)
+
+    def _run(self, steps, options):
+        now = timezone.now()
+        user = User.objects.create_user(email=f'benchmark-{uuid.uuid4().hex}@example.invalid')
+
+        pending = options['pending']
+        due = min(options['due'], pending)
+        self._insert(user, pending, now, delivered=False, due=due)
+        self.stdout.write(f'{pending} undelivered letters ({due} due)')
+
+        self.stdout.write(f"{'delivered history':>18} | {'claim poll ms':>13} | {'window load ms':>14}")
+        self.stdout.write('-' * 53)
+        history = 0
+        for step in steps:
+            if step > history:
+                self._insert(user, step - history, now, delivered=True, offset=history)
+                history = step
+
+            claim_ms = self._time(
+                lambda: list(
+                    due_letters(now).order_by('next_attempt_at', 'id')
+                    .values_list('id', flat=True)[:DELIVERY_BATCH_SIZE]
+                ),
+                options['repeat'],
+            )
+            window_ms = self._time(
+                lambda: list(
+                    pending_letters().filter(next_attempt_at__lte=now + timedelta(hours=1))
+                    .order_by('next_attempt_at').values_list('next_attempt_at', 'id')
+                ),
+                options['repeat'],
+            )
+            self.stdout.write(f'{history:>18} | {claim_ms:>13.3f} | {window_ms:>14.3f}')
+
+        if options['explain']:
+            self.stdout.write('\nClaim query plan:')
+            self.stdout.write(
+                due_letters(now).order_by('next_attempt_at', 'id')
+                .values_list('id', flat=True)[:DELIVERY_BATCH_SIZE].explain()
+            )
+
+    def _insert(self, user, count, now, delivered, due=0, offset=0, batch_size=5000):
+        for start in range(0, count, batch_size):
+            letters = []
+            for n in range(start, min(start + batch_size, count)):
+                if delivered:
+                    when = now - timedelta(days=1 + n % 365)
+                elif n < due:
+                    when = now - timedelta(minutes=1 + n % 60)
+                else:
+                    when = now + timedelta(minutes=1 + n)
+                letters.append(Letter(
+                    author=user,
+                    title=f"bench-{'d' if delivered else 'p'}-{offset + n}",
+                    content='benchmark',
+                    delivery_date=when,
+                    next_attempt_at=when,
+                    is_delivered=delivered,
+                    sent_at=when if delivered else None,
+                ))
+            Letter.objects.bulk_create(letters, batch_size=batch_size)
+
+    def _time(self, query, repeat):
+        query()  # warm up
+        start = time.perf_counter()
+        for _ in range(repeat):
+            query()
+        return (time.perf_counter() - start) * 1000 / repeat
@@ -0,0 +1,147 @@
+from django.contrib.auth import get_user_model
+from django.core.mail import get_connection
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connection
+from django.utils import timezone
+from futureme.db import is_database_locked, scratch_database
+from letters.delivery import deliver_due_letters, due_letters
+from letters.models import Letter
+from datetime import timedelta
+import statistics
+import threading
+import time
+import uuid
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = 'Write letters from several threads while the delivery loop drains them (runs in a scratch database)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--writers', type=int, default=4, help='Threads creating letters')
+        parser.add_argument('--seconds', type=float, default=10, help='How long the writers run')
+        parser.add_argument('--drainers', type=int, default=1, help='Threads running the delivery loop')
+        parser.add_argument('--batch-size', type=int, default=100, help='Letters claimed per delivery batch')
+
+    def handle(self, *args, **options):
+        # Never the live database: a running scheduler would send the
+        # benchmark's due letters, and the writers would hold its lock
+        with scratch_database() as name:
+            self.stdout.write(f'Scratch database: {name}')
+            self._run(options)
+
+    def _run(self, options):
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                pragmas = {
+                    name: cursor.execute(f'PRAGMA {name}').fetchone()[0]
+                    for name in ('journal_mode', 'synchronous', 'mmap_size', 'cache_size')
+                }
+            self.stdout.write('SQLite ' + ', '.join(f'{name}={value}' for name, value in pragmas.items()))
+
+        user = User.objects.create_user(email=f'benchmark-{uuid.uuid4().hex}@example.invalid')
+        self.stop = threading.Event()
+        self.writing = threading.Event()
+        self.writing.set()
+        self.written = threading.Event()
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.write_errors = 0
+        self.delivered = 0
+        self.drain_errors = 0
+
+        writers = [threading.Thread(target=self._write, args=(user,)) for _ in range(options['writers'])]
+        drainers = [
+            threading.Thread(target=self._drain, args=(user, options['batch_size']))
+            for _ in range(options['drainers'])
+        ]
+        try:
+            start = time.perf_counter()
+            for thread in writers + drainers:
+                thread.start()
+            time.sleep(options['seconds'])
+            self.writing.clear()
+            for thread in writers:
+                thread.join()
+            write_seconds = time.perf_counter() - start
+            self.written.set()
+            # Let the drainers catch up with what was written
+            for thread in drainers:
+                thread.join()
+            total_seconds = time.perf_counter() - start
+            self._report(write_seconds, total_seconds)
+        finally:
+            self.writing.clear()
+            self.stop.set()
+            # Their connections must be closed before the scratch database is dropped
+            for thread in writers + drainers:
+                if thread.is_alive():
+                    thread.join()
+
+    def _write(self, user):
+        try:
+            n = 0
+            while self.writing.is_set():
+                begin = time.perf_counter()
+                try:
+                    # Due straight away so the drainers pick it up
+                    when = timezone.now() - timedelta(seconds=1)
+                    Letter.objects.create(
+                        author=user,
+                        title=f'bench-{threading.get_ident()}-{n}',
+                        content='benchmark',
+                        delivery_date=when,
+                        next_attempt_at=when,
+                    )
+                except OperationalError as e:
+                    if not is_database_locked(e):
+                        raise
+                    with self.lock:
+                        self.write_errors += 1
+                    continue
+                with self.lock:
+                    self.latencies.append((time.perf_counter() - begin) * 1000)
+                n += 1
+        finally:
+            connection.close()
+
+    def _drain(self, user, batch_size):
+        mail = get_connection('django.core.mail.backends.locmem.EmailBackend')
+        try:
+            while not self.stop.is_set():
+                try:
+                    # Only the benchmark's own letters: anyone else's due
+                    # letter would be marked delivered without being sent
+                    result = deliver_due_letters(
+                        batch_size=batch_size,
+                        connection=mail,
+                        queryset=due_letters().filter(author=user),
+                    )
+                except OperationalError as e:
+                    if not is_database_locked(e):
+                        raise
+                    with self.lock:
+                        self.drain_errors += 1
+                    continue
+                with self.lock:
+                    self.delivered += len(result.sent)
+                if not result.claimed:
+                    if self.written.is_set():
+                        break
+                    time.sleep(0.05)
+        finally:
+            connection.close()
+
+    def _report(self, write_seconds, total_seconds):
+        written = len(self.latencies)
+        self.stdout.write(f'Written:   {written} letters in {write_seconds:.1f}s ({written / write_seconds:.0f}/s)')
+        self.stdout.write(f'Delivered: {self.delivered} letters in {total_seconds:.1f}s ({self.delivered / total_seconds:.0f}/s)')
+        if written:
+            latencies = sorted(self.latencies)
+            p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+            self.stdout.write(
+                f'Write latency ms: p50 {statistics.median(latencies):.2f}, '
+                f'p99 {p99:.2f}, max {latencies[-1]:.2f}'
+            )
+        self.stdout.write(f'"database is locked": {self.write_errors} writes, {self.drain_errors} delivery runs')
@@ -12,7 +12,7 @@ class Command(BaseCommand):
         self.stdout.write(f"Timezone: {timezone.get_current_timezone()}")
         
         # Get all letters
-        letters = Letter.objects.all().order_by('delivery_date')
+        letters = Letter.objects.select_related('author').order_by('delivery_date')
         
         self.stdout.write(f"\nTotal letters: {letters.count()}")
         
@@ -12,7 +12,7 @@ class Command(BaseCommand):
         now = timezone.now()
         
         # Get all letters
-        all_letters = Letter.objects.all().order_by('delivery_date')
+        all_letters = Letter.objects.select_related('author').order_by('delivery_date')
         
         self.stdout.write(f"\nCurrent time: {now}")
         self.stdout.write(f"Total letters: {all_letters.count()}\n")
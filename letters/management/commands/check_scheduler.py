@@ -1,5 +1,6 @@
 from django.core.management.base import BaseCommand
-from futureme.scheduler import check_scheduler_status, get_scheduled_jobs
+from letters import scheduler
+from letters.history import recent_runs
 from letters.models import Letter
 from django.utils import timezone
 import logging
@@ -10,15 +11,20 @@ class Command(BaseCommand):
     help = 'Checks the status of the APScheduler'
 
     def handle(self, *args, **options):
-        try:
-            check_scheduler_status()
-            jobs = get_scheduled_jobs()
+        # Delivery normally runs in the worker process (start_scheduler),
+        # so the run history below is the view that spans processes
+        if scheduler.scheduler is not None:
+            jobs = scheduler.scheduler.get_jobs()
             self.stdout.write(f'Found {len(jobs)} scheduled jobs:')
             for job in jobs:
                 self.stdout.write(f'  - {job.id}: Next run at {job.next_run_time}')
-        except Exception as e:
-            logger.error(f"Failed to check scheduler status: {str(e)}")
-            self.stdout.write(self.style.ERROR(f'Failed to check scheduler status: {str(e)}'))
+        else:
+            self.stdout.write('The letter scheduler is not running in this process')
+
+        runs = recent_runs(5)
+        self.stdout.write(f'\nLast {len(runs)} scheduler runs that did work:')
+        for run in runs:
+            self.stdout.write(f'  - {run.started_at} {run.job_id}: {run.status} in {run.duration:.2f}s {run.detail}')
 
         # Check pending letters
         now = timezone.now()
@@ -14,7 +14,7 @@ class Command(BaseCommand):
         self.stdout.write(f"Timezone: {timezone.get_current_timezone()}")
         
         # Get ALL letters
-        letters = Letter.objects.all().order_by('delivery_date')
+        letters = Letter.objects.select_related('author').order_by('delivery_date')
         
         self.stdout.write(f"\nTotal letters in database: {letters.count()}")
         
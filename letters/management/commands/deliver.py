@@ -0,0 +1,224 @@
+from django.conf import settings
+from django.core.mail import get_connection
+from django.core.mail.backends.smtp import EmailBackend as SMTPBackend
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection as db_connection
+from django.db.models import Count, Max, Min
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from futureme.mail import PooledEmailBackend
+from letters.aio import deliver_async
+from letters.processes import deliver_in_processes
+from letters.delivery import (
+    DELIVERY_BATCH_SIZE,
+    DeliveryResult,
+    PacedConnection,
+    Pacer,
+    deliver_batch,
+    due_letters,
+    pending_letters,
+)
+import asyncio
+import threading
+import time
+
+
+class Command(BaseCommand):
+    help = 'Deliver due letters with the batched delivery engine, optionally in parallel and rate limited'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=None,
+            help='Worker threads, each with its own SMTP connection (default 1); '
+                 'with --async, concurrent SMTP sessions (default LETTER_ASYNC_SESSIONS)',
+        )
+        parser.add_argument(
+            '--async',
+            action='store_true',
+            dest='use_async',
+            help='Send from one asyncio event loop over many pipelined SMTP sessions',
+        )
+        parser.add_argument(
+            '--processes',
+            type=int,
+            default=None,
+            help='Spread batches over this many worker processes, 0 for one per CPU core',
+        )
+        parser.add_argument('--batch-size', type=int, default=DELIVERY_BATCH_SIZE, help='Letters claimed per batch')
+        parser.add_argument('--max-rate', type=float, default=None, help='Messages per second across all workers')
+        parser.add_argument(
+            '--until-empty',
+            action='store_true',
+            help='Keep going until no letter is due, including ones that fall due during the run '
+                 '(default: only letters due when the run starts)',
+        )
+        parser.add_argument(
+            '--all',
+            action='store_true',
+            help='Also deliver future letters now; letters already attempted keep their retry schedule',
+        )
+        parser.add_argument('--dry-run', action='store_true', help='Report what would be delivered and exit')
+        parser.add_argument('--progress-every', type=float, default=5, help='Seconds between progress lines')
+
+    def handle(self, *args, **options):
+        if options['concurrency'] is not None and options['concurrency'] < 1:
+            raise CommandError('--concurrency must be at least 1')
+        if options['use_async'] and not issubclass(import_string(settings.EMAIL_BACKEND), SMTPBackend):
+            raise CommandError(f'--async talks SMTP itself and cannot replace {settings.EMAIL_BACKEND}')
+        if options['processes'] is not None:
+            if options['processes'] < 0:
+                raise CommandError('--processes cannot be negative')
+            if options['use_async'] or options['concurrency'] is not None:
+                raise CommandError('--processes sends one batch at a time per process; '
+                                   'it cannot be combined with --async or --concurrency')
+        if options['max_rate'] is not None and options['max_rate'] <= 0:
+            raise CommandError('--max-rate must be positive')
+
+        started_at = timezone.now()
+        backlog = due_letters(started_at)
+        if options['all']:
+            # Only letters nobody has tried yet. A claimed letter's
+            # next_attempt_at is its lease and a failed one's is its retry
+            # backoff; moving either would let it be sent twice
+            early = pending_letters().filter(
+                next_attempt_at__gt=started_at,
+                delivery_attempts=0,
+                last_delivery_attempt__isnull=True,
+            )
+            backlog = backlog | early
+        backlog = backlog.aggregate(
+            total=Count('id'), oldest=Min('next_attempt_at'), newest=Max('next_attempt_at'),
+        )
+        total = backlog['total']
+        self.stdout.write(f'{total} letters to deliver')
+        if total:
+            self.stdout.write(f"Oldest due {backlog['oldest']}, newest {backlog['newest']}")
+        if options['max_rate'] and total:
+            self.stdout.write(f"At {options['max_rate']:g}/s that takes at least {total / options['max_rate']:.0f}s")
+
+        if options['dry_run']:
+            self.stdout.write(self.style.WARNING('Dry run: nothing was sent'))
+            return
+        if not total and not options['until_empty']:
+            return
+
+        if options['all']:
+            early.update(next_attempt_at=started_at)
+        # Without --until-empty, only what was due at the start is claimed
+        queryset = None if options['until_empty'] else due_letters(started_at)
+
+        self.result = DeliveryResult()
+        self.lock = threading.Lock()
+        self.errors = []
+        done = threading.Event()
+
+        start = time.perf_counter()
+        reporter = threading.Thread(target=self._report, args=(start, options['progress_every'], done), daemon=True)
+        reporter.start()
+        try:
+            if options['processes'] is not None:
+                self._deliver_processes(None if options['until_empty'] else started_at, options)
+            elif options['use_async']:
+                self._deliver_async(queryset, options)
+            else:
+                self._deliver_threads(queryset, options)
+        finally:
+            done.set()
+
+        elapsed = time.perf_counter() - start
+        result = self.result
+        self.stdout.write(self.style.SUCCESS(
+            f'Delivered {len(result.sent)} letters in {elapsed:.1f}s '
+            f'({len(result.sent) / elapsed if elapsed else 0:.1f}/s) over {result.batches} batches'
+        ))
+        if result.failed:
+            self.stdout.write(self.style.WARNING(
+                f'{len(result.failed)} sends failed; {len(result.given_up)} letters gave up, the rest will be retried'
+            ))
+        for error in self.errors:
+            self.stdout.write(self.style.ERROR(f'Worker stopped: {error}'))
+
+    def _deliver_threads(self, queryset, options):
+        self.stopping = threading.Event()
+        pacer = Pacer(options['max_rate']) if options['max_rate'] else None
+        workers = [
+            threading.Thread(
+                target=self._work,
+                args=(queryset, options['batch_size'], pacer),
+                name=f'deliver-{n}',
+            )
+            for n in range(options['concurrency'] or 1)
+        ]
+        for worker in workers:
+            worker.start()
+        try:
+            for worker in workers:
+                worker.join()
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.WARNING('\nInterrupted; finishing the batches in flight'))
+            self.stopping.set()
+            for worker in workers:
+                worker.join()
+
+    def _deliver_async(self, queryset, options):
+        try:
+            asyncio.run(deliver_async(
+                sessions=options['concurrency'],
+                batch_size=options['batch_size'],
+                queryset=queryset,
+                max_rate=options['max_rate'],
+                on_batch=self._merge,
+            ))
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.WARNING('\nInterrupted; letters already sent were recorded'))
+        except Exception as e:
+            # TaskGroup failures arrive as an ExceptionGroup
+            self.errors.extend(str(error) for error in getattr(e, 'exceptions', [e]))
+
+    def _deliver_processes(self, until, options):
+        try:
+            deliver_in_processes(
+                processes=options['processes'],
+                batch_size=options['batch_size'],
+                until=until,
+                max_rate=options['max_rate'],
+                on_batch=self._merge,
+            )
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.WARNING('\nInterrupted; the batches in flight were finished'))
+        except Exception as e:
+            self.errors.append(str(e))
+
+    def _merge(self, batch):
+        with self.lock:
+            self.result.merge(batch)
+
+    def _work(self, queryset, batch_size, pacer):
+        backend = None
+        if issubclass(import_string(settings.EMAIL_BACKEND), PooledEmailBackend):
+            # The shared pool holds only EMAIL_POOL_SIZE sessions; with more
+            # threads than that, workers would queue for one instead of sending
+            backend = 'django.core.mail.backends.smtp.EmailBackend'
+        mail = get_connection(backend, fail_silently=False)
+        if pacer is not None:
+            mail = PacedConnection(mail, pacer)
+        try:
+            while not self.stopping.is_set():
+                batch = deliver_batch(batch_size=batch_size, connection=mail, queryset=queryset)
+                self._merge(batch)
+                if not batch.claimed:
+                    return
+        except Exception as e:
+            with self.lock:
+                self.errors.append(str(e))
+        finally:
+            db_connection.close()
+
+    def _report(self, start, every, done):
+        while not done.wait(every):
+            with self.lock:
+                sent, failed = len(self.result.sent), len(self.result.failed)
+            elapsed = time.perf_counter() - start
+            self.stdout.write(f'{elapsed:6.0f}s  sent {sent}  failed {failed}  ({sent / elapsed:.1f}/s)')
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+from letters.outbox import OUTBOX_POLL_SECONDS, OutboxDispatcher
+import logging
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Send queued outbound emails (OTP codes, notifications)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Send everything that is ready now and exit',
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=None,
+            help='Number of sender threads',
+        )
+
+    def handle(self, *args, **options):
+        dispatcher = OutboxDispatcher(workers=options['workers'], poll_interval=OUTBOX_POLL_SECONDS)
+
+        if options['once']:
+            sent = dispatcher.dispatch_once()
+            self.stdout.write(self.style.SUCCESS(f'Sent {sent} queued emails'))
+            return
+
+        self.stdout.write(self.style.SUCCESS('Starting outbox dispatcher...'))
+        dispatcher.start()
+        try:
+            while True:
+                dispatcher._thread.join(timeout=60)
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.SUCCESS('\nStopping outbox dispatcher...'))
+        finally:
+            dispatcher.stop()
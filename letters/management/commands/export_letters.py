@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from letters.models import Letter
+from letters.transfer import TRANSFER_CHUNK_SIZE, export_letters
+import sys
+
+
+class Command(BaseCommand):
+    help = 'Export letters as JSON lines, streaming so memory use stays flat'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', '-o', default='-', help="File to write, or '-' for stdout")
+        parser.add_argument('--email', action='append', help='Only export letters by this author (repeatable)')
+        parser.add_argument('--chunk-size', type=int, default=TRANSFER_CHUNK_SIZE, help='Rows fetched per round trip')
+
+    def handle(self, *args, **options):
+        letters = Letter.objects.all()
+        if options['email']:
+            letters = letters.filter(author__email__in=options['email'])
+
+        out = sys.stdout if options['output'] == '-' else open(options['output'], 'w', encoding='utf-8')
+        count = 0
+        try:
+            for line in export_letters(letters, chunk_size=options['chunk_size']):
+                out.write(line)
+                count += 1
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        # Progress goes to stderr so stdout stays a clean export
+        self.stderr.write(self.style.SUCCESS(f'Exported {count} letters'))
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+from letters.transfer import ON_CONFLICT_CHOICES, TRANSFER_CHUNK_SIZE, import_letters
+import sys
+
+
+class Command(BaseCommand):
+    help = 'Import letters from a JSON lines export, in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="File to read, or '-' for stdin")
+        parser.add_argument(
+            '--on-conflict',
+            choices=ON_CONFLICT_CHOICES,
+            default='skip',
+            help='What to do with letters that already exist (same author, title and creation time)',
+        )
+        parser.add_argument('--batch-size', type=int, default=TRANSFER_CHUNK_SIZE, help='Letters per INSERT')
+
+    def handle(self, *args, **options):
+        source = sys.stdin if options['path'] == '-' else open(options['path'], encoding='utf-8')
+        try:
+            result = import_letters(source, on_conflict=options['on_conflict'], batch_size=options['batch_size'])
+        finally:
+            if source is not sys.stdin:
+                source.close()
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Read {result.read} letters, imported {result.imported} new, '
+            f'updated {result.updated}, skipped {result.skipped} existing'
+        ))
+        if result.missing_authors:
+            self.stdout.write(self.style.WARNING(f'Skipped {result.missing_authors} letters whose author has no account'))
+        if result.invalid:
+            self.stdout.write(self.style.WARNING(f'Skipped {result.invalid} invalid lines (see the log)'))
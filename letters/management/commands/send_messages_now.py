@@ -1,10 +1,5 @@
-from django.core.management.base import BaseCommand
-from futureme.scheduler import send_scheduled_messages
+from letters.management.commands.deliver import Command as DeliverCommand
 
-class Command(BaseCommand):
-    help = 'Manually trigger message sending'
-    
-    def handle(self, *args, **options):
-        self.stdout.write('Manually sending scheduled messages...')
-        send_scheduled_messages()
-        self.stdout.write('Done!')
\ No newline at end of file
+
+class Command(DeliverCommand):
+    help = 'Manually trigger message sending (same as "deliver", which takes the same options)'
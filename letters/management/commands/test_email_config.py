@@ -25,7 +25,7 @@ class Command(BaseCommand):
         recipient_email = options.get('email')
         if not recipient_email and options.get('letter_id'):
             try:
-                letter = Letter.objects.get(id=options['letter_id'])
+                letter = Letter.objects.select_related('author').get(id=options['letter_id'])
                 recipient_email = letter.author.email
                 self.stdout.write(f"Using email from letter {options['letter_id']}: {recipient_email}")
             except Letter.DoesNotExist:
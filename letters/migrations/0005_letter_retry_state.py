@@ -0,0 +1,54 @@
+# Generated by Django 5.0.3 on 2026-10-18 13:48
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import F
+
+
+def backfill_retry_state(apps, schema_editor):
+    """
+    Derive next_attempt_at from the old fixed policy (3 attempts, 5 minute
+    cool-down). Letters that already used all their attempts become failed.
+    """
+    Letter = apps.get_model('letters', 'Letter')
+    undelivered = Letter.objects.filter(is_delivered=False)
+    undelivered.filter(delivery_attempts__gte=3).update(is_failed=True)
+    undelivered.filter(last_delivery_attempt__isnull=True).update(
+        next_attempt_at=F('delivery_date')
+    )
+    undelivered.filter(last_delivery_attempt__isnull=False, is_failed=False).update(
+        next_attempt_at=F('last_delivery_attempt') + timedelta(minutes=5)
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('letters', '0004_outboundemail'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='letter',
+            name='is_failed',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='letter',
+            name='last_delivery_error',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='letter',
+            name='next_attempt_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(backfill_retry_state, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='letter',
+            index=models.Index(fields=['is_failed', 'is_delivered', 'next_attempt_at'], name='letter_next_attempt_idx'),
+        ),
+    ]
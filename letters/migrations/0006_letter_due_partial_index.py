@@ -0,0 +1,31 @@
+# Generated by Django 5.0.3 on 2026-10-18 13:49
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('letters', '0005_letter_retry_state'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='letter',
+            name='letter_delivery_status_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='letter',
+            name='letter_last_attempt_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='letter',
+            name='letter_next_attempt_idx',
+        ),
+        migrations.AddIndex(
+            model_name='letter',
+            index=models.Index(condition=models.Q(('is_delivered', False), ('is_failed', False)), fields=['next_attempt_at', 'id'], name='letter_due_idx'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.0.3 on 2026-10-18 13:55
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('letters', '0006_letter_due_partial_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='letter',
+            index=models.Index(fields=['author', 'delivery_date', 'id'], name='letter_author_delivery_idx'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.0.3 on 2026-10-18 14:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('letters', '0007_letter_author_delivery_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SchedulerRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('slot', models.PositiveIntegerField(unique=True)),
+                ('job_id', models.CharField(max_length=100)),
+                ('started_at', models.DateTimeField()),
+                ('duration', models.FloatField(help_text='Seconds')),
+                ('status', models.CharField(choices=[('ok', 'OK'), ('error', 'Error')], max_length=10)),
+                ('detail', models.TextField(blank=True, default='')),
+            ],
+            options={
+                'ordering': ['-started_at'],
+            },
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.0.3 on 2026-10-18 14:57
+
+from django.db import migrations, models
+
+
+def continue_after_latest_run(apps, schema_editor):
+    # The next run goes into the slot after the newest one recorded so far
+    SchedulerRun = apps.get_model('letters', 'SchedulerRun')
+    SchedulerRunCounter = apps.get_model('letters', 'SchedulerRunCounter')
+    latest = SchedulerRun.objects.order_by('-started_at').values_list('slot', flat=True).first()
+    SchedulerRunCounter.objects.create(pk=1, value=0 if latest is None else latest + 1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('letters', '0008_schedulerrun'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SchedulerRunCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('value', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(continue_after_latest_run, migrations.RunPython.noop),
+    ]
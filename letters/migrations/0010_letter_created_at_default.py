@@ -0,0 +1,19 @@
+# Generated by Django 5.0.3 on 2026-10-18 15:04
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('letters', '0009_schedulerruncounter'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='letter',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+    ]
@@ -15,12 +15,19 @@ class Letter(models.Model):
     title = models.CharField(max_length=200)
     content = models.TextField()
     delivery_date = models.DateTimeField()
-    created_at = models.DateTimeField(auto_now_add=True)
+    # A default rather than auto_now_add, which would overwrite the
+    # created_at of letters restored by letters.transfer.import_letters
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
     is_delivered = models.BooleanField(default=False)
     sent_at = models.DateTimeField(null=True, blank=True)
     uuid = models.UUIDField(default=uuid.uuid4, editable=False, unique=True)
     delivery_attempts = models.IntegerField(default=0)
     last_delivery_attempt = models.DateTimeField(null=True, blank=True)
+    # When the delivery engine may next try this letter: the delivery date
+    # at first, then pushed out by the retry backoff after each failure
+    next_attempt_at = models.DateTimeField(null=True, blank=True)
+    is_failed = models.BooleanField(default=False)
+    last_delivery_error = models.TextField(blank=True, default='')
 
     class Meta:
         ordering = ['delivery_date']
@@ -31,22 +38,31 @@ class Letter(models.Model):
             )
         ]
         indexes = [
-            models.Index(
-                fields=['delivery_date', 'is_delivered', 'delivery_attempts'],
-                name='letter_delivery_status_idx'
-            ),
             models.Index(
                 fields=['author', 'is_delivered'],
                 name='letter_author_status_idx'
             ),
+            # Hot path of the delivery scheduler. Partial, so it only holds
+            # letters still waiting to go out and stays small no matter how
+            # much delivered history accumulates. Queries must repeat the
+            # condition exactly (see letters.delivery.due_letters).
+            models.Index(
+                fields=['next_attempt_at', 'id'],
+                name='letter_due_idx',
+                condition=models.Q(is_delivered=False, is_failed=False),
+            ),
+            # Keyset pagination of a user's letters (letters.pagination)
             models.Index(
-                fields=['last_delivery_attempt'],
-                name='letter_last_attempt_idx'
+                fields=['author', 'delivery_date', 'id'],
+                name='letter_author_delivery_idx'
             ),
         ]
 
     def __str__(self):
-        return f"{self.title} by {self.author.email}"
+        # Don't fetch the author just to render a letter
+        if Letter.author.is_cached(self):
+            return f"{self.title} by {self.author.email}"
+        return f"{self.title} by user {self.author_id}"
 
     def mark_as_sent(self):
         """Mark the letter as sent with timestamp"""
@@ -61,24 +77,109 @@ class Letter(models.Model):
         self.save(update_fields=['delivery_attempts', 'last_delivery_attempt'])
 
     def save(self, *args, **kwargs):
+        if not self.delivery_attempts or self.next_attempt_at is None:
+            # Not tried yet: the first attempt happens at the delivery date
+            self.next_attempt_at = self.delivery_date
+            update_fields = kwargs.get('update_fields')
+            if update_fields is not None and 'delivery_date' in update_fields:
+                kwargs['update_fields'] = set(update_fields) | {'next_attempt_at'}
         try:
-            logger.info(f"\n=== Saving Letter ===")
-            logger.info(f"Author: {self.author.email}")
-            logger.info(f"Title: {self.title}")
-            logger.info(f"Delivery Date: {self.delivery_date}")
-            logger.info(f"Is Delivered: {self.is_delivered}")
-            logger.info(f"Delivery Attempts: {self.delivery_attempts}")
-            logger.info(f"Last Attempt: {self.last_delivery_attempt}")
-            
             super().save(*args, **kwargs)
-            
-            logger.info(f"Successfully saved letter with ID: {self.id}")
-            logger.info("=== End Saving Letter ===\n")
-            
         except Exception as e:
-            logger.error(f"Error saving letter: {str(e)}", exc_info=True)
+            logger.error("Error saving letter %s: %s", self.pk, e, exc_info=True)
             raise
 
+class DeliveryWorker(models.Model):
+    """A running delivery worker process, kept alive by heartbeats"""
+    worker_id = models.CharField(max_length=100, unique=True)
+    hostname = models.CharField(max_length=255)
+    pid = models.IntegerField()
+    started_at = models.DateTimeField(auto_now_add=True)
+    heartbeat_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.worker_id} ({self.hostname}:{self.pid})"
+
+class Lease(models.Model):
+    """A time-limited claim on a named resource, such as a delivery shard"""
+    name = models.CharField(max_length=100, unique=True)
+    holder = models.CharField(max_length=100, blank=True, default='')
+    expires_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.name} held by {self.holder or 'nobody'} until {self.expires_at}"
+
+class OutboundEmail(models.Model):
+    """A queued outbound email, sent asynchronously by letters.outbox"""
+    STATUS_PENDING = 'pending'
+    STATUS_SENDING = 'sending'
+    STATUS_SENT = 'sent'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_SENDING, 'Sending'),
+        (STATUS_SENT, 'Sent'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    html_body = models.TextField(blank=True, default='')
+    from_email = models.CharField(max_length=254, blank=True, default='')
+    to = models.JSONField(default=list)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    attempts = models.IntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=['status', 'next_attempt_at'],
+                name='outbox_status_next_idx'
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.subject} to {', '.join(self.to)} ({self.status})"
+
+class SchedulerRun(models.Model):
+    """
+    A scheduler job run that did some work or failed. Rows are a ring
+    buffer of fixed slots overwritten in turn (see letters.history).
+    """
+    STATUS_OK = 'ok'
+    STATUS_ERROR = 'error'
+    STATUS_CHOICES = [
+        (STATUS_OK, 'OK'),
+        (STATUS_ERROR, 'Error'),
+    ]
+
+    slot = models.PositiveIntegerField(unique=True)
+    job_id = models.CharField(max_length=100)
+    started_at = models.DateTimeField()
+    duration = models.FloatField(help_text='Seconds')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES)
+    detail = models.TextField(blank=True, default='')
+
+    class Meta:
+        ordering = ['-started_at']
+
+    def __str__(self):
+        return f"{self.job_id} at {self.started_at} ({self.status})"
+
+class SchedulerRunCounter(models.Model):
+    """
+    Runs recorded so far, in a single row shared by every scheduler
+    process; it picks each run's ``SchedulerRun`` slot (see letters.history).
+    """
+    value = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.value} scheduler runs recorded"
+
 class Profile(models.Model):
     user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='letter_profile')
 
@@ -87,7 +188,7 @@ class Profile(models.Model):
 
 
 # Signal handlers for profile management
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 
 @receiver(post_save, sender=settings.AUTH_USER_MODEL)
@@ -112,4 +213,11 @@ def save_user_profile(sender, instance, created=False, **kwargs):
         if profile is not None:
             profile.save()
     except Exception as e:
-        logger.warning(f"Error saving user profile: {str(e)}")
\ No newline at end of file
+        logger.warning("Error saving user profile: %s", e)
+
+@receiver(post_save, sender=Letter)
+@receiver(post_delete, sender=Letter)
+def invalidate_author_letter_index(sender, instance, **kwargs):
+    """Drop the author's cached letter index when one of their letters changes"""
+    from letters.cache import invalidate_letter_index
+    invalidate_letter_index(instance.author_id)
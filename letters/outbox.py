@@ -0,0 +1,235 @@
+"""
+Durable outbound mail queue.
+
+Request handlers call ``enqueue_email`` instead of ``send_mail``: the message
+is stored in ``OutboundEmail`` and the view returns straight away. An
+``OutboxDispatcher`` sends queued messages from a thread pool, retrying
+failures with exponential backoff and recording the outcome on the row.
+
+Two dispatchers cooperate:
+
+* Web processes start one lazily on their first enqueue. It only wakes up
+  when something is enqueued in that process, so OTP mails leave within
+  milliseconds without any idle polling.
+* The scheduler worker (``start_scheduler`` or ``dispatch_outbox``) runs a
+  polling dispatcher that handles retries and anything a web process left
+  behind, e.g. because it was recycled mid-send.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import logging
+import random
+import threading
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives
+from django.db import DEFAULT_DB_ALIAS, close_old_connections, connections, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from letters.models import OutboundEmail
+from letters.retry import RetryPolicy
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_WORKERS = getattr(settings, 'OUTBOX_WORKERS', 4)
+OUTBOX_BATCH_SIZE = getattr(settings, 'OUTBOX_BATCH_SIZE', 50)
+OUTBOX_MAX_ATTEMPTS = getattr(settings, 'OUTBOX_MAX_ATTEMPTS', 5)
+OUTBOX_RETRY_DELAY = getattr(settings, 'OUTBOX_RETRY_DELAY_SECONDS', 30)
+OUTBOX_POLL_SECONDS = getattr(settings, 'OUTBOX_POLL_SECONDS', 5)
+OUTBOX_DISPATCH_IN_PROCESS = getattr(settings, 'OUTBOX_DISPATCH_IN_PROCESS', True)
+# How long a claimed message may stay in 'sending' before another
+# dispatcher assumes its sender died and takes it over
+SENDING_LEASE = timedelta(minutes=5)
+# 30s, 60s, 120s, ... capped at one hour
+RETRY_POLICY = RetryPolicy(
+    max_attempts=OUTBOX_MAX_ATTEMPTS,
+    base_delay=OUTBOX_RETRY_DELAY,
+    max_delay=3600,
+)
+
+_local_dispatcher = None
+_local_dispatcher_lock = threading.Lock()
+
+
+def enqueue_email(subject, body, to, from_email=None, html_body=''):
+    """
+    Queue an email for asynchronous delivery and return the OutboundEmail.
+
+    The local dispatcher is woken once the surrounding transaction commits.
+    """
+    message = OutboundEmail.objects.create(
+        subject=subject,
+        body=body,
+        html_body=html_body or '',
+        from_email=from_email or settings.DEFAULT_FROM_EMAIL or '',
+        to=list(to),
+    )
+    if OUTBOX_DISPATCH_IN_PROCESS:
+        transaction.on_commit(lambda: get_local_dispatcher().wake())
+    return message
+
+
+def claim_pending(batch_size=None, now=None):
+    """
+    Claim up to ``batch_size`` messages that are ready to send.
+
+    Claimed rows move to 'sending' with a lease; rows whose lease ran out
+    (the sender died) are claimable again. As in ``claim_due_letters``,
+    the claim is one conditional UPDATE and only the rows it changed are
+    read back, so two dispatchers never send the same message.
+    """
+    batch_size = batch_size or OUTBOX_BATCH_SIZE
+    now = now or timezone.now()
+    ready = OutboundEmail.objects.filter(
+        Q(status=OutboundEmail.STATUS_PENDING) | Q(status=OutboundEmail.STATUS_SENDING),
+        next_attempt_at__lte=now,
+    )
+    # The random offset makes the lease unique to this claim; it is how
+    # the claimed rows are found again below
+    lease_until = now + SENDING_LEASE + timedelta(microseconds=random.randrange(1, 1000000))
+    claim = {
+        'status': OutboundEmail.STATUS_SENDING,
+        'attempts': F('attempts') + 1,
+        'next_attempt_at': lease_until,
+    }
+    candidates = ready.order_by('next_attempt_at', 'id')
+
+    if connections[DEFAULT_DB_ALIAS].features.has_select_for_update_skip_locked:
+        with transaction.atomic():
+            ids = list(candidates.select_for_update(skip_locked=True).values_list('id', flat=True)[:batch_size])
+            if not ids or not ready.filter(id__in=ids).update(**claim):
+                return []
+    # Elsewhere the UPDATE ... WHERE id IN (SELECT ... LIMIT n) is a single
+    # statement that re-checks the status, so a row another dispatcher
+    # claimed in between is skipped instead of claimed twice. The
+    # autocommit exists() check keeps idle polls from taking the write lock.
+    elif not candidates.exists() or not ready.filter(id__in=candidates.values('id')[:batch_size]).update(**claim):
+        return []
+
+    return list(
+        OutboundEmail.objects.filter(
+            status=OutboundEmail.STATUS_SENDING,
+            next_attempt_at=lease_until,
+        ).order_by('id')
+    )
+
+
+def send_outbound(message):
+    """Send one claimed message and record the outcome; returns True on success"""
+    email = EmailMultiAlternatives(
+        subject=message.subject,
+        body=message.body,
+        from_email=message.from_email or None,
+        to=message.to,
+    )
+    if message.html_body:
+        email.attach_alternative(message.html_body, 'text/html')
+
+    try:
+        email.send(fail_silently=False)
+    except Exception as e:
+        now = timezone.now()
+        next_attempt_at = RETRY_POLICY.next_attempt_at(message.attempts, now)
+        if next_attempt_at is None:
+            status, next_attempt_at = OutboundEmail.STATUS_FAILED, now
+            logger.error("Giving up on outbound email %s after %s attempts: %s", message.id, message.attempts, e)
+        else:
+            status = OutboundEmail.STATUS_PENDING
+            logger.warning("Outbound email %s failed, retrying at %s: %s", message.id, next_attempt_at, e)
+        OutboundEmail.objects.filter(id=message.id).update(
+            status=status,
+            next_attempt_at=next_attempt_at,
+            last_error=str(e)[:1000],
+        )
+        return False
+
+    OutboundEmail.objects.filter(id=message.id).update(
+        status=OutboundEmail.STATUS_SENT,
+        sent_at=timezone.now(),
+        last_error='',
+    )
+    return True
+
+
+class OutboxDispatcher:
+    """Sends queued emails from a thread pool"""
+
+    def __init__(self, workers=None, batch_size=None, poll_interval=None):
+        self.workers = workers or OUTBOX_WORKERS
+        self.batch_size = batch_size or OUTBOX_BATCH_SIZE
+        # None means "only run when woken", used inside web processes
+        self.poll_interval = poll_interval
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._executor = None
+
+    def wake(self):
+        self._wake.set()
+
+    def dispatch_once(self):
+        """Send every message that is ready now; returns the number sent"""
+        sent = 0
+        while not self._stopped.is_set():
+            messages = claim_pending(self.batch_size)
+            if not messages:
+                break
+            if self._executor is None:
+                results = [self._send(message) for message in messages]
+            else:
+                results = list(self._executor.map(self._send, messages))
+            sent += sum(results)
+        return sent
+
+    def _send(self, message):
+        try:
+            return send_outbound(message)
+        finally:
+            close_old_connections()
+
+    def run_forever(self):
+        while not self._stopped.is_set():
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+            if self._stopped.is_set():
+                break
+            try:
+                close_old_connections()
+                self.dispatch_once()
+            except Exception as e:
+                logger.error("Error dispatching outbox: %s", e, exc_info=True)
+                self._stopped.wait(5)
+            finally:
+                # The next wake-up may be hours away in a web process
+                close_old_connections()
+
+    def start(self):
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix='outbox-sender'
+        )
+        self._thread = threading.Thread(
+            target=self.run_forever, name='outbox-dispatcher', daemon=True
+        )
+        self._thread.start()
+        # Pick up anything queued before we started
+        self.wake()
+
+    def stop(self):
+        self._stopped.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout=10)
+        if self._executor:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+def get_local_dispatcher():
+    """The wake-on-enqueue dispatcher for this process, started on first use"""
+    global _local_dispatcher
+    with _local_dispatcher_lock:
+        if _local_dispatcher is None:
+            _local_dispatcher = OutboxDispatcher(poll_interval=None)
+            _local_dispatcher.start()
+        return _local_dispatcher
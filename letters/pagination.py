@@ -0,0 +1,138 @@
+"""
+Keyset (cursor) pagination.
+
+Pages are fetched with a ``WHERE (a, b) > (last_a, last_b)`` style filter
+instead of OFFSET, so every page costs the same no matter how deep the
+client has scrolled, and rows inserted meanwhile never shift a page.
+The cursor is an opaque, URL-safe token holding the sort key of the last
+row on the previous page.
+"""
+import base64
+import json
+from dataclasses import dataclass
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+@dataclass
+class Page:
+    items: list
+    next_cursor: str = None
+
+    @property
+    def has_more(self):
+        return self.next_cursor is not None
+
+
+def encode_cursor(values):
+    raw = json.dumps(values, default=str, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except (ValueError, TypeError) as e:
+        raise InvalidCursor(str(e))
+    if not isinstance(values, list):
+        raise InvalidCursor('Cursor must hold a list of values')
+    return values
+
+
+class KeysetPaginator:
+    """
+    Paginates a queryset on ``ordering``, which must end with a unique
+    field (normally ``id``) so the sort key identifies exactly one row.
+    Prefix a field with '-' to sort it descending.
+    """
+
+    def __init__(self, ordering=('delivery_date', 'id'), page_size=50, max_page_size=200):
+        self.ordering = tuple(ordering)
+        self.fields = [name.lstrip('-') for name in self.ordering]
+        self.page_size = page_size
+        self.max_page_size = max_page_size
+
+    def page_limit(self, limit=None):
+        """Clamp a client supplied page size"""
+        if limit in (None, ''):
+            return self.page_size
+        try:
+            limit = int(limit)
+        except (TypeError, ValueError):
+            return self.page_size
+        return max(1, min(limit, self.max_page_size))
+
+    def paginate(self, queryset, cursor=None, limit=None, values=None):
+        """
+        Return the page after ``cursor``.
+
+        With ``values`` the page holds ``queryset.values(*values)`` dicts
+        (the sort fields are always fetched); otherwise model instances.
+        """
+        limit = self.page_limit(limit)
+        queryset = queryset.order_by(*self.ordering)
+        if cursor:
+            queryset = queryset.filter(self._after(queryset.model, decode_cursor(cursor)))
+        if values is not None:
+            queryset = queryset.values(*dict.fromkeys([*values, *self.fields]))
+
+        items = list(queryset[:limit + 1])
+        next_cursor = None
+        if len(items) > limit:
+            items = items[:limit]
+            next_cursor = encode_cursor([self._key(items[-1], name) for name in self.fields])
+        return Page(items=items, next_cursor=next_cursor)
+
+    def paginate_rows(self, rows, model, cursor=None, limit=None):
+        """Same as ``paginate`` for dicts already in memory, e.g. from a cache"""
+        limit = self.page_limit(limit)
+        rows = list(rows)
+        for order in reversed(self.ordering):
+            rows.sort(key=lambda row: row[order.lstrip('-')], reverse=order.startswith('-'))
+        if cursor:
+            values = self._cursor_values(model, decode_cursor(cursor))
+            rows = [row for row in rows if self._row_after(row, values)]
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor([rows[-1][name] for name in self.fields])
+        return Page(items=rows, next_cursor=next_cursor)
+
+    def _row_after(self, row, values):
+        for order, name, value in zip(self.ordering, self.fields, values):
+            if row[name] != value:
+                return row[name] < value if order.startswith('-') else row[name] > value
+        return False
+
+    def _key(self, item, name):
+        return item[name] if isinstance(item, dict) else getattr(item, name)
+
+    def _cursor_values(self, model, values):
+        if len(values) != len(self.fields) or None in values:
+            raise InvalidCursor('Cursor does not match the ordering')
+        try:
+            return [
+                model._meta.get_field(name).to_python(value)
+                for name, value in zip(self.fields, values)
+            ]
+        except ValidationError as e:
+            raise InvalidCursor(str(e))
+
+    def _after(self, model, values):
+        values = self._cursor_values(model, values)
+        # (a > x) OR (a = x AND b > y) OR ...
+        condition = Q()
+        for i, order in enumerate(self.ordering):
+            lookup = 'lt' if order.startswith('-') else 'gt'
+            step = Q(**{f'{self.fields[i]}__{lookup}': values[i]})
+            for name, value in zip(self.fields[:i], values[:i]):
+                step &= Q(**{name: value})
+            condition |= step
+        return condition
@@ -0,0 +1,97 @@
+"""
+Process-pool delivery: batches spread over worker processes.
+
+Building MIME messages and encrypting SMTP sessions is CPU work that
+holds the GIL, so threads in one process share a single core.
+``deliver_in_processes`` runs ``deliver_batch`` in a pool of worker
+processes instead. Each worker claims, sends and records one batch per
+task, over its own database connection and its own ``PooledEmailBackend``
+pool, and hands the batch's ``DeliveryResult`` back to the parent.
+
+Workers are started with ``spawn`` rather than forked, so none of them
+inherits the parent's database or SMTP sockets. Each one calls
+``django.setup()`` itself, which is why the Django imports of the
+worker functions happen inside them.
+"""
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import multiprocessing
+import os
+import signal
+
+import django
+
+# Set in each worker by _init_worker
+_pacer = None
+
+
+def _init_worker(rate):
+    global _pacer
+    # Ctrl-C is the parent's to handle: it lets the batches in flight
+    # finish, so no letter is sent without being marked
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    django.setup()
+    from letters.delivery import Pacer
+    _pacer = Pacer(rate) if rate else None
+
+
+def _deliver_batch(batch_size, until):
+    from django.core.mail import get_connection
+    from django.db import close_old_connections
+    from letters.delivery import PacedConnection, deliver_batch, due_letters
+
+    close_old_connections()
+    mail = get_connection(fail_silently=False)
+    if _pacer is not None:
+        mail = PacedConnection(mail, _pacer)
+    queryset = due_letters(until) if until is not None else None
+    return deliver_batch(batch_size=batch_size, connection=mail, queryset=queryset)
+
+
+def deliver_in_processes(processes=None, batch_size=None, until=None, max_rate=None, on_batch=None):
+    """
+    Deliver due letters from ``processes`` worker processes (default: one
+    per CPU core) until none are left; returns the aggregate ``DeliveryResult``.
+
+    ``until`` limits delivery to letters due by then. ``max_rate`` is
+    split evenly between the workers. ``on_batch`` is called in this
+    process with every batch's result.
+
+    On Ctrl-C no new batches are handed out; the ones in flight finish
+    and are reported before ``KeyboardInterrupt`` is raised again.
+    """
+    from letters.delivery import DeliveryResult
+
+    processes = processes or os.cpu_count() or 1
+    rate = max_rate / processes if max_rate else None
+    result = DeliveryResult()
+    interrupted = False
+    pool = ProcessPoolExecutor(
+        processes,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=_init_worker,
+        initargs=(rate,),
+    )
+    try:
+        # Two batches per worker keep each one busy while the parent
+        # collects the other's result
+        pending = {pool.submit(_deliver_batch, batch_size, until) for _ in range(processes * 2)}
+        while pending:
+            try:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            except KeyboardInterrupt:
+                interrupted = True
+                continue
+            for future in done:
+                batch = future.result()
+                result.merge(batch)
+                if on_batch is not None:
+                    on_batch(batch)
+                # An empty claim means the backlog is drained; the other
+                # batches in flight still come back
+                if batch.claimed and not interrupted:
+                    pending.add(pool.submit(_deliver_batch, batch_size, until))
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+    if interrupted:
+        raise KeyboardInterrupt
+    return result
@@ -0,0 +1,48 @@
+"""Retry policy shared by letter delivery and the outbound mail queue."""
+from dataclasses import dataclass
+from datetime import timedelta
+import random
+
+from django.conf import settings
+from django.utils import timezone
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """
+    Exponential backoff with jitter.
+
+    Attempt ``n`` (1-based) that fails is retried after
+    ``base_delay * 2 ** (n - 1)`` seconds, capped at ``max_delay`` and spread
+    by +/- ``jitter`` (a fraction of the delay) so a burst of failures does
+    not come back as a burst of retries. After ``max_attempts`` failures the
+    caller should give up and mark the item as failed.
+    """
+    max_attempts: int = 3
+    base_delay: float = 300
+    max_delay: float = 6 * 3600
+    jitter: float = 0.2
+
+    @classmethod
+    def for_letters(cls):
+        return cls(
+            max_attempts=getattr(settings, 'LETTER_RETRY_MAX_ATTEMPTS', cls.max_attempts),
+            base_delay=getattr(settings, 'LETTER_RETRY_BASE_DELAY_SECONDS', cls.base_delay),
+            max_delay=getattr(settings, 'LETTER_RETRY_MAX_DELAY_SECONDS', cls.max_delay),
+            jitter=getattr(settings, 'LETTER_RETRY_JITTER', cls.jitter),
+        )
+
+    def delay(self, attempts):
+        delay = min(self.base_delay * 2 ** max(attempts - 1, 0), self.max_delay)
+        if self.jitter:
+            delay *= 1 + random.uniform(-self.jitter, self.jitter)
+        return timedelta(seconds=delay)
+
+    def should_give_up(self, attempts):
+        return attempts >= self.max_attempts
+
+    def next_attempt_at(self, attempts, now=None):
+        """When to retry after ``attempts`` failures, or None to give up"""
+        if self.should_give_up(attempts):
+            return None
+        return (now or timezone.now()) + self.delay(attempts)
@@ -1,87 +1,155 @@
-from django_apscheduler.jobstores import DjangoJobStore
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.interval import IntervalTrigger
-from letters.tasks import send_letter
-from letters.models import Letter
-from django.utils import timezone
-from django.db import transaction
+from letters.deadlines import DeadlineScheduler
+from letters.delivery import DeliveryResult, deliver_due_letters
+from letters.history import tracked
+from letters.leader import LeaderElection
+from letters.outbox import OUTBOX_POLL_SECONDS, OutboxDispatcher
+from letters.sharding import ShardCoordinator
+from django.conf import settings
+from django.db import close_old_connections
+from futureme.log import log_event
 import logging
-from datetime import timedelta
 
 logger = logging.getLogger(__name__)
 
+# Upper bound on batches per tick so one run cannot starve the next one
+SCHEDULER_MAX_BATCHES = getattr(settings, 'LETTER_SCHEDULER_MAX_BATCHES', 50)
+SCHEDULER_SWEEP_SECONDS = getattr(settings, 'LETTER_SCHEDULER_SWEEP_SECONDS', 300)
+
+scheduler = None
+deadline_scheduler = None
+coordinator = None
+outbox_dispatcher = None
+election = None
+
+@tracked('check_and_send_letters')
 def check_and_send_letters():
-    """Check for due letters and send them immediately"""
+    """Check for due letters and send them in batches"""
+    # Jobs run outside the request cycle, so drop expired or broken
+    # persistent connections here the way request_started would
+    close_old_connections()
     try:
-        now = timezone.now()  # This is already in UTC
-        logger.info(f"\n=== Checking for due letters at {now} (UTC) ===")
-        
-        # First get eligible letters without locking
-        # Only send letters that are PAST their delivery date
-        due_letters = Letter.objects.filter(
-            delivery_date__lte=now,
-            is_delivered=False,
-            delivery_attempts__lt=3
-        ).exclude(
-            last_delivery_attempt__gte=now - timedelta(minutes=5)
-        ).order_by('delivery_date')[:10]  # Process only 10 letters at a time
-        
-        if not due_letters:
-            logger.info("No due letters found")
-            return
-            
-        logger.info(f"Found {due_letters.count()} due letters")
-        
-        # Process each due letter
-        for letter in due_letters:
-            try:
-                logger.info(f"\nProcessing letter {letter.id}:")
-                logger.info(f"Title: {letter.title}")
-                logger.info(f"Delivery date (UTC): {letter.delivery_date}")
-                logger.info(f"Current time (UTC): {now}")
-                logger.info(f"Time difference: {now - letter.delivery_date}")
-                logger.info(f"Delivery attempts: {letter.delivery_attempts}")
-                logger.info(f"Last attempt: {letter.last_delivery_attempt}")
-                logger.info(f"Recipient: {letter.author.email}")
-                
-                # Send the letter
-                send_letter(letter.id)
-                logger.info(f"Successfully sent letter {letter.id}")
-                
-            except Exception as e:
-                logger.error(f"Failed to send letter {letter.id}: {str(e)}")
-                continue
-                
-    except Exception as e:
-        logger.error(f"Error in check_and_send_letters: {str(e)}")
+        shards = coordinator.shards if coordinator is not None else None
+        result = deliver_due_letters(max_batches=SCHEDULER_MAX_BATCHES, shards=shards)
+        if not result.claimed:
+            logger.debug("No due letters found")
+            return None
+        log_event(
+            logger, 'letters.sweep',
+            claimed=result.claimed,
+            sent=len(result.sent),
+            failed=len(result.failed),
+        )
+        return result.summary()
+    finally:
+        close_old_connections()
+
+@tracked('deliver_due_letters', summary=DeliveryResult.summary, reraise=True)
+def deliver_due(shards=None):
+    """Deliver what the deadline scheduler found due, sharded or not"""
+    # The deadline scheduler handles the errors and decides what to reload
+    return deliver_due_letters(shards=shards)
+
+def _start_delivery():
+    """Start the deadline scheduler and the APScheduler safety sweep"""
+    global scheduler, deadline_scheduler
+    deadline_scheduler = DeadlineScheduler(coordinator=coordinator, deliver=deliver_due)
+    if coordinator is not None:
+        coordinator.on_change = deadline_scheduler.request_refresh
+        coordinator.start()
+    deadline_scheduler.start()
+
+    # Create scheduler with a single thread to prevent concurrent database access
+    scheduler = BackgroundScheduler(
+        job_defaults={
+            'coalesce': True,  # Only run once if multiple executions are missed
+            'max_instances': 1  # Only allow one instance of the job to run at a time
+        }
+    )
+    # The sweep is static and re-added at every start, so it lives in
+    # the default in-memory job store: ticks never write to the database
+
+    # Safety sweep for letters the deadline scheduler was not told about
+    scheduler.add_job(
+        check_and_send_letters,
+        trigger=IntervalTrigger(seconds=SCHEDULER_SWEEP_SECONDS),
+        id='check_and_send_letters',
+        replace_existing=True,
+        max_instances=1
+    )
+
+    # Start the scheduler
+    scheduler.start()
+    logger.info("Letter scheduler started successfully")
+
+def _stop_delivery():
+    global scheduler, deadline_scheduler
+    if deadline_scheduler is not None:
+        deadline_scheduler.stop()
+        deadline_scheduler = None
+    if scheduler is not None:
+        scheduler.shutdown(wait=False)
+        scheduler = None
+        logger.info("Letter scheduler stopped")
+
+def start_scheduler(sharded=None):
+    """
+    Start the deadline scheduler plus a slow APScheduler safety sweep.
+
+    The deadline scheduler delivers letters the moment they are due; the
+    sweep only catches letters it could not know about (for example ones
+    made due by management commands that edit ``delivery_date`` directly).
+
+    With ``sharded`` (default: ``LETTER_DELIVERY_SHARDED``) this process
+    registers as one of several delivery workers and only handles the
+    shards it holds leases on. Otherwise the processes that start a
+    scheduler elect a leader (``letters.leader``): only the leader
+    delivers, the others stand by and take over if it dies.
+
+    Returns what to ``join()`` on: the deadline scheduler when sharded,
+    the election otherwise, or None if nothing could be started.
+    """
+    global coordinator, outbox_dispatcher, election
+    if deadline_scheduler is not None or election is not None:
+        logger.info("Letter scheduler already running")
+        return election or deadline_scheduler
+
+    if sharded is None:
+        sharded = getattr(settings, 'LETTER_DELIVERY_SHARDED', False)
 
-def start_scheduler():
     try:
-        # Create scheduler with a single thread to prevent concurrent database access
-        scheduler = BackgroundScheduler(
-            job_defaults={
-                'coalesce': True,  # Only run once if multiple executions are missed
-                'max_instances': 1  # Only allow one instance of the job to run at a time
-            }
-        )
-        scheduler.add_jobstore(DjangoJobStore(), "default")
-        
-        # Add the job to check and send letters every 30 seconds
-        scheduler.add_job(
-            check_and_send_letters,
-            trigger=IntervalTrigger(seconds=30),
-            id='check_and_send_letters',
-            replace_existing=True,
-            max_instances=1
-        )
-        
-        # Start the scheduler
-        scheduler.start()
-        logger.info("Letter scheduler started successfully")
-        
-        # Check for due letters immediately
-        check_and_send_letters()
-        
+        # Retries and leftovers of the outbound mail queue; claims make it
+        # safe to run in every process
+        outbox_dispatcher = OutboxDispatcher(poll_interval=OUTBOX_POLL_SECONDS)
+        outbox_dispatcher.start()
+
+        if sharded:
+            coordinator = ShardCoordinator()
+            _start_delivery()
+            return deadline_scheduler
+
+        election = LeaderElection(
+            'letters-scheduler',
+            on_elected=_start_delivery,
+            on_deposed=_stop_delivery,
+        ).start()
+        return election
     except Exception as e:
         logger.error(f"Failed to start letter scheduler: {str(e)}")
-        # Don't raise the exception - we want the app to start even if scheduler fails
\ No newline at end of file
+        # Don't raise the exception - we want the app to start even if scheduler fails
+        return None
+
+def stop_scheduler():
+    global coordinator, outbox_dispatcher, election
+    if election is not None:
+        # Steps down, which stops delivery through _stop_delivery
+        election.stop()
+        election = None
+    _stop_delivery()
+    if coordinator is not None:
+        coordinator.stop()
+        coordinator = None
+    if outbox_dispatcher is not None:
+        outbox_dispatcher.stop()
+        outbox_dispatcher = None
@@ -0,0 +1,181 @@
+"""
+Lease-based sharding for running several delivery workers at once.
+
+Letters are split into ``LETTER_DELIVERY_SHARDS`` shards by ``id % shards``.
+Each worker registers itself in ``DeliveryWorker``, heartbeats, and holds a
+time-limited ``Lease`` on its fair share of the shards. When a worker dies
+its leases expire and the survivors pick the shards up at their next
+heartbeat. Leases only partition the work: the claim step in
+``letters.delivery`` still guarantees a letter is never sent twice, even
+while a lease is changing hands.
+"""
+import logging
+import math
+import os
+import socket
+import threading
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections
+from django.db.models import F, Q
+from django.db.models.functions import Mod
+from django.utils import timezone
+
+from letters.models import DeliveryWorker, Lease
+
+logger = logging.getLogger(__name__)
+
+SHARD_COUNT = getattr(settings, 'LETTER_DELIVERY_SHARDS', 16)
+LEASE_TTL = timedelta(seconds=getattr(settings, 'LETTER_DELIVERY_LEASE_SECONDS', 30))
+HEARTBEAT_INTERVAL = getattr(settings, 'LETTER_DELIVERY_HEARTBEAT_SECONDS', 10)
+
+
+def shard_of(letter_id, shard_count=SHARD_COUNT):
+    return letter_id % shard_count
+
+
+def in_shards(queryset, shards, shard_count=SHARD_COUNT):
+    """Restrict a Letter queryset to the given shards"""
+    return queryset.annotate(
+        delivery_shard=Mod(F('id'), shard_count)
+    ).filter(delivery_shard__in=list(shards))
+
+
+def acquire_lease(name, holder, ttl, now=None):
+    """
+    Take or renew the lease called ``name`` for ``holder``.
+
+    Succeeds if the lease is free, expired or already held by ``holder``.
+    """
+    now = now or timezone.now()
+    acquired = Lease.objects.filter(name=name).filter(
+        Q(holder=holder) | Q(holder='') | Q(expires_at__lt=now)
+    ).update(holder=holder, expires_at=now + ttl)
+    if acquired:
+        return True
+    if not Lease.objects.filter(name=name).exists():
+        try:
+            Lease.objects.create(name=name, holder=holder, expires_at=now + ttl)
+            return True
+        except IntegrityError:
+            # Another process created it first
+            return False
+    return False
+
+
+def release_lease(name, holder):
+    return Lease.objects.filter(name=name, holder=holder).update(
+        holder='', expires_at=timezone.now()
+    )
+
+
+class ShardCoordinator:
+    """Registers this process as a worker and keeps its shard leases fresh"""
+
+    def __init__(self, worker_id=None, shard_count=None, lease_ttl=None,
+                 heartbeat_interval=None, on_change=None):
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.shard_count = shard_count or SHARD_COUNT
+        self.lease_ttl = lease_ttl or LEASE_TTL
+        self.heartbeat_interval = heartbeat_interval or HEARTBEAT_INTERVAL
+        self.on_change = on_change
+        self._shards = frozenset()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def shards(self):
+        return self._shards
+
+    def owns(self, letter_id):
+        return shard_of(letter_id, self.shard_count) in self._shards
+
+    def heartbeat(self):
+        """Renew this worker's registration and rebalance its shard leases"""
+        now = timezone.now()
+        DeliveryWorker.objects.update_or_create(
+            worker_id=self.worker_id,
+            defaults={
+                'hostname': socket.gethostname(),
+                'pid': os.getpid(),
+                'heartbeat_at': now,
+            },
+        )
+        # Forget workers that stopped heartbeating a long time ago
+        DeliveryWorker.objects.filter(heartbeat_at__lt=now - self.lease_ttl * 10).delete()
+
+        live_workers = DeliveryWorker.objects.filter(heartbeat_at__gte=now - self.lease_ttl).count()
+        fair_share = math.ceil(self.shard_count / max(live_workers, 1))
+
+        names = {self._lease_name(shard): shard for shard in range(self.shard_count)}
+        leases = {
+            lease.name: lease
+            for lease in Lease.objects.filter(name__in=names)
+        }
+        owned = set()
+        for name, shard in names.items():
+            lease = leases.get(name)
+            if lease is not None and lease.holder == self.worker_id and lease.expires_at > now:
+                owned.add(shard)
+
+        # Give back shards beyond our fair share so new workers can take them
+        for shard in sorted(owned)[fair_share:]:
+            release_lease(self._lease_name(shard), self.worker_id)
+            owned.discard(shard)
+
+        for shard in sorted(owned):
+            if not acquire_lease(self._lease_name(shard), self.worker_id, self.lease_ttl, now):
+                owned.discard(shard)
+
+        for name, shard in names.items():
+            if len(owned) >= fair_share:
+                break
+            if shard in owned:
+                continue
+            lease = leases.get(name)
+            if lease is not None and lease.holder and lease.expires_at >= now:
+                continue
+            if acquire_lease(name, self.worker_id, self.lease_ttl, now):
+                owned.add(shard)
+
+        owned = frozenset(owned)
+        if owned != self._shards:
+            logger.info(
+                "Worker %s now owns %d/%d shards (%d live workers)",
+                self.worker_id, len(owned), self.shard_count, live_workers,
+            )
+            self._shards = owned
+            if self.on_change:
+                self.on_change(owned)
+        return owned
+
+    def _lease_name(self, shard):
+        return f"delivery-shard:{shard}"
+
+    def run_forever(self):
+        while not self._stopped.is_set():
+            try:
+                close_old_connections()
+                self.heartbeat()
+            except Exception as e:
+                logger.error("Shard heartbeat failed for %s: %s", self.worker_id, e, exc_info=True)
+            self._stopped.wait(self.heartbeat_interval)
+
+    def start(self):
+        self.heartbeat()
+        self._thread = threading.Thread(
+            target=self.run_forever, name='letters-shard-heartbeat', daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """Release all leases and unregister so other workers take over at once"""
+        self._stopped.set()
+        try:
+            Lease.objects.filter(holder=self.worker_id).update(holder='', expires_at=timezone.now())
+            DeliveryWorker.objects.filter(worker_id=self.worker_id).delete()
+        except Exception as e:
+            logger.warning("Could not release leases for %s: %s", self.worker_id, e)
+        self._shards = frozenset()
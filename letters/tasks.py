@@ -1,119 +1,61 @@
-from django.core.mail import send_mail
 from django.conf import settings
 from django.utils import timezone
-from letters.models import Letter
-from datetime import timedelta
+from letters.delivery import (
+    build_message,
+    claim_due_letters,
+    deliver_due_letters,
+    due_letters,
+    mark_delivered,
+    record_failures,
+)
+from letters.outbox import enqueue_email
+from futureme.log import log_event
+from futureme.routers import use_primary
 import logging
-from django.db import transaction
-from django.db.models import F
-from django.core.exceptions import ObjectDoesNotExist
-from django.core.mail import EmailMessage
-from django.core.mail.backends.smtp import EmailBackend
 
 logger = logging.getLogger(__name__)
 
 def send_otp_email(email, otp_code):
+    """Queue an OTP email for the outbox dispatcher"""
     subject = 'Your OTP Code for FutureSelf'
     message = f'Your OTP code is: {otp_code}. It will expire in 10 minutes.'
-    from_email = settings.DEFAULT_FROM_EMAIL
-    recipient_list = [email]
-    send_mail(subject, message, from_email, recipient_list)
+    enqueue_email(subject, message, [email], from_email=settings.DEFAULT_FROM_EMAIL)
 
+@use_primary()
 def send_letter(letter_id):
-    """Send a letter to its author"""
+    """Send a single letter to its author if it is due"""
+    letters = claim_due_letters(
+        batch_size=1,
+        queryset=due_letters().filter(id=letter_id),
+    )
+    if not letters:
+        logger.info("Letter %s not found or not eligible for sending", letter_id)
+        return
+
+    letter = letters[0]
     try:
-        # First check if letter exists and is eligible for sending without locking
-        letter = Letter.objects.filter(
-            id=letter_id,
-            is_delivered=False,
-            delivery_attempts__lt=3
-        ).first()
-        
-        if not letter:
-            logger.info(f"Letter {letter_id} not found or not eligible for sending")
-            return
-            
-        # Check if we've tried to deliver this letter recently
-        if letter.last_delivery_attempt and (timezone.now() - letter.last_delivery_attempt) < timedelta(minutes=5):
-            logger.info(f"Letter {letter_id} was attempted recently at {letter.last_delivery_attempt}, skipping")
-            return
-        
-        # Double check if the letter is due
-        now = timezone.now()
-        if letter.delivery_date > now:
-            logger.info(f"Letter {letter_id} not due yet (due at {letter.delivery_date}, current time {now}), skipping")
-            return
-        
-        # Use a small transaction only for the critical update
-        with transaction.atomic():
-            # Try to acquire the letter with a lock only for the update
-            letter = Letter.objects.select_for_update(nowait=True).filter(
-                id=letter_id,
-                is_delivered=False,
-                delivery_attempts__lt=3
-            ).first()
-            
-            if not letter:
-                logger.info(f"Letter {letter_id} was processed by another worker")
-                return
-            
-            # Increment delivery attempts
-            letter.increment_delivery_attempt()
-            
-            logger.info(f"Sending letter {letter_id} to {letter.author.email}")
-            logger.info(f"Delivery date: {letter.delivery_date}")
-            logger.info(f"Current time: {now}")
-            logger.info(f"Time difference: {now - letter.delivery_date}")
-            logger.info(f"Delivery attempt: {letter.delivery_attempts}")
-            
-            # Send the email
-            send_mail(
-                subject=f'Your Future Letter: {letter.title}',
-                message=letter.content,
-                from_email=settings.DEFAULT_FROM_EMAIL,
-                recipient_list=[letter.author.email],
-                fail_silently=False,
-            )
-            
-            # Mark as delivered
-            letter.mark_as_sent()
-            logger.info(f"Successfully sent letter {letter_id} to {letter.author.email}")
-            
-    except Letter.DoesNotExist:
-        logger.error(f"Letter {letter_id} not found")
+        build_message(letter).send(fail_silently=False)
+        mark_delivered([letter.id], author_ids=[letter.author_id])
+        log_event(logger, 'letter.sent', letter_id=letter.id, attempts=letter.delivery_attempts)
     except Exception as e:
-        logger.error(f"Failed to send letter {letter_id}: {str(e)}")
+        logger.error("Failed to send letter %s: %s", letter_id, e)
+        record_failures([letter], {letter.id: str(e)})
         raise
 
 def process_due_letters():
     """Process all due letters that haven't been delivered yet"""
-    now = timezone.now()
-    logger.info(f"Checking for due letters at {now}")
-    
     try:
-        # Get due letters
-        due_letters = Letter.objects.filter(
-            delivery_date__lte=now,
-            is_delivered=False
-        ).order_by('delivery_date')
-        
-        logger.info(f"Found {due_letters.count()} due letters to process")
-        
-        for letter in due_letters:
-            logger.info(f"Processing letter {letter.id}: {letter.title}")
-            logger.info(f"Delivery date: {letter.delivery_date}")
-            logger.info(f"Recipient: {letter.author.email}")
-            
-            try:
-                send_letter(letter.id)
-                logger.info(f"Successfully processed letter {letter.id}")
-            except Exception as e:
-                logger.error(f"Error processing letter {letter.id}: {str(e)}")
-                # Don't raise the exception - continue with next letter
-                continue
-                
+        result = deliver_due_letters()
+        if result.claimed:
+            log_event(
+                logger, 'letters.processed',
+                claimed=result.claimed,
+                batches=result.batches,
+                sent=len(result.sent),
+                failed=len(result.failed),
+            )
     except Exception as e:
-        logger.error(f"Error in process_due_letters: {str(e)}")
+        logger.error("Error in process_due_letters: %s", e)
         # Don't raise the exception - let the scheduler retry
 
 def schedule_letter_delivery(letter):
@@ -122,14 +64,10 @@ def schedule_letter_delivery(letter):
         now = timezone.now()
         # Only send if delivery date has ALREADY PASSED
         if letter.delivery_date <= now:
-            logger.info(f"Letter {letter.id} is due now, sending immediately")
-            logger.info(f"Delivery date: {letter.delivery_date}")
-            logger.info(f"Current time: {now}")
+            logger.debug("Letter %s is due now, sending immediately", letter.id)
             send_letter(letter.id)
         else:
-            logger.info(f"Letter {letter.id} scheduled for {letter.delivery_date}")
-            logger.info(f"Current time: {now}")
-            logger.info(f"Time until delivery: {letter.delivery_date - now}")
+            logger.debug("Letter %s scheduled for %s", letter.id, letter.delivery_date)
     except Exception as e:
-        logger.error(f"Error scheduling letter {letter.id}: {str(e)}")
+        logger.error("Error scheduling letter %s: %s", letter.id, e)
         raise
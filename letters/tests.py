@@ -0,0 +1,979 @@
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+from datetime import timedelta
+from unittest import mock, skipUnless
+import json
+import logging
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.sessions.models import Session
+from django.core import mail
+from django.core.cache import caches
+from django.core.management import CommandError, call_command
+from django.db import DatabaseError, connection, transaction
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from futureme.log import log_event
+from futureme.mail import PoolTimeout
+from futureme.routers import PIN_COOKIE, PIN_SECONDS, REPLICA_ALIAS, ReplicaPinMiddleware, ReplicaRouter, use_primary
+
+from letters import cache as letter_cache
+from letters.cache import CACHE_ALIAS, get_letter_index
+from letters.deadlines import DeadlineScheduler, notify_letter_scheduled
+from letters.delivery import (
+    CLAIM_LEASE, RETRY_POLICY, DeliveryResult, Pacer, claim_due_letters, deliver_due_letters, due_letters, mark_delivered,
+    record_outcome, send_batch,
+)
+from letters import history
+from letters.leader import LeaderElection, uses_advisory_locks
+from letters.models import DeliveryWorker, Lease, Letter, OutboundEmail, SchedulerRun
+from letters import outbox
+from letters.outbox import OutboxDispatcher, claim_pending, enqueue_email
+from letters.pagination import InvalidCursor, KeysetPaginator
+from letters.retry import RetryPolicy
+from letters.sharding import ShardCoordinator, acquire_lease, in_shards, release_lease
+from letters.transfer import export_letters, import_letters
+
+User = get_user_model()
+
+
+def make_letters(author, count, start=None, step=timedelta(days=1)):
+    start = start or timezone.now() + timedelta(days=30)
+    return [
+        Letter.objects.create(author=author, title=f'letter {n}', content='content', delivery_date=start + step * n)
+        for n in range(count)
+    ]
+
+
+class Worker:
+    """A thread of its own, and so a database connection of its own"""
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(1)
+
+    def submit(self, func, *args):
+        return self.executor.submit(func, *args)
+
+    def run(self, func, *args):
+        return self.submit(func, *args).result(timeout=10)
+
+    def close_connection(self):
+        # connection.close looked up here would be the calling thread's
+        self.run(lambda: connection.close())
+
+    def close(self):
+        self.close_connection()
+        self.executor.shutdown()
+
+
+class KeysetPaginatorTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='pages@example.com')
+        self.paginator = KeysetPaginator(ordering=('delivery_date', 'id'), page_size=3)
+
+    def collect(self, queryset):
+        ids, cursor = [], None
+        while True:
+            page = self.paginator.paginate(queryset, cursor=cursor)
+            ids += [letter.id for letter in page.items]
+            if not page.has_more:
+                return ids
+            cursor = page.next_cursor
+
+    def test_pages_cover_every_row_once_in_order(self):
+        letters = make_letters(self.user, 8)
+        self.assertEqual(self.collect(Letter.objects.all()), [letter.id for letter in letters])
+
+    def test_ties_on_the_sort_field_are_broken_by_id(self):
+        # All on the same date, so only the id tells the pages apart
+        letters = make_letters(self.user, 7, step=timedelta(0))
+        self.assertEqual(self.collect(Letter.objects.all()), [letter.id for letter in letters])
+
+    def test_descending_ordering(self):
+        letters = make_letters(self.user, 5)
+        self.paginator = KeysetPaginator(ordering=('-delivery_date', '-id'), page_size=2)
+        self.assertEqual(self.collect(Letter.objects.all()), [letter.id for letter in reversed(letters)])
+
+    def test_cursor_is_stable_when_rows_are_added_before_it(self):
+        letters = make_letters(self.user, 6)
+        first = self.paginator.paginate(Letter.objects.all())
+        # Sorts before everything on the first page
+        Letter.objects.create(
+            author=self.user, title='early', content='content',
+            delivery_date=letters[0].delivery_date - timedelta(days=1),
+        )
+        second = self.paginator.paginate(Letter.objects.all(), cursor=first.next_cursor)
+        self.assertEqual([letter.id for letter in second.items], [letter.id for letter in letters[3:]])
+        self.assertFalse(second.has_more)
+
+    def test_limit_is_clamped(self):
+        self.assertEqual(self.paginator.page_limit('0'), 1)
+        self.assertEqual(self.paginator.page_limit('10000'), self.paginator.max_page_size)
+        self.assertEqual(self.paginator.page_limit('nonsense'), self.paginator.page_size)
+
+    def test_invalid_cursor(self):
+        with self.assertRaises(InvalidCursor):
+            self.paginator.paginate(Letter.objects.all(), cursor='not a cursor')
+
+
+class LettersAPITests(TestCase):
+    def setUp(self):
+        # Index invalidation waits for commits, which TestCase never makes
+        caches[CACHE_ALIAS].clear()
+        self.user = User.objects.create_user(email='api@example.com')
+        self.client.force_login(self.user)
+        self.url = reverse('api_letters')
+
+    def get(self, **params):
+        headers = {}
+        if 'if_none_match' in params:
+            headers['If-None-Match'] = params.pop('if_none_match')
+        return self.client.get(self.url, params, headers=headers)
+
+    def test_pages_follow_next_cursor(self):
+        letters = make_letters(self.user, 5)
+        make_letters(User.objects.create_user(email='other@example.com'), 2)
+        ids, cursor = [], None
+        while True:
+            params = {'limit': 2, 'fields': 'id,title'}
+            if cursor:
+                params['cursor'] = cursor
+            data = self.get(**params).json()
+            self.assertLessEqual(len(data['letters']), 2)
+            ids += [row['id'] for row in data['letters']]
+            cursor = data['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(ids, [letter.id for letter in letters])
+
+    def test_cursor_is_stable_when_letters_are_added_before_it(self):
+        letters = make_letters(self.user, 4)
+        first = self.get(limit=2).json()
+        Letter.objects.create(
+            author=self.user, title='early', content='content',
+            delivery_date=letters[0].delivery_date - timedelta(days=1),
+        )
+        second = self.get(limit=2, cursor=first['next_cursor']).json()
+        self.assertEqual([row['id'] for row in second['letters']], [letters[2].id, letters[3].id])
+        self.assertIsNone(second['next_cursor'])
+
+    def test_fields(self):
+        make_letters(self.user, 1)
+        data = self.get(fields='id,title').json()
+        self.assertEqual(set(data['letters'][0]), {'id', 'title'})
+        self.assertEqual(self.get(fields='id,password').status_code, 400)
+
+    def test_invalid_cursor(self):
+        self.assertEqual(self.get(cursor='not a cursor').status_code, 400)
+
+    def test_matching_etag_returns_304(self):
+        make_letters(self.user, 3)
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+
+        cached = self.get(if_none_match=etag)
+        self.assertEqual(cached.status_code, 304)
+        self.assertEqual(cached['ETag'], etag)
+        self.assertEqual(cached.content, b'')
+        self.assertEqual(self.get(if_none_match=f'"other", {etag}').status_code, 304)
+        self.assertEqual(self.get(if_none_match='*').status_code, 304)
+
+    def test_etag_changes_with_the_content(self):
+        letters = make_letters(self.user, 2)
+        etag = self.get()['ETag']
+        Letter.objects.filter(id=letters[0].id).update(title='edited')
+        response = self.get(if_none_match=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.json()['letters'][0]['title'], 'edited')
+
+    def test_etag_depends_on_the_page(self):
+        make_letters(self.user, 4)
+        first = self.get(limit=2)
+        second = self.get(limit=2, cursor=first.json()['next_cursor'])
+        self.assertNotEqual(first['ETag'], second['ETag'])
+        self.assertEqual(self.get(limit=2, cursor=first.json()['next_cursor'], if_none_match=first['ETag']).status_code, 200)
+
+
+@override_settings(CACHES={
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'tests-default'},
+    CACHE_ALIAS: {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'tests-letters'},
+})
+@mock.patch.object(letter_cache, 'CACHE_ENABLED', True)
+class CachedLettersAPITests(LettersAPITests):
+    """The same requests, served from the cached letter index where the fields allow"""
+
+
+@override_settings(CACHES={
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'tests-default'},
+    CACHE_ALIAS: {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'tests-letters'},
+})
+@mock.patch.object(letter_cache, 'CACHE_ENABLED', True)
+class LetterIndexCacheTests(TestCase):
+    def setUp(self):
+        caches[CACHE_ALIAS].clear()
+        self.user = User.objects.create_user(email='index@example.com')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.letters = make_letters(self.user, 3)
+
+    def titles(self):
+        return [row['title'] for row in get_letter_index(self.user.id)]
+
+    def test_hits_skip_the_database(self):
+        self.assertEqual(self.titles(), ['letter 0', 'letter 1', 'letter 2'])
+        with self.assertNumQueries(0):
+            self.assertEqual(self.titles(), ['letter 0', 'letter 1', 'letter 2'])
+
+    def test_save_starts_a_new_generation(self):
+        self.titles()
+        letter = self.letters[1]
+        letter.title = 'edited'
+        with self.captureOnCommitCallbacks(execute=True):
+            letter.save()
+        self.assertEqual(self.titles(), ['letter 0', 'edited', 'letter 2'])
+
+    def test_delete_starts_a_new_generation(self):
+        self.titles()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.letters[0].delete()
+        self.assertEqual(self.titles(), ['letter 1', 'letter 2'])
+
+    def test_mark_delivered_starts_a_new_generation(self):
+        get_letter_index(self.user.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            mark_delivered([self.letters[2].id])
+        delivered = [row['is_delivered'] for row in get_letter_index(self.user.id)]
+        self.assertEqual(delivered, [False, False, True])
+
+    def test_index_loaded_before_a_write_is_never_read(self):
+        # A reader that loaded the index before the write stores it under
+        # the old generation, after the write's invalidation
+        cache = caches[CACHE_ALIAS]
+        generation = letter_cache._generation(cache, self.user.id)
+        stale = letter_cache._load_index(self.user.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            Letter.objects.create(author=self.user, title='new', content='content', delivery_date=timezone.now())
+        cache.set(letter_cache._index_key(self.user.id, generation), stale)
+        self.assertIn('new', self.titles())
+
+    def test_invalidation_waits_for_the_commit(self):
+        self.titles()
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            Letter.objects.filter(id=self.letters[0].id).update(title='edited')
+            letter_cache.invalidate_letter_index(self.user.id)
+        self.assertEqual(self.titles()[0], 'letter 0')
+        for callback in callbacks:
+            callback()
+        self.assertEqual(self.titles()[0], 'edited')
+
+    def test_other_users_keep_their_index(self):
+        other = User.objects.create_user(email='other-index@example.com')
+        make_letters(other, 1)
+        get_letter_index(other.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.letters[0].delete()
+        with self.assertNumQueries(0):
+            self.assertEqual(len(get_letter_index(other.id)), 1)
+
+    @mock.patch.object(letter_cache, 'INDEX_MAX_SIZE', 2)
+    def test_large_indexes_are_not_cached(self):
+        self.assertIsNone(get_letter_index(self.user.id))
+
+    def test_disabled_cache_falls_back_to_the_database(self):
+        with mock.patch.object(letter_cache, 'CACHE_ENABLED', False), self.assertNumQueries(0):
+            self.assertIsNone(get_letter_index(self.user.id))
+
+
+class DeadlineSchedulerTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='deadline@example.com')
+
+    def test_refreshes_often_without_notify(self):
+        # New letters from web workers only reach the heap by a refresh
+        with override_settings(LETTER_SCHEDULER_POLL_SECONDS=30, LETTER_SCHEDULER_REFRESH_SECONDS=300):
+            with mock.patch('letters.deadlines.listens_for_notify', return_value=False):
+                self.assertEqual(DeadlineScheduler().refresh_interval, timedelta(seconds=30))
+            with mock.patch('letters.deadlines.listens_for_notify', return_value=True):
+                self.assertEqual(DeadlineScheduler().refresh_interval, timedelta(seconds=300))
+
+    def test_requeued_letters_go_back_on_the_heap(self):
+        now = timezone.now()
+        letter = Letter.objects.create(author=self.user, title='due', content='content', delivery_date=now)
+        retry_at = now + timedelta(minutes=1)
+        calls = []
+
+        def deliver(shards=None):
+            calls.append(shards)
+            scheduler.stop()
+            return DeliveryResult(claimed=1, batches=1, failed=[letter.id], requeued={letter.id: retry_at})
+
+        scheduler = DeadlineScheduler(deliver=deliver, refresh_interval=300)
+        scheduler.run_forever()
+        self.assertEqual(calls, [None])
+        self.assertEqual(scheduler._heap, [(retry_at, letter.id)])
+
+    def test_record_outcome_reports_retries_and_released_claims(self):
+        past = timezone.now() - timedelta(minutes=1)
+        for n in range(3):
+            Letter.objects.create(author=self.user, title=f'due {n}', content='content', delivery_date=past)
+        sent, failed, untried = claim_due_letters(batch_size=3)
+        result = record_outcome([sent, failed, untried], [sent.id], {failed.id: 'refused'})
+        failed.refresh_from_db()
+        untried.refresh_from_db()
+        self.assertEqual(result.requeued, {failed.id: failed.next_attempt_at, untried.id: untried.next_attempt_at})
+        self.assertGreater(failed.next_attempt_at, timezone.now())
+        self.assertLessEqual(untried.next_attempt_at, timezone.now())
+
+    def test_merge_forgets_requeued_letters_finished_later(self):
+        now = timezone.now()
+        result = DeliveryResult(requeued={1: now, 2: now})
+        result.merge(DeliveryResult(sent=[1], requeued={3: now}))
+        self.assertEqual(result.requeued, {2: now, 3: now})
+
+
+@mock.patch.object(history, 'RUN_HISTORY_SIZE', 3)
+class RunHistoryTests(TestCase):
+    def record(self, n):
+        history.record_run(f'job-{n}', timezone.now() + timedelta(seconds=n), 0.1, SchedulerRun.STATUS_OK, 'detail')
+        return SchedulerRun.objects.get(job_id=f'job-{n}').slot
+
+    def test_runs_take_the_slots_in_turn(self):
+        self.assertEqual([self.record(n) for n in range(5)], [0, 1, 2, 0, 1])
+        self.assertEqual([run.job_id for run in history.recent_runs()], ['job-4', 'job-3', 'job-2'])
+
+    def test_slots_above_a_smaller_history_size_are_dropped(self):
+        for slot in (1, 5, 7):
+            SchedulerRun.objects.create(slot=slot, job_id='old', started_at=timezone.now(), duration=0, status='ok')
+        self.assertEqual(self.record(0), 0)
+        self.assertEqual(sorted(SchedulerRun.objects.values_list('slot', flat=True)), [0, 1])
+
+
+class SharedRunHistoryTests(TransactionTestCase):
+    @mock.patch.object(history, 'RUN_HISTORY_SIZE', 50)
+    def test_workers_do_not_overwrite_each_other(self):
+        # Like the processes of start_scheduler --sharded, each with its own connection
+        def worker(name):
+            try:
+                for n in range(10):
+                    history.record_run(f'{name}-{n}', timezone.now(), 0.1, SchedulerRun.STATUS_OK)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker, args=(f'worker{w}',)) for w in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(SchedulerRun.objects.count(), 40)
+        self.assertEqual(len(set(SchedulerRun.objects.values_list('job_id', flat=True))), 40)
+
+
+@skipUnless(connection.vendor == 'postgresql', 'needs PostgreSQL (run the tests with a postgres DATABASE_URL)')
+class PostgresTests(TransactionTestCase):
+    """The PostgreSQL-only paths: SKIP LOCKED claims, advisory locks and NOTIFY"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(email='postgres@example.com')
+
+    def due_letters(self, count):
+        when = timezone.now() - timedelta(minutes=1)
+        return [
+            Letter.objects.create(
+                author=self.user, title=f'due {n}', content='content', delivery_date=when + timedelta(seconds=n),
+            )
+            for n in range(count)
+        ]
+
+    def test_claim_skips_rows_locked_by_another_claim(self):
+        letters = self.due_letters(4)
+        locked, release = threading.Event(), threading.Event()
+
+        def hold_first_two():
+            with transaction.atomic():
+                list(Letter.objects.select_for_update().filter(id__in=[letters[0].id, letters[1].id]))
+                locked.set()
+                release.wait(10)
+
+        holder = Worker()
+        try:
+            holding = holder.submit(hold_first_two)
+            self.assertTrue(locked.wait(10))
+            claimed = claim_due_letters(batch_size=4)
+        finally:
+            release.set()
+            holding.result(timeout=10)
+            holder.close()
+        self.assertEqual({letter.id for letter in claimed}, {letters[2].id, letters[3].id})
+        # The rows the other transaction held are still claimable
+        self.assertEqual({letter.id for letter in claim_due_letters(batch_size=4)}, {letters[0].id, letters[1].id})
+
+    def test_advisory_lock_elects_one_leader(self):
+        self.assertTrue(uses_advisory_locks())
+        first, second = Worker(), Worker()
+        a = LeaderElection('test-leader', holder='a')
+        b = LeaderElection('test-leader', holder='b')
+        a._advisory = b._advisory = True
+        try:
+            self.assertTrue(first.run(a.poll))
+            self.assertFalse(second.run(b.poll))
+            self.assertTrue(first.run(a.poll))
+            # Resigning unlocks straight away
+            first.run(a._resign)
+            self.assertTrue(second.run(b.poll))
+            self.assertFalse(first.run(a.poll))
+            # So does losing the connection, e.g. when the leader dies; the
+            # server drops the lock once it notices, a moment later
+            second.close_connection()
+            deadline = time.monotonic() + 10
+            while not first.run(a.poll) and time.monotonic() < deadline:
+                time.sleep(0.05)
+            self.assertTrue(a.is_leader)
+        finally:
+            first.run(a._resign)
+            first.close()
+            second.close()
+
+    def test_notify_reaches_a_scheduler_in_another_process(self):
+        scheduler = DeadlineScheduler()
+        listener = threading.Thread(target=scheduler._listen, daemon=True)
+        listener.start()
+        letter = Letter.objects.create(
+            author=self.user, title='later', content='content', delivery_date=timezone.now() + timedelta(minutes=5),
+        )
+        try:
+            # Repeat until the listener has run LISTEN and heard one
+            deadline = time.monotonic() + 10
+            while letter.id not in scheduler._queued and time.monotonic() < deadline:
+                notify_letter_scheduled(letter)
+                time.sleep(0.1)
+        finally:
+            scheduler.stop()
+            listener.join(10)
+        self.assertIn(letter.id, scheduler._queued)
+
+
+class LogEventTests(TestCase):
+    def test_record_points_at_the_caller(self):
+        with self.assertLogs('letters.tests', logging.INFO) as logs:
+            log_event(logging.getLogger('letters.tests'), 'letter.sent', letter_id=7)
+        record, = logs.records
+        self.assertEqual((record.module, record.funcName), ('tests', 'test_record_points_at_the_caller'))
+        self.assertEqual(record.getMessage(), 'letter.sent letter_id=7')
+        self.assertEqual(record.fields, {'letter_id': 7})
+
+
+class LetterTransferTests(TestCase):
+    def setUp(self):
+        self.author = User.objects.create_user(email='transfer@example.com')
+        self.created_at = timezone.now() - timedelta(days=400, microseconds=123)
+        self.letters = make_letters(self.author, 3)
+        Letter.objects.filter(pk=self.letters[0].pk).update(created_at=self.created_at)
+
+    def export(self):
+        return list(export_letters(Letter.objects.filter(author=self.author)))
+
+    def test_round_trip_restores_every_field(self):
+        lines = self.export()
+        before = list(Letter.objects.order_by('id').values())
+        Letter.objects.all().delete()
+
+        result = import_letters(lines)
+
+        self.assertEqual((result.read, result.imported, result.skipped), (3, 3, 0))
+        after = list(Letter.objects.order_by('id').values())
+        for row in before + after:
+            del row['id']
+        self.assertEqual(after, before)
+        self.assertEqual(Letter.objects.get(uuid=self.letters[0].uuid).created_at, self.created_at)
+
+    def test_existing_letters_are_skipped_or_updated(self):
+        lines = self.export()
+        Letter.objects.filter(pk=self.letters[0].pk).update(content='changed here')
+
+        result = import_letters(lines)
+        self.assertEqual((result.imported, result.skipped), (0, 3))
+        self.assertEqual(Letter.objects.get(pk=self.letters[0].pk).content, 'changed here')
+
+        result = import_letters(lines, on_conflict='update')
+        self.assertEqual((result.imported, result.updated), (0, 3))
+        self.assertEqual(Letter.objects.get(pk=self.letters[0].pk).content, 'content')
+        self.assertEqual(Letter.objects.count(), 3)
+
+    def test_uuid_of_another_letter_is_replaced(self):
+        line = json.loads(self.export()[0])
+        line.update(title='another letter', created_at=timezone.now().isoformat())
+
+        result = import_letters([json.dumps(line)])
+
+        self.assertEqual(result.imported, 1)
+        imported = Letter.objects.get(title='another letter')
+        self.assertNotEqual(imported.uuid, self.letters[0].uuid)
+        self.assertEqual(Letter.objects.get(uuid=self.letters[0].uuid).pk, self.letters[0].pk)
+
+    def test_duplicate_uuids_within_a_file_are_replaced(self):
+        line = json.loads(self.export()[0])
+        line['uuid'] = str(uuid.uuid4())
+        copies = [dict(line, title=f'copy {n}') for n in range(2)]
+        Letter.objects.all().delete()
+
+        result = import_letters(json.dumps(copy) for copy in copies)
+
+        self.assertEqual(result.imported, 2)
+        self.assertEqual(len(set(Letter.objects.values_list('uuid', flat=True))), 2)
+
+    def test_unknown_authors_and_invalid_lines_are_counted(self):
+        line = json.loads(self.export()[0])
+        with self.assertLogs('letters.transfer', 'WARNING'):
+            result = import_letters([
+                json.dumps(dict(line, author='nobody@example.com')),
+                '{not json',
+                json.dumps({'author': 'transfer@example.com'}),
+                '',
+            ])
+        self.assertEqual((result.read, result.missing_authors, result.invalid, result.imported), (3, 1, 2, 0))
+
+    def test_export_is_staff_only_and_filtered_by_email(self):
+        make_letters(User.objects.create_user(email='other@example.com'), 1)
+        url = reverse('export_letters')
+        self.client.force_login(self.author)
+        self.assertEqual(self.client.get(url).status_code, 302)
+
+        self.client.force_login(User.objects.create_superuser(email='admin@example.com', password='pw'))
+        response = self.client.get(url, {'email': 'transfer@example.com'})
+        self.assertEqual(response.status_code, 200)
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([row['uuid'] for row in rows], [str(letter.uuid) for letter in self.letters])
+
+
+class FakeConnection:
+    """A mail connection that fails, or runs out, on the given letter titles"""
+
+    def __init__(self, fail=(), timeout=()):
+        self.fail = set(fail)
+        self.timeout = set(timeout)
+        self.sent = []
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def send_messages(self, messages):
+        title = messages[0].subject.removeprefix('Your Future Letter: ')
+        if title in self.timeout:
+            raise PoolTimeout('no connection')
+        if title in self.fail:
+            raise ConnectionError(f'{title} bounced')
+        self.sent.extend(messages)
+        return len(messages)
+
+
+class DeliveryTests(TestCase):
+    def setUp(self):
+        self.author = User.objects.create_user(email='delivery@example.com')
+        self.due = make_letters(self.author, 5, start=timezone.now() - timedelta(hours=1), step=timedelta(minutes=1))
+        self.later = make_letters(self.author, 1)[0]
+
+    def test_delivers_due_letters_in_batches(self):
+        result = deliver_due_letters(batch_size=2)
+
+        self.assertEqual(sorted(result.sent), sorted(letter.id for letter in self.due))
+        # Three full or partial batches, then an empty claim
+        self.assertEqual((result.claimed, result.batches), (5, 3))
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertEqual(mail.outbox[0].to, ['delivery@example.com'])
+        self.assertEqual(Letter.objects.filter(is_delivered=True, sent_at__isnull=False).count(), 5)
+        self.assertFalse(Letter.objects.get(pk=self.later.pk).is_delivered)
+
+    def test_max_batches_bounds_the_work(self):
+        result = deliver_due_letters(batch_size=2, max_batches=1)
+        self.assertEqual(len(result.sent), 2)
+        self.assertEqual(due_letters().count(), 3)
+
+    def test_claimed_letters_are_not_claimed_again(self):
+        now = timezone.now()
+        claimed = claim_due_letters(batch_size=3, now=now)
+
+        self.assertEqual([letter.id for letter in claimed], [letter.id for letter in self.due[:3]])
+        self.assertEqual([letter.delivery_attempts for letter in claimed], [1, 1, 1])
+        self.assertTrue(all(letter.next_attempt_at > now + CLAIM_LEASE for letter in claimed))
+        again = claim_due_letters(batch_size=10, now=now)
+        self.assertEqual([letter.id for letter in again], [letter.id for letter in self.due[3:]])
+        self.assertEqual(claim_due_letters(now=now), [])
+
+    def test_claim_expires_if_the_worker_dies(self):
+        now = timezone.now()
+        claim_due_letters(batch_size=10, now=now)
+        later = now + CLAIM_LEASE + timedelta(seconds=1)
+        self.assertEqual(len(claim_due_letters(batch_size=10, now=later)), 5)
+        self.assertEqual(Letter.objects.get(pk=self.due[0].pk).delivery_attempts, 2)
+
+    def test_one_failure_does_not_stop_the_batch(self):
+        letters = claim_due_letters(batch_size=10)
+        connection = FakeConnection(fail={'letter 1'})
+
+        with self.assertLogs('letters.delivery', 'ERROR'):
+            sent_ids, failures = send_batch(letters, connection)
+
+        self.assertEqual(len(connection.sent), 4)
+        self.assertEqual(list(failures), [self.due[1].id])
+        self.assertEqual(failures[self.due[1].id], 'letter 1 bounced')
+        self.assertNotIn(self.due[1].id, sent_ids)
+
+    def test_letters_never_attempted_are_handed_back(self):
+        letters = claim_due_letters(batch_size=10)
+        with self.assertLogs('letters.delivery', 'WARNING'):
+            sent_ids, failures = send_batch(letters, FakeConnection(timeout={'letter 2'}))
+        result = record_outcome(letters, sent_ids, failures)
+
+        self.assertEqual(len(result.sent), 2)
+        self.assertEqual(set(result.requeued), {letter.id for letter in self.due[2:]})
+        untried = Letter.objects.filter(pk__in=result.requeued)
+        self.assertEqual(set(untried.values_list('delivery_attempts', flat=True)), {0})
+        self.assertEqual(due_letters().count(), 3)
+
+
+class RetryTests(TestCase):
+    def setUp(self):
+        self.author = User.objects.create_user(email='retry@example.com')
+        self.letter = make_letters(self.author, 1, start=timezone.now() - timedelta(minutes=1))[0]
+
+    def test_backoff_doubles_up_to_the_cap(self):
+        policy = RetryPolicy(max_attempts=10, base_delay=60, max_delay=300, jitter=0)
+        self.assertEqual(
+            [policy.delay(attempts).total_seconds() for attempts in range(1, 6)],
+            [60, 120, 240, 300, 300],
+        )
+        self.assertIsNone(RetryPolicy(max_attempts=2).next_attempt_at(2))
+
+    def test_jitter_spreads_the_delay(self):
+        policy = RetryPolicy(base_delay=100, jitter=0.2)
+        delays = {policy.delay(1).total_seconds() for _ in range(20)}
+        self.assertGreater(len(delays), 1)
+        self.assertTrue(all(80 <= delay <= 120 for delay in delays))
+
+    def fail_once(self):
+        letters = claim_due_letters()
+        self.assertEqual([letter.id for letter in letters], [self.letter.id])
+        with self.assertLogs('letters.delivery', 'ERROR'):
+            sent_ids, failures = send_batch(letters, FakeConnection(fail={'letter 0'}))
+            return record_outcome(letters, sent_ids, failures)
+
+    def test_failed_letter_waits_for_its_retry(self):
+        before = timezone.now()
+        result = self.fail_once()
+
+        letter = Letter.objects.get(pk=self.letter.pk)
+        self.assertEqual(result.failed, [letter.id])
+        self.assertEqual(result.requeued, {letter.id: letter.next_attempt_at})
+        self.assertEqual((letter.delivery_attempts, letter.is_failed), (1, False))
+        self.assertEqual(letter.last_delivery_error, 'letter 0 bounced')
+        delay = (letter.next_attempt_at - before).total_seconds()
+        base = RETRY_POLICY.base_delay
+        self.assertTrue(base * (1 - RETRY_POLICY.jitter) <= delay <= base * (1 + RETRY_POLICY.jitter) + 5)
+        self.assertFalse(due_letters().exists())
+
+    def test_letter_is_given_up_after_the_last_attempt(self):
+        for _ in range(RETRY_POLICY.max_attempts - 1):
+            self.fail_once()
+            Letter.objects.filter(pk=self.letter.pk).update(next_attempt_at=timezone.now())
+        result = self.fail_once()
+
+        letter = Letter.objects.get(pk=self.letter.pk)
+        self.assertEqual(result.given_up, [letter.id])
+        self.assertEqual(result.requeued, {})
+        self.assertEqual((letter.delivery_attempts, letter.is_failed), (RETRY_POLICY.max_attempts, True))
+        # Never due again, however long it waits
+        self.assertFalse(due_letters(timezone.now() + timedelta(days=3650)).exists())
+        self.assertEqual(deliver_due_letters().claimed, 0)
+
+
+@mock.patch('letters.outbox.close_old_connections')
+class OutboxTests(TestCase):
+    def enqueue(self, count=1):
+        with mock.patch.object(outbox, 'OUTBOX_DISPATCH_IN_PROCESS', False):
+            return [enqueue_email(f'subject {n}', 'body', [f'to{n}@example.com']) for n in range(count)]
+
+    def test_enqueue_only_stores_the_message(self, close_old_connections):
+        with mock.patch.object(outbox, 'get_local_dispatcher') as dispatcher:
+            with self.captureOnCommitCallbacks() as callbacks:
+                message = enqueue_email('Your code', 'body', ['otp@example.com'], html_body='<p>body</p>')
+            self.assertEqual(mail.outbox, [])
+            self.assertEqual((message.status, message.attempts, message.to), ('pending', 0, ['otp@example.com']))
+            # The in-process dispatcher is only woken once the row is committed
+            dispatcher.assert_not_called()
+            for callback in callbacks:
+                callback()
+            dispatcher.return_value.wake.assert_called_once_with()
+
+    def test_claimed_messages_are_not_claimed_again(self, close_old_connections):
+        self.enqueue(3)
+        now = timezone.now()
+        claimed = claim_pending(batch_size=2, now=now)
+        self.assertEqual([message.subject for message in claimed], ['subject 0', 'subject 1'])
+        self.assertEqual({(message.status, message.attempts) for message in claimed}, {('sending', 1)})
+        self.assertEqual([message.subject for message in claim_pending(now=now)], ['subject 2'])
+        self.assertEqual(claim_pending(now=now), [])
+        # A dispatcher that died mid-send loses its claim when the lease runs out
+        self.assertEqual(len(claim_pending(now=now + outbox.SENDING_LEASE + timedelta(seconds=1))), 3)
+
+    def test_dispatch_sends_every_ready_message(self, close_old_connections):
+        self.enqueue(5)
+        self.assertEqual(OutboxDispatcher(batch_size=2).dispatch_once(), 5)
+        self.assertEqual(sorted(email.to[0] for email in mail.outbox), [f'to{n}@example.com' for n in range(5)])
+        self.assertEqual(OutboundEmail.objects.filter(status='sent', sent_at__isnull=False).count(), 5)
+
+    def test_failures_back_off_then_give_up(self, close_old_connections):
+        message, = self.enqueue()
+        dispatcher = OutboxDispatcher()
+        with mock.patch('letters.outbox.EmailMultiAlternatives.send', side_effect=ConnectionError('refused')):
+            with self.assertLogs('letters.outbox', 'WARNING'):
+                self.assertEqual(dispatcher.dispatch_once(), 0)
+            message.refresh_from_db()
+            self.assertEqual((message.status, message.attempts, message.last_error), ('pending', 1, 'refused'))
+            self.assertGreater(message.next_attempt_at, timezone.now())
+
+            for _ in range(outbox.OUTBOX_MAX_ATTEMPTS - 1):
+                OutboundEmail.objects.filter(pk=message.pk).update(next_attempt_at=timezone.now())
+                with self.assertLogs('letters.outbox', 'WARNING'):
+                    dispatcher.dispatch_once()
+        message.refresh_from_db()
+        self.assertEqual((message.status, message.attempts), ('failed', outbox.OUTBOX_MAX_ATTEMPTS))
+        self.assertEqual(claim_pending(now=timezone.now() + timedelta(days=1)), [])
+
+
+class OutboxDispatcherThreadTests(TransactionTestCase):
+    def test_woken_dispatcher_sends_from_its_pool(self):
+        # Threads close their connections after each round, as at the end of a request
+        self.enterContext(mock.patch.dict(connection.settings_dict, {'CONN_MAX_AGE': 0}))
+        dispatcher = OutboxDispatcher(workers=2, batch_size=2, poll_interval=None)
+        dispatcher.start()
+        try:
+            with mock.patch.object(outbox, 'OUTBOX_DISPATCH_IN_PROCESS', False):
+                for n in range(5):
+                    enqueue_email(f'subject {n}', 'body', [f'to{n}@example.com'])
+            dispatcher.wake()
+            deadline = time.monotonic() + 10
+            while OutboundEmail.objects.exclude(status='sent').exists() and time.monotonic() < deadline:
+                time.sleep(0.05)
+        finally:
+            dispatcher.stop()
+        self.assertEqual(OutboundEmail.objects.filter(status='sent').count(), 5)
+        self.assertEqual(len(mail.outbox), 5)
+
+
+class ReplicaRouterTests(SimpleTestCase):
+    def setUp(self):
+        self.enterContext(mock.patch.dict(settings.DATABASES, {REPLICA_ALIAS: {}}))
+        self.router = ReplicaRouter()
+
+    def request(self, view, method='get', cookies=None):
+        request = getattr(RequestFactory(), method)('/')
+        request.COOKIES.update(cookies or {})
+
+        def get_response(request):
+            view()
+            return HttpResponse()
+
+        return ReplicaPinMiddleware(get_response)(request)
+
+    def reads(self, model=Letter):
+        return self.router.db_for_read(model)
+
+    def test_get_requests_read_from_the_replica(self):
+        seen = []
+        response = self.request(lambda: seen.extend([self.reads(), self.reads(Session)]))
+        self.assertEqual(seen, [REPLICA_ALIAS, 'default'])
+        self.assertNotIn(PIN_COOKIE, response.cookies)
+        # Outside a request everything stays on the primary
+        self.assertEqual(self.reads(), 'default')
+
+    def test_writes_and_pinned_clients_use_the_primary(self):
+        seen = []
+        self.request(lambda: seen.append(self.reads()), method='post')
+        self.request(lambda: seen.append(self.reads()), cookies={PIN_COOKIE: '1'})
+        self.assertEqual(seen, ['default', 'default'])
+
+    def test_a_write_pins_the_request_and_the_client(self):
+        seen = []
+
+        def view():
+            seen.append(self.reads())
+            self.router.db_for_write(Letter)
+            seen.append(self.reads())
+
+        response = self.request(view)
+        self.assertEqual(seen, [REPLICA_ALIAS, 'default'])
+        self.assertEqual(response.cookies[PIN_COOKIE]['max-age'], PIN_SECONDS)
+
+    def test_primary_only_tables_do_not_pin(self):
+        response = self.request(lambda: self.router.db_for_write(Session))
+        self.assertNotIn(PIN_COOKIE, response.cookies)
+
+    def test_use_primary_block(self):
+        seen = []
+
+        def view():
+            with use_primary():
+                seen.append(self.reads())
+            seen.append(self.reads())
+            with use_primary():
+                self.router.db_for_write(Letter)
+            seen.append(self.reads())
+
+        self.request(view)
+        self.assertEqual(seen, ['default', REPLICA_ALIAS, 'default'])
+
+
+class LeaderElectionTests(TestCase):
+    def contender(self, holder):
+        election = LeaderElection(
+            'test-leader', holder=holder, lease_seconds=60,
+            on_elected=mock.Mock(name='on_elected'), on_deposed=mock.Mock(name='on_deposed'),
+        )
+        election._advisory = False
+        return election
+
+    def test_one_leader_at_a_time(self):
+        a, b = self.contender('a'), self.contender('b')
+        with self.assertLogs('letters.leader', 'INFO'):
+            self.assertTrue(a.poll())
+        self.assertFalse(b.poll())
+        self.assertTrue(a.poll())
+        a.on_elected.assert_called_once_with()
+
+        # Resigning hands the lease over at once
+        a._resign()
+        a.on_deposed.assert_called_once_with()
+        with self.assertLogs('letters.leader', 'INFO'):
+            self.assertTrue(b.poll())
+        self.assertFalse(a.poll())
+
+    def test_standby_takes_over_an_expired_lease(self):
+        a, b = self.contender('a'), self.contender('b')
+        with self.assertLogs('letters.leader', 'INFO'):
+            a.poll()
+        # The leader stopped renewing, e.g. because it died
+        Lease.objects.filter(name='leader:test-leader').update(expires_at=timezone.now() - timedelta(seconds=1))
+        with self.assertLogs('letters.leader', 'INFO'):
+            self.assertTrue(b.poll())
+        with self.assertLogs('letters.leader', 'WARNING'):
+            self.assertFalse(a.poll())
+        a.on_deposed.assert_called_once_with()
+
+    def test_leader_rides_out_a_failed_renewal(self):
+        a = self.contender('a')
+        with self.assertLogs('letters.leader', 'INFO'):
+            a.poll()
+        with mock.patch('letters.leader.acquire_lease', side_effect=DatabaseError('gone away')), \
+                self.assertLogs('letters.leader', 'WARNING'):
+            # Half the lease is left, so nobody else can have taken over yet
+            self.assertTrue(a.poll())
+            a._confirmed_at -= 31
+            self.assertFalse(a.poll())
+        a.on_deposed.assert_called_once_with()
+
+
+class ShardLeaseTests(TestCase):
+    def test_lease_is_exclusive_until_it_expires(self):
+        ttl = timedelta(seconds=30)
+        now = timezone.now()
+        self.assertTrue(acquire_lease('shard', 'a', ttl, now))
+        self.assertFalse(acquire_lease('shard', 'b', ttl, now))
+        self.assertTrue(acquire_lease('shard', 'a', ttl, now))
+        self.assertTrue(acquire_lease('shard', 'b', ttl, now + ttl * 2))
+        release_lease('shard', 'b')
+        self.assertTrue(acquire_lease('shard', 'a', ttl))
+
+    def coordinator(self, worker_id):
+        return ShardCoordinator(worker_id=worker_id, shard_count=4, on_change=mock.Mock())
+
+    def test_workers_split_the_shards_and_take_over_from_leavers(self):
+        a, b = self.coordinator('a'), self.coordinator('b')
+        with self.assertLogs('letters.sharding', 'INFO'):
+            self.assertEqual(a.heartbeat(), {0, 1, 2, 3})
+        # b joins: a gives up its extra shards at its next heartbeat
+        self.assertEqual(b.heartbeat(), set())
+        with self.assertLogs('letters.sharding', 'INFO'):
+            self.assertEqual(a.heartbeat(), {0, 1})
+        with self.assertLogs('letters.sharding', 'INFO'):
+            self.assertEqual(b.heartbeat(), {2, 3})
+        a.on_change.assert_called_with(frozenset({0, 1}))
+        self.assertTrue(b.owns(6) and not b.owns(5))
+
+        a.stop()
+        self.assertFalse(DeliveryWorker.objects.filter(worker_id='a').exists())
+        with self.assertLogs('letters.sharding', 'INFO'):
+            self.assertEqual(b.heartbeat(), {0, 1, 2, 3})
+
+    def test_in_shards_filters_letters_by_id(self):
+        letters = make_letters(User.objects.create_user(email='shards@example.com'), 8)
+        ids = set(in_shards(Letter.objects.all(), {1, 3}, shard_count=4).values_list('id', flat=True))
+        self.assertEqual(ids, {letter.id for letter in letters if letter.id % 4 in (1, 3)})
+
+
+class DeliverCommandTests(TransactionTestCase):
+    """The command's workers have connections of their own, so nothing here runs in a transaction"""
+
+    def setUp(self):
+        self.author = User.objects.create_user(email='deliver@example.com')
+        self.due = make_letters(self.author, 4, start=timezone.now() - timedelta(hours=1), step=timedelta(minutes=1))
+        self.future = make_letters(self.author, 2)
+
+    def deliver(self, *args):
+        out = StringIO()
+        call_command('deliver', *args, '--progress-every', '60', stdout=out)
+        return out.getvalue()
+
+    def test_rejects_conflicting_flags(self):
+        for args in (
+            ['--concurrency', '0'],
+            ['--processes', '-1'],
+            ['--processes', '2', '--concurrency', '2'],
+            ['--max-rate', '0'],
+            # The test mail backend is not SMTP
+            ['--async'],
+        ):
+            with self.subTest(args=args), self.assertRaises(CommandError):
+                self.deliver(*args)
+
+    def test_dry_run_sends_nothing(self):
+        output = self.deliver('--dry-run', '--max-rate', '2')
+        self.assertIn('4 letters to deliver', output)
+        self.assertIn('At 2/s that takes at least 2s', output)
+        self.assertEqual(mail.outbox, [])
+        self.assertFalse(Letter.objects.filter(delivery_attempts__gt=0).exists())
+
+    def test_delivers_due_letters_once_across_workers(self):
+        output = self.deliver('--concurrency', '3', '--batch-size', '1')
+        self.assertIn('Delivered 4 letters', output)
+        self.assertEqual(len(mail.outbox), 4)
+        delivered = set(Letter.objects.filter(is_delivered=True).values_list('id', flat=True))
+        self.assertEqual(delivered, {letter.id for letter in self.due})
+
+    def test_all_leaves_letters_being_retried_alone(self):
+        retry_at = timezone.now() + timedelta(hours=1)
+        Letter.objects.filter(pk=self.future[1].pk).update(
+            delivery_attempts=1, last_delivery_attempt=timezone.now(), next_attempt_at=retry_at,
+        )
+        output = self.deliver('--all')
+        self.assertIn('5 letters to deliver', output)
+        self.assertEqual(len(mail.outbox), 5)
+        retried = Letter.objects.get(pk=self.future[1].pk)
+        self.assertEqual((retried.is_delivered, retried.next_attempt_at), (False, retry_at))
+
+    def test_pacer_spaces_sends(self):
+        pacer = Pacer(10)
+        delays = [pacer.reserve(), pacer.reserve(), pacer.reserve(2), pacer.reserve()]
+        self.assertAlmostEqual(delays[0], 0, delta=0.01)
+        for delay, expected in zip(delays[1:], (0.1, 0.2, 0.4)):
+            self.assertAlmostEqual(delay, expected, delta=0.02)
@@ -0,0 +1,209 @@
+"""
+Letter export and import as JSON lines.
+
+``export_letters`` streams one JSON object per letter, reading the table
+in ``chunk_size`` slices through ``QuerySet.iterator``, so memory stays
+flat however many letters there are. ``import_letters`` reads the same
+format and inserts it with ``bulk_create`` in batches. Letters that
+already exist (same author, title and ``created_at``: the
+``unique_letter`` constraint) are skipped, or updated with
+``on_conflict='update'``. Authors are matched by email. An exported
+``uuid`` that already belongs to a different letter here (an export of
+another database, or of another author's letters) is replaced with a
+new one.
+"""
+from dataclasses import dataclass
+from datetime import datetime
+from itertools import islice
+import json
+import logging
+import uuid
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import transaction
+
+from letters.cache import invalidate_letter_index
+from letters.models import Letter
+
+logger = logging.getLogger(__name__)
+
+TRANSFER_CHUNK_SIZE = getattr(settings, 'LETTER_TRANSFER_CHUNK_SIZE', 2000)
+
+# Exported columns, in file order; ``author`` is the author's email
+LETTER_FIELDS = (
+    'uuid', 'title', 'content', 'delivery_date', 'created_at',
+    'is_delivered', 'sent_at', 'delivery_attempts', 'last_delivery_attempt',
+    'next_attempt_at', 'is_failed', 'last_delivery_error',
+)
+DATETIME_FIELDS = frozenset({
+    'delivery_date', 'created_at', 'sent_at', 'last_delivery_attempt', 'next_attempt_at',
+})
+REQUIRED_FIELDS = ('author', 'title', 'content', 'delivery_date', 'created_at')
+# Columns overwritten when an existing letter is updated
+UPDATE_FIELDS = [
+    'content', 'delivery_date', 'is_delivered', 'sent_at', 'delivery_attempts',
+    'last_delivery_attempt', 'next_attempt_at', 'is_failed', 'last_delivery_error',
+]
+ON_CONFLICT_CHOICES = ('skip', 'update')
+
+
+class InvalidLetter(ValueError):
+    """A line of an import file that cannot be turned into a letter"""
+
+
+@dataclass
+class ImportResult:
+    read: int = 0
+    # New rows inserted
+    imported: int = 0
+    # Letters that already existed, updated or left alone per on_conflict
+    updated: int = 0
+    skipped: int = 0
+    missing_authors: int = 0
+    invalid: int = 0
+
+
+def _encode(value):
+    # isoformat() keeps microseconds, which unique_letter depends on
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    raise TypeError(f"Cannot serialize {type(value).__name__}")
+
+
+def export_letters(queryset=None, chunk_size=None):
+    """Yield the letters of ``queryset`` as JSON lines, oldest first"""
+    queryset = Letter.objects.all() if queryset is None else queryset
+    rows = (
+        queryset.order_by('id')
+        .values_list('author__email', *LETTER_FIELDS)
+        .iterator(chunk_size=chunk_size or TRANSFER_CHUNK_SIZE)
+    )
+    names = ('author',) + LETTER_FIELDS
+    for row in rows:
+        yield json.dumps(dict(zip(names, row)), default=_encode, ensure_ascii=False) + '\n'
+
+
+def _parse(line):
+    try:
+        data = json.loads(line)
+    except json.JSONDecodeError as e:
+        raise InvalidLetter(f"invalid JSON: {e}") from e
+    if not isinstance(data, dict):
+        raise InvalidLetter("expected a JSON object")
+    missing = [name for name in REQUIRED_FIELDS if data.get(name) in (None, '')]
+    if missing:
+        raise InvalidLetter(f"missing {', '.join(missing)}")
+    values = {name: data[name] for name in LETTER_FIELDS if data.get(name) is not None}
+    try:
+        for name in DATETIME_FIELDS & values.keys():
+            values[name] = datetime.fromisoformat(values[name])
+        if 'uuid' in values:
+            values['uuid'] = uuid.UUID(values['uuid'])
+    except (TypeError, ValueError) as e:
+        raise InvalidLetter(str(e)) from e
+    values.setdefault('next_attempt_at', values['delivery_date'])
+    return data['author'].strip(), values
+
+
+def import_letters(lines, on_conflict='skip', batch_size=None):
+    """
+    Insert letters from JSON ``lines``; returns an ``ImportResult``.
+
+    Each batch is one transaction. Letters whose author has no account
+    here and lines that cannot be parsed are counted and skipped.
+    """
+    if on_conflict not in ON_CONFLICT_CHOICES:
+        raise ValueError(f"on_conflict must be one of {ON_CONFLICT_CHOICES}")
+    batch_size = batch_size or TRANSFER_CHUNK_SIZE
+    result = ImportResult()
+    lines = iter(lines)
+    line_number = 0
+
+    while True:
+        chunk = list(islice(lines, batch_size))
+        if not chunk:
+            break
+        batch = []
+        for line in chunk:
+            line_number += 1
+            if not line.strip():
+                continue
+            result.read += 1
+            try:
+                batch.append(_parse(line))
+            except InvalidLetter as e:
+                result.invalid += 1
+                logger.warning("Skipping line %s of letter import: %s", line_number, e)
+        if batch:
+            _import_batch(batch, on_conflict, result)
+    return result
+
+
+def _import_batch(batch, on_conflict, result):
+    emails = {email for email, _ in batch}
+    author_ids = dict(
+        get_user_model().objects.filter(email__in=emails).values_list('email', 'id')
+    )
+    # Keyed on unique_letter: PostgreSQL refuses to upsert the same row
+    # twice in one statement, so the last copy in a batch wins
+    letters = {}
+    for email, values in batch:
+        author_id = author_ids.get(email)
+        if author_id is None:
+            result.missing_authors += 1
+            continue
+        letters[author_id, values['title'], values['created_at']] = Letter(author_id=author_id, **values)
+    if not letters:
+        return
+
+    existing = {
+        (author_id, title, created_at): letter_uuid
+        for author_id, title, created_at, letter_uuid in Letter.objects.filter(
+            author_id__in={key[0] for key in letters},
+            title__in={key[1] for key in letters},
+        ).values_list('author_id', 'title', 'created_at', 'uuid')
+    }
+    taken = {
+        letter_uuid: (author_id, title, created_at)
+        for letter_uuid, author_id, title, created_at in Letter.objects.filter(
+            uuid__in=[letter.uuid for letter in letters.values()],
+        ).values_list('uuid', 'author_id', 'title', 'created_at')
+    }
+    new, known = [], []
+    for key, letter in letters.items():
+        if key in existing:
+            # The upsert only looks at unique_letter; any other uuid would
+            # hit the uuid constraint instead
+            letter.uuid = existing[key]
+            known.append(letter)
+            continue
+        if taken.get(letter.uuid, key) != key:
+            letter.uuid = uuid.uuid4()
+        taken[letter.uuid] = key
+        new.append(letter)
+
+    if on_conflict == 'update':
+        letters, options = new + known, {
+            'update_conflicts': True,
+            'unique_fields': ['author', 'title', 'created_at'],
+            'update_fields': UPDATE_FIELDS,
+        }
+    else:
+        letters, options = new, {'ignore_conflicts': True}
+    if letters:
+        with transaction.atomic():
+            Letter.objects.bulk_create(letters, **options)
+        # bulk_create does not send post_save
+        invalidate_letter_index(*{letter.author_id for letter in letters})
+
+    # Counted from the table: a concurrent import may have inserted some
+    # of these letters first, and ignore_conflicts drops them silently
+    inserted = Letter.objects.filter(uuid__in=[letter.uuid for letter in new]).count() if new else 0
+    result.imported += inserted
+    if on_conflict == 'update':
+        result.updated += len(known)
+    else:
+        result.skipped += len(known) + len(new) - inserted
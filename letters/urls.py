@@ -10,5 +10,6 @@ urlpatterns = [
     path('write/', views.write_letter, name='write_letter'),
     path('letter/<int:letter_id>/', views.view_letter, name='view_letter'),
     path('api/letters/', views.api_letters, name='api_letters'),
+    path('api/letters/export/', views.export_letters_view, name='export_letters'),
     path('confirmation/', views.confirmation_view, name='confirmation'),
 ]
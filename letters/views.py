@@ -1,13 +1,20 @@
 from django.shortcuts import render, redirect
 from django.contrib.auth import login, authenticate, logout
 from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth import get_user_model
-from django.http import JsonResponse
+from django.http import HttpResponse, HttpResponseNotModified, JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_protect, csrf_exempt
 from django.views.decorators.http import require_http_methods
 from django.core.mail import send_mail
 from .models import Letter
+from .cache import INDEX_FIELDS, get_letter_index
+from .deadlines import notify_letter_scheduled
+from .pagination import InvalidCursor, KeysetPaginator
+from .transfer import export_letters
 from accounts.models import PendingRegistration
+from futureme.log import log_event
+import hashlib
 import json
 import random
 import logging
@@ -18,6 +25,10 @@ from django.contrib import messages
 from datetime import datetime, timedelta
 from django.contrib.auth.hashers import make_password
 from django.db import transaction
+from django.db.models import Case, CharField, Count, Q, Value, When
+from django.utils.cache import patch_cache_control
+from django.utils.http import parse_etags, quote_etag
+from rest_framework.decorators import api_view
 
 logger = logging.getLogger(__name__)
 User = get_user_model()  # Get the custom user model
@@ -25,44 +36,81 @@ User = get_user_model()  # Get the custom user model
 def home_view(request):
     return render(request, 'index.html')
 
+DASHBOARD_FIELDS = ('id', 'title', 'delivery_date', 'is_delivered', 'sent_at', 'status')
+dashboard_paginator = KeysetPaginator(ordering=('-delivery_date', '-id'), page_size=24, max_page_size=100)
+
+def letter_status(now):
+    """Database expression for a letter's dashboard status"""
+    return Case(
+        When(is_delivered=True, then=Value('delivered')),
+        When(is_failed=True, then=Value('failed')),
+        When(delivery_date__lte=now, then=Value('overdue')),
+        default=Value('scheduled'),
+        output_field=CharField(),
+    )
+
+def letter_status_counts(letters, now):
+    """Count ``letters`` per dashboard status in a single query"""
+    pending = Q(is_delivered=False, is_failed=False)
+    return letters.aggregate(
+        total=Count('id'),
+        delivered=Count('id', filter=Q(is_delivered=True)),
+        failed=Count('id', filter=Q(is_delivered=False, is_failed=True)),
+        overdue=Count('id', filter=pending & Q(delivery_date__lte=now)),
+        scheduled=Count('id', filter=pending & Q(delivery_date__gt=now)),
+    )
+
+def indexed_letter_status(row, now):
+    """``letter_status`` for a row of the cached letter index"""
+    if row['is_delivered']:
+        return 'delivered'
+    if row['is_failed']:
+        return 'failed'
+    if row['delivery_date'] <= now:
+        return 'overdue'
+    return 'scheduled'
+
+def _dashboard_from_index(index, now, cursor, limit):
+    counts = {'total': len(index), 'delivered': 0, 'failed': 0, 'overdue': 0, 'scheduled': 0}
+    for row in index:
+        row['status'] = indexed_letter_status(row, now)
+        counts[row['status']] += 1
+    page = dashboard_paginator.paginate_rows(index, Letter, cursor=cursor, limit=limit)
+    return page, counts
+
+def _dashboard_from_database(letters, now, cursor, limit):
+    page = dashboard_paginator.paginate(
+        letters.annotate(status=letter_status(now)),
+        cursor=cursor,
+        limit=limit,
+        values=DASHBOARD_FIELDS,
+    )
+    return page, letter_status_counts(letters, now)
+
 @login_required
 def dashboard(request):
     """Display user's letters and their status"""
     try:
-        # Get all letters for the current user, ordered by delivery date
-        letters = Letter.objects.filter(author=request.user).order_by('-delivery_date')
-        
-        # Process each letter to determine its status
-        for letter in letters:
-            now = timezone.now()
-            
-            # Update status based on delivery date and is_delivered flag
-            if letter.is_delivered:
-                letter.status = 'Delivered'
-                letter.status_class = 'success'
-            elif letter.delivery_date <= now:
-                letter.status = 'Overdue'
-                letter.status_class = 'danger'
-            else:
-                time_diff = letter.delivery_date - now
-                if time_diff.days > 0:
-                    letter.status = f'In {time_diff.days} days'
-                elif time_diff.seconds >= 3600:
-                    hours = time_diff.seconds // 3600
-                    letter.status = f'In {hours} hours'
-                else:
-                    minutes = time_diff.seconds // 60
-                    letter.status = f'In {minutes} minutes'
-                letter.status_class = 'info'
-            
-            # Add delivery time information
-            if letter.is_delivered and letter.sent_at:
-                letter.delivery_time = letter.sent_at.strftime('%Y-%m-%d %H:%M:%S UTC')
+        now = timezone.now()
+        cursor = request.GET.get('cursor')
+        limit = request.GET.get('limit')
+        # Served from the per-user cache when possible; users with too many
+        # letters to cache fall back to the projected database queries
+        index = get_letter_index(request.user.id)
+        try:
+            if index is not None:
+                page, counts = _dashboard_from_index(index, now, cursor, limit)
             else:
-                letter.delivery_time = letter.delivery_date.strftime('%Y-%m-%d %H:%M:%S UTC')
-        
+                letters = Letter.objects.filter(author=request.user)
+                page, counts = _dashboard_from_database(letters, now, cursor, limit)
+        except InvalidCursor:
+            return redirect('dashboard')
+
         context = {
-            'letters': letters,
+            'letters': page.items,
+            'next_cursor': page.next_cursor,
+            'is_first_page': not cursor,
+            'counts': counts,
             'user': request.user
         }
         return render(request, 'dashboard.html', context)
@@ -85,12 +133,6 @@ def write_letter(request):
         delivery_date_str = data.get('delivery_date')
         timezone_offset = data.get('timezone_offset', 0)  # Get timezone offset in minutes
         
-        logger.info(f"\n=== Letter Creation Debug ===")
-        logger.info(f"Received letter data:")
-        logger.info(f"Title: {title}")
-        logger.info(f"Delivery Date (raw): {delivery_date_str}")
-        logger.info(f"Timezone Offset: {timezone_offset} minutes")
-        
         if not all([title, content, delivery_date_str]):
             logger.error("Missing required fields")
             return JsonResponse({'error': 'All fields are required'}, status=400)
@@ -106,13 +148,8 @@ def write_letter(request):
             # Get current time in UTC
             now = timezone.now()
             
-            logger.info(f"Time comparison:")
-            logger.info(f"Current time (UTC): {now}")
-            logger.info(f"Delivery time (UTC): {delivery_date}")
-            logger.info(f"Time difference: {delivery_date - now}")
-            
             if delivery_date <= now:
-                logger.error("Delivery date is not in the future")
+                logger.info("Rejected letter with past delivery date %s", delivery_date)
                 return JsonResponse({'error': 'Delivery date must be in the future'}, status=400)
             
             # Sanitize content
@@ -129,17 +166,17 @@ def write_letter(request):
                         delivery_attempts=0,  # Initialize delivery attempts
                         last_delivery_attempt=None  # Initialize last attempt
                     )
+
+                    log_event(
+                        logger, 'letter.created',
+                        letter_id=letter.id,
+                        author_id=letter.author_id,
+                        delivery_date=letter.delivery_date.isoformat(),
+                        timezone_offset=timezone_offset,
+                    )
                     
-                    logger.info(f"Successfully created letter:")
-                    logger.info(f"Letter ID: {letter.id}")
-                    logger.info(f"Author: {letter.author.email}")
-                    logger.info(f"Delivery Date (UTC): {letter.delivery_date}")
-                    logger.info(f"Is Delivered: {letter.is_delivered}")
-                    logger.info(f"Delivery Attempts: {letter.delivery_attempts}")
-                    logger.info("=== End Letter Creation Debug ===\n")
-                    
-                    # Store letter ID in session for confirmation
-                    request.session['last_letter_id'] = letter.id
+                    # Wake the deadline scheduler once the letter is committed
+                    transaction.on_commit(lambda: notify_letter_scheduled(letter))
                     
                     return JsonResponse({
                         'message': 'Letter saved successfully',
@@ -160,21 +197,97 @@ def write_letter(request):
         logger.error(f"Unexpected error saving letter: {str(e)}", exc_info=True)
         return JsonResponse({'error': 'Failed to save letter'}, status=500)
 
-@login_required(login_url='/accounts/login/')
+# Fields a client may ask for with ?fields=; the default keeps the
+# original response shape
+API_LETTER_FIELDS = ('id', 'title', 'content', 'delivery_date', 'created_at', 'is_delivered', 'sent_at')
+API_LETTER_DEFAULT_FIELDS = ('id', 'title', 'content', 'delivery_date', 'created_at')
+api_paginator = KeysetPaginator(ordering=('delivery_date', 'id'), page_size=50, max_page_size=200)
+
+def _json_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+@api_view(['GET'])
 def api_letters(request):
-    letters = Letter.objects.filter(author=request.user).order_by('delivery_date')
-    return JsonResponse({
+    """
+    The user's letters in delivery order, one page at a time.
+
+    Query parameters: ``cursor`` (the ``next_cursor`` of the previous page),
+    ``limit`` (page size, at most 200) and ``fields`` (comma-separated, e.g.
+    ``fields=id,title,delivery_date`` to leave out the content). Responses
+    carry an ETag, so polling clients can send If-None-Match and get a 304.
+
+    Runs through DRF so clients can authenticate with ``Authorization:
+    Token <key>`` (served from ``CachedTokenAuthentication``) as well as
+    with the browser session; unauthenticated requests get a 401.
+    """
+    fields = request.GET.get('fields')
+    if fields:
+        fields = [name.strip() for name in fields.split(',') if name.strip()]
+        unknown = set(fields) - set(API_LETTER_FIELDS)
+        if unknown:
+            return JsonResponse(
+                {'error': f"Unknown fields: {', '.join(sorted(unknown))}"}, status=400
+            )
+    else:
+        fields = API_LETTER_DEFAULT_FIELDS
+
+    # Lists without content can come from the cached letter index
+    index = get_letter_index(request.user.id) if set(fields) <= set(INDEX_FIELDS) else None
+    try:
+        if index is not None:
+            page = api_paginator.paginate_rows(
+                index, Letter,
+                cursor=request.GET.get('cursor'),
+                limit=request.GET.get('limit'),
+            )
+        else:
+            page = api_paginator.paginate(
+                Letter.objects.filter(author=request.user),
+                cursor=request.GET.get('cursor'),
+                limit=request.GET.get('limit'),
+                values=fields,
+            )
+    except InvalidCursor:
+        return JsonResponse({'error': 'Invalid cursor'}, status=400)
+
+    body = json.dumps({
         'letters': [
-            {
-                'id': letter.id,
-                'title': letter.title,
-                'content': letter.content,
-                'delivery_date': letter.delivery_date.isoformat(),
-                'created_at': letter.created_at.isoformat()
-            }
-            for letter in letters
-        ]
-    })
+            {name: _json_value(row[name]) for name in fields}
+            for row in page.items
+        ],
+        'next_cursor': page.next_cursor,
+    }, separators=(',', ':'))
+
+    etag = quote_etag(hashlib.md5(body.encode(), usedforsecurity=False).hexdigest())
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match and (if_none_match.strip() == '*' or etag in parse_etags(if_none_match)):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(body, content_type='application/json')
+    response['ETag'] = etag
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+@staff_member_required
+@require_http_methods(["GET"])
+def export_letters_view(request):
+    """
+    Stream every letter as a JSON lines download, for backups and moving
+    users between environments. ``?email=`` (repeatable) limits the export
+    to those authors. Import the file with ``manage.py import_letters``.
+    """
+    letters = Letter.objects.all()
+    emails = request.GET.getlist('email')
+    if emails:
+        letters = letters.filter(author__email__in=emails)
+    # Fix the database now: the body is generated after the middleware
+    # that routes this request's reads has returned
+    letters = letters.using(letters.db)
+
+    response = StreamingHttpResponse(export_letters(letters), content_type='application/x-ndjson')
+    response['Content-Disposition'] = 'attachment; filename="letters.jsonl"'
+    patch_cache_control(response, private=True, no_store=True)
+    return response
 
 @login_required
 def confirmation_view(request):